@@ -0,0 +1,210 @@
+import json
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from export_backend import load_yolo, resolve_backend
+from image_cache import IMAGE_CACHE, ImageCache
+from profiling import TRACER
+from render_results import render_detections
+from verification.vertools.prediction_store import PredictionWriter
+from verification.vertools.result_cache import CACHE_DIR, ResultCache
+
+IMAGE_SUFFIXES = {".bmp", ".png", ".jpg", ".jpeg", ".tif", ".tiff"}
+# save=True のときに描画した画像の保存先
+SAVE_DIR = Path("predict/annotated")
+# 推論結果は変えずにファイルを書き出す引数（キャッシュのキーには含めない）
+SIDE_EFFECT_KWARGS = ("save", "save_txt", "save_conf", "save_crop")
+# そのうち ultralytics 自身が書き出すもの（指定された場合はキャッシュから読まずに推論する）
+PREDICTOR_OUTPUT_KWARGS = ("save_txt", "save_crop")
+
+
+def fold_jobs(images_dir: Path, runs_dir: Path) -> dict[Path, list[Path]]:
+    """
+    leave-one-out の各画像を、その画像を学習から除いたモデル (runs_dir/no_<画像名>) に割り当てる
+    チェックポイントが見つからない画像はスキップする
+
+    :param images_dir: 画像ディレクトリ
+    :param runs_dir: no_<画像名> のフォルダが並ぶディレクトリ（例: runs/BoundingBox）
+    :return: {チェックポイントのパス: [画像のパス, ...]}（画像名順）
+    """
+    jobs = {}
+    for img_path in sorted(Path(images_dir).iterdir()):
+        if img_path.suffix.lower() not in IMAGE_SUFFIXES:
+            continue
+        checkpoint = Path(runs_dir) / f"no_{img_path.stem}" / "weights" / "best.pt"
+        if not checkpoint.exists():
+            print(f"チェックポイントが存在しないためスキップします: {checkpoint}")
+            continue
+        jobs.setdefault(checkpoint, []).append(img_path)
+    return jobs
+
+
+def load_fold_model(checkpoint: Path, backend: str = "auto"):
+    """
+    モデルを読み込み、読み込みにかかった時間とともに返す
+    エクスポート済みの ONNX があればそちらを使う（export_backend.resolve_backend）
+
+    :param backend: "auto" / "torch" / "onnx" / "onnx_int8"
+    :return: (モデル, 読み込み時間[秒])
+    """
+    start = time.perf_counter()
+    model = load_yolo(checkpoint, backend)
+    return model, time.perf_counter() - start
+
+
+def save_annotated(image, detections, names: dict, output_path: Path) -> bool:
+    """
+    検出結果を描画した画像を output_path に保存する（描画は render_results と同じ見た目）
+
+    :param image: 元画像（書き換えない）
+    :param detections: (N, 6) の [x1, y1, x2, y2, conf, cls]
+    :param names: {クラスインデックス: クラス名}
+    :return: 保存できた場合 True
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    annotated = render_detections(image.copy(), detections, names)
+    with TRACER.stage("serialize", image=output_path.stem):
+        return cv2.imwrite(str(output_path), annotated)
+
+
+def predict_in_batches(model, image_paths: list[Path], batch_size: int = 8, cache: ImageCache = None,
+                       save_dir: Path = SAVE_DIR, **predict_kwargs):
+    """
+    画像を batch_size 枚ずつまとめて推論し、バッチごとに結果を返すジェネレータ
+    画像のデコードは別スレッドで先読みし、推論と重ねて行う
+
+    デコード済みの配列を渡して推論すると ultralytics は画像名を知らず、save=True の描画画像は
+    image0.jpg, image1.jpg, ... になってバッチごとに上書きされる。そのため save は ultralytics に渡さず、
+    描画画像は save_dir/<画像のファイル名> に自前で保存する
+    save_txt・save_crop などその他の書き出しを指定した場合は、ファイル名を保つためパスを渡して推論する
+
+    :param model: 読み込み済みの YOLO モデル
+    :param image_paths: 画像のパスのリスト
+    :param batch_size: 1回の推論でまとめる画像の枚数
+    :param cache: デコード済み画像のキャッシュ（省略時は image_cache.IMAGE_CACHE）
+    :param save_dir: save=True のときの描画画像の保存先
+    :param predict_kwargs: model.predict に渡す引数（conf, iou, device, save など）
+    :return: (画像パスのリスト, 結果のリスト, 推論時間[秒]) を順に返す
+    """
+    cache = IMAGE_CACHE if cache is None else cache
+    save = predict_kwargs.pop("save", False)
+    by_path = any(predict_kwargs.get(k) for k in PREDICTOR_OUTPUT_KWARGS)
+    chunk, images = [], []
+    # 先読みは次のバッチ分まで
+    for n, (path, image) in enumerate(cache.prefetch(image_paths, depth=batch_size), start=1):
+        chunk.append(path)
+        images.append(image)
+        if len(chunk) == batch_size or n == len(image_paths):
+            source = [str(p) for p in chunk] if by_path else images
+            t0 = time.perf_counter()
+            with TRACER.stage("predict", images=len(images)):
+                results = model.predict(source, batch=len(images), verbose=False, **predict_kwargs)
+            elapsed = time.perf_counter() - t0
+            for img_path, image, r in zip(chunk, images, results):
+                TRACER.record_speed(r, Path(img_path).stem)
+                if save:
+                    save_annotated(image, r.boxes.data[:, :6].cpu().numpy(), r.names,
+                                   Path(save_dir) / Path(img_path).name)
+            yield chunk, results, elapsed
+            chunk, images = [], []
+
+
+def prediction_key(cache: ResultCache, checkpoint: Path, image_path: Path, backend: str, predict_kwargs: dict) -> str:
+    """
+    推論結果のキャッシュのキー
+    実際に読み込むモデルファイル（ONNX に変換済みならそちら）と画像の内容、推論の引数から作る
+    save などの結果に影響しない引数（SIDE_EFFECT_KWARGS）は含めない
+    """
+    model_path, backend_name = resolve_backend(checkpoint, backend)
+    predict_kwargs = {k: v for k, v in predict_kwargs.items() if k not in SIDE_EFFECT_KWARGS}
+    return cache.key("predict", cache.file_digest(model_path), backend_name, cache.file_digest(image_path),
+                     predict_kwargs)
+
+
+def run_leave_one_out(images_dir: Path,
+                      runs_dir: Path = Path("runs/BoundingBox"),
+                      store_dir: Path = Path("predict/store"),
+                      batch_size: int = 8,
+                      backend: str = "auto",
+                      cache_dir: Path = CACHE_DIR,
+                      save_dir: Path = SAVE_DIR,
+                      **predict_kwargs) -> dict[str, float]:
+    """
+    各チェックポイントを一度だけ読み込み、割り当てられた画像をバッチ推論して
+    結果をバッチが終わるたびに列形式のストアへ書き出す
+    以前と同じモデル・画像・引数の結果はキャッシュから書き出し、全画像がキャッシュにある fold はモデルを読み込まない
+    save=True の場合、キャッシュから書き出した画像も保存済みの検出を描画して save_dir に保存する
+    save_txt・save_crop（PREDICTOR_OUTPUT_KWARGS）は ultralytics が書き出すため、
+    指定された場合はキャッシュからは読まずに全画像を推論する（結果はキャッシュに保存する）
+
+    :param images_dir: 画像ディレクトリ
+    :param runs_dir: no_<画像名> のフォルダが並ぶディレクトリ
+    :param store_dir: 結果の出力先（prediction_store 形式）
+    :param batch_size: 1回の推論でまとめる画像の枚数
+    :param backend: モデルの形式（load_fold_model を参照）
+    :param cache_dir: 推論結果のキャッシュ（result_cache.ResultCache）の保存先。None でキャッシュを使わない
+    :param save_dir: save=True のときの描画画像の保存先（<画像のファイル名> で保存する）
+    :param predict_kwargs: model.predict に渡す引数
+    :return: {'load_time': モデル読み込みの合計時間, 'inference_time': 推論の合計時間, 'images': 処理した画像数,
+              'cached': キャッシュから書き出した画像数}
+    """
+    jobs = fold_jobs(images_dir, runs_dir)
+    cache = ResultCache(cache_dir) if cache_dir is not None else None
+    use_cached = not any(predict_kwargs.get(k) for k in PREDICTOR_OUTPUT_KWARGS)
+    load_total = 0.0
+    infer_total = 0.0
+    n_images = 0
+    n_cached = 0
+
+    with PredictionWriter(store_dir) as writer:
+        for checkpoint, image_paths in jobs.items():
+            keys = {}
+            todo = image_paths
+            if cache is not None:
+                keys = {p: prediction_key(cache, checkpoint, p, backend, predict_kwargs) for p in image_paths}
+            if cache is not None and use_cached:
+                todo = []
+                for img_path in image_paths:
+                    cached = cache.get(keys[img_path])
+                    if cached is None:
+                        todo.append(img_path)
+                        continue
+                    names = {int(k): v for k, v in json.loads(str(cached['names'])).items()}
+                    writer.add(img_path.stem, cached['boxes'], cached['conf'], cached['cls'], names=names)
+                    if predict_kwargs.get("save"):
+                        detections = np.column_stack([cached['boxes'], cached['conf'], cached['cls']])
+                        save_annotated(IMAGE_CACHE.get(img_path), detections, names, Path(save_dir) / img_path.name)
+                    n_cached += 1
+            print(f"使用モデル：{checkpoint}, 画像数：{len(image_paths)}（キャッシュ済み：{len(image_paths) - len(todo)}）")
+            if not todo:
+                continue
+
+            model, load_time = load_fold_model(checkpoint, backend)
+            load_total += load_time
+
+            infer_time = 0.0
+            for chunk, results, elapsed in predict_in_batches(model, todo, batch_size, save_dir=save_dir,
+                                                              **predict_kwargs):
+                infer_time += elapsed
+                for img_path, r in zip(chunk, results):
+                    with TRACER.stage("serialize", image=img_path.stem):
+                        arrays = {'boxes': r.boxes.xyxy.cpu().numpy(),
+                                  'conf': r.boxes.conf.cpu().numpy(),
+                                  'cls': r.boxes.cls.cpu().numpy()}
+                        writer.add(img_path.stem, **arrays, names=r.names)
+                        if cache is not None:
+                            cache.put(keys[img_path], dict(arrays, names=json.dumps(r.names, ensure_ascii=False)),
+                                      kind="predict")
+                n_images += len(chunk)
+            infer_total += infer_time
+            print(f"  読み込み時間: {load_time:.2f}秒, 推論時間: {infer_time:.2f}秒")
+
+    if cache is not None:
+        cache.close()
+    print(f"モデル読み込み合計: {load_total:.2f}秒, 推論合計: {infer_total:.2f}秒, 画像数: {n_images}, "
+          f"キャッシュから: {n_cached}")
+    return {'load_time': load_total, 'inference_time': infer_total, 'images': n_images, 'cached': n_cached}
@@ -1,13 +1,17 @@
 import os
-from ultralytics import YOLO
 from pathlib import Path
 
-def load_model(model_path):
+from batch_predict import fold_jobs
+from export_backend import load_yolo
+from stream_predict import consume, stream_predict
+
+def load_model(model_path, backend="auto"):
     """
     モデルを読み込み、エラー発生時は例外を送出する。
+    best.pt と同じフォルダにエクスポート済みの ONNX があれば、そちらを優先して読み込む（backend="torch" で無効）。
     """
     try:
-        model = YOLO(model_path)
+        model = load_yolo(model_path, backend)
         print("モデルの読み込みに成功しました。")
         return model
     except Exception as e:
@@ -24,47 +28,40 @@ def get_target_class_index(model, target_class):
             return idx
     raise ValueError(f"対象クラス '{target_class}' がモデルに存在しません。")
 
-def perform_inference(model, image_path, target_class_index, conf=0.7, iou=0.2, imgsz=512, device="cpu"):
+def perform_inference(model, image_path, target_class_index, conf=0.7, iou=0.2, imgsz=512, device="cpu", depth=2):
     """
     画像ファイルの存在確認後、対象クラスのみ検出するように推論を実行する。
+    結果はリストにまとめず、1 枚ずつ返すジェネレータとして返す（ディレクトリを渡しても、
+    元の解像度のマスクを持つ結果は最大 depth 枚しかメモリに残らない）。
     """
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"画像ファイルが存在しません: {image_path}")
-    try:
-        results = model.predict(
-            source=image_path,      # 画像またはディレクトリ
-            conf=conf,              # 信頼度の閾値
-            iou=iou,                # NMS IoUの閾値
-            device=device,          # 推論デバイス（CPUまたはGPU）
-            imgsz=imgsz,            # 推論時のリサイズ
-            classes=[target_class_index],  # 対象クラスのみ検出する
-            agnostic_nms=False,
-            show_labels=False,
-            show_conf=True,
-            max_det=1000,
-            save=True,
-            save_txt=True,
-            save_conf=True,
-            verbose=True,
-            retina_masks=True
-        )
-        if not results:
-            raise ValueError("推論結果が空です。")
-        return results
-    except Exception as e:
-        print(f"推論中にエラーが発生しました: {e}")
-        raise
+    # 推論中のエラーは、結果を受け取る側（consume）で送出される
+    return stream_predict(
+        model,
+        image_path,             # 画像またはディレクトリ
+        depth=depth,            # 先に推論しておく結果の最大枚数
+        conf=conf,              # 信頼度の閾値
+        iou=iou,                # NMS IoUの閾値
+        device=device,          # 推論デバイス（CPUまたはGPU）
+        imgsz=imgsz,            # 推論時のリサイズ
+        classes=[target_class_index],  # 対象クラスのみ検出する
+        agnostic_nms=False,
+        show_labels=False,
+        show_conf=True,
+        max_det=1000,
+        save=True,
+        save_txt=True,
+        save_conf=True,
+        verbose=True,
+        retina_masks=True
+    )
 
-def process_results(results):
+def process_results(res):
     """
-    推論結果からバウンディングボックス情報を抽出して表示する。
+    推論結果（1 枚分）からバウンディングボックス情報を抽出して表示する。
+    consume に渡すシンクとして使える。
     """
-    try:
-        res = results[0]
-    except IndexError:
-        print("推論結果が見つかりません。")
-        return
-
     if hasattr(res, "boxes") and res.boxes is not None:
         print(f"検出されたバウンディングボックス情報: {res.boxes}")
     else:
@@ -74,16 +71,24 @@ def main():
     model_path = Path('runs\\independ')
     image_path = Path("YOLO_dataset_zip\\project-6-at-2025-03-23-20-14-00444e1f\\images")
     target_class = "y2o3"
-          
-    for img, mod in zip(image_path.iterdir(), model_path.iterdir()): # i want to iterate both the images and the model
-        print(f'Image: {img}, Model: {mod}')
+
+    # 画像名 <stem> ごとに no_<stem> のモデルを対応付け、各モデルは一度だけ読み込む
+    for checkpoint, images in fold_jobs(image_path, model_path).items():
+        print(f'Model: {checkpoint}, Images: {[img.name for img in images]}')
         try:
-            model = load_model(mod / 'weights' / 'best.pt')
+            model = load_model(checkpoint)
             target_index = get_target_class_index(model, target_class)
-            results = perform_inference(model, img, target_index)
-            # process_results(results)
         except Exception as e:
             print(f"エラーが発生しました: {e}")
+            continue
+        for img in images:
+            try:
+                # 結果は 1 枚ずつシンクに渡して手放す（例: [process_results, stream_predict.JsonSink(Path("predict"))]）
+                sinks = []
+                if consume(perform_inference(model, img, target_index), sinks) == 0:
+                    raise ValueError("推論結果が空です。")
+            except Exception as e:
+                print(f"エラーが発生しました: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
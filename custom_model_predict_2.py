@@ -1,14 +1,23 @@
 import os
+from pathlib import Path
+
 import cv2
-from ultralytics import YOLO
+
+from export_backend import load_yolo
+from image_cache import imread_cached
+from profiling import TRACER
+from render_results import render_detections
+from tiled_predict import perform_tiled_inference
+from tta_predict import perform_tta_inference
 
 
-def load_model(model_path):
+def load_model(model_path, backend="auto"):
     """
     モデルを読み込み、エラー発生時は例外を送出する。
+    best.pt と同じフォルダにエクスポート済みの ONNX があれば、そちらを優先して読み込む（backend="torch" で無効）。
     """
     try:
-        model = YOLO(model_path)
+        model = load_yolo(model_path, backend)
         print("モデルの読み込みに成功しました。")
         return model
     except Exception as e:
@@ -65,6 +74,9 @@ def perform_inference(model, image_path, target_class_indices, conf=0.4, iou=0.5
         )
         if not results:
             raise ValueError("推論結果が空です。")
+        for res in results:
+            # ultralytics が計測した前処理・推論・後処理の時間を記録する
+            TRACER.record_speed(res, Path(res.path).stem)
         return results
     except Exception as e:
         print(f"推論中にエラーが発生しました: {e}")
@@ -86,8 +98,10 @@ def process_results(results, image_path, custom_mapping):
         return
 
     # 元画像の読み込み
-    image = cv2.imread(image_path)
-    if image is None:
+    # 同じ画像を何度も描画する場合はデコード済みの画像を使い回す（キャッシュの画像は書き換えずコピーに描画する）
+    try:
+        image = imread_cached(image_path).copy()
+    except (OSError, ValueError):
         print("画像の読み込みに失敗しました。")
         return
 
@@ -108,53 +122,12 @@ def process_results(results, image_path, custom_mapping):
         print(f"検出結果の取得に失敗しました: {e}")
         return
 
-    # 描画パラメータ
-    box_color = (255, 0, 0)       # 緑色
-    box_thickness = 1
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    font_scale = 0.5              # 小さいフォントサイズ
-    text_thickness = 1
-    text_color = (255, 255, 255)  # 白色
-    bg_color = (0, 0, 0)          # 黒色（背景）
-    alpha = 0.5                 # 半透明
-
-    for box in boxes:
-        # 各ボックス情報： [x1, y1, x2, y2, conf, cls]
-        x1, y1, x2, y2, conf, cls = box
-        x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-        # バウンディングボックスの描画
-        cv2.rectangle(image, (x1, y1), (x2, y2), box_color, box_thickness)
-
-        # 結果オブジェクトの names 属性から、対応するラベルを取得
-        label_text = res.names[int(cls)]
-
-        # テキストサイズの取得
-        (text_width, text_height), baseline = cv2.getTextSize(
-            label_text, font, font_scale, text_thickness)
-
-        # テキスト背景の左上座標（バウンディングボックス上部、画像外に出ないよう調整）
-        text_x = x1
-        text_y = y1 - 10 if y1 - 10 > text_height + \
-            baseline else y1 + text_height + baseline
-
-        # テキスト背景用の矩形座標
-        rect_x1 = text_x
-        rect_y1 = text_y - text_height - baseline
-        rect_x2 = text_x + text_width
-        rect_y2 = text_y + baseline
-
-        # 半透明の背景描画のため、対象領域のオーバーレイを作成しブレンディング
-        overlay = image.copy()
-        cv2.rectangle(overlay, (rect_x1, rect_y1),
-                      (rect_x2, rect_y2), bg_color, -1)
-        image = cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0)
-
-        # テキストの描画
-        cv2.putText(image, label_text, (text_x, text_y), font,
-                    font_scale, text_color, text_thickness, cv2.LINE_AA)
+    # ボックス・ラベル背景・文字をまとめて描画する（背景の半透明処理は全ボックス分を一度に行う）
+    image = render_detections(image, boxes, res.names)
 
     output_path = "predict/output_custom_y_600.png"
-    cv2.imwrite(output_path, image)
+    with TRACER.stage("serialize"):
+        cv2.imwrite(output_path, image)
     print(f"注釈付き画像を {output_path} に保存しました。")
     print(f"boxes: {boxes.shape}")
 
@@ -176,6 +149,12 @@ def main():
         "y2o3": "y",
         # "y2o3_peppermintGreen": "ypg"
     }
+    # True の場合、画像を縮小せずに 512px のタイルに分割して推論する（高解像度の平面像向け）
+    use_tiles = False
+    # True の場合、倍率 1.0 / 1.5 と左右反転の 4 枚を 1 バッチで推論して統合する（小さな析出物の見逃しを減らす）
+    # adaptive_tta が True なら、通常の推論で小さい・信頼度の低い検出が多かった場合だけ拡張画像を推論する
+    use_tta = False
+    adaptive_tta = True
 
     try:
         model = load_model(model_path)
@@ -183,7 +162,13 @@ def main():
         target_indices = get_target_class_indices(model, target_classes)
 
         # 推論実行
-        results = perform_inference(model, image_path, target_indices)
+        if use_tiles:
+            results = perform_tiled_inference(model, image_path, target_indices, tile=512, overlap=64)
+        elif use_tta:
+            results = perform_tta_inference(model, image_path, target_indices, imgsz=512, scales=(1.0, 1.5),
+                                            flip=True, adaptive=adaptive_tta)
+        else:
+            results = perform_inference(model, image_path, target_indices)
         # 結果オブジェクト内の names を custom_mapping に従って更新し、描画する
         process_results(results, image_path, custom_mapping)
     except Exception as e:
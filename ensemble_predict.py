@@ -0,0 +1,236 @@
+# leave-one-out の全 fold のモデルで同じ画像を推論し、検出結果を Weighted Box Fusion（WBF）で統合する
+#
+# ・画像のデコードと前処理（レターボックス・正規化）はバッチごとに一度だけ行い、同じテンソルを全モデルに渡す
+# ・重みは fold ごとに FP32 へ変換（Conv と BN を融合）したものを weights フォルダにキャッシュし、
+#   torch.load(mmap=True) で読み込む。重みはファイルに対応したページとして扱われ、
+#   匿名メモリに N 個の複製を持たない（複数プロセスで同じモデルを読んでもページキャッシュを共有する）
+#
+# 実行（リポジトリのルートから）:
+#   python ensemble_predict.py --runs runs/BoundingBox --images YOLO_dataset_zip/.../images --store predict/ensemble_store
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from batch_predict import IMAGE_SUFFIXES
+from image_cache import IMAGE_CACHE
+from profiling import TRACER
+from tiled_predict import nms_xyxy
+from verification.vertools.prediction_store import PredictionWriter
+from verification.vertools.spatial_index import GridIndex, pair_iou
+
+MMAP_SUFFIX = ".fp32.pt"
+
+
+def fold_checkpoints(runs_dir: Path) -> list[Path]:
+    """
+    runs_dir/no_*/weights/best.pt を fold 名順に列挙する
+    """
+    return sorted(Path(runs_dir).glob("no_*/weights/best.pt"))
+
+
+def mmap_weights_path(checkpoint: Path) -> Path:
+    """
+    best.pt を FP32 に変換し Conv と BN を融合したモデルを best.fp32.pt に保存する（best.pt が新しい場合のみ作り直す）
+    ultralytics の best.pt は FP16 で保存されており、読み込み時の FP32 への変換で複製ができるため、
+    変換済みのものをメモリマップで読む
+    """
+    checkpoint = Path(checkpoint)
+    cache = checkpoint.with_name(checkpoint.stem + MMAP_SUFFIX)
+    if cache.exists() and cache.stat().st_mtime_ns >= checkpoint.stat().st_mtime_ns:
+        return cache
+    ckpt = torch.load(checkpoint, map_location="cpu", weights_only=False)
+    model = (ckpt.get("ema") or ckpt["model"]).float().fuse().eval()
+    tmp_path = cache.with_name(cache.name + ".tmp")
+    torch.save(model, tmp_path)
+    tmp_path.replace(cache)
+    return cache
+
+
+def load_mmap_model(checkpoint: Path) -> torch.nn.Module:
+    """
+    変換済みのモデルをメモリマップで読み込む
+    """
+    with TRACER.stage("load_model", backend="mmap"):
+        model = torch.load(mmap_weights_path(checkpoint), map_location="cpu", mmap=True, weights_only=False)
+        model.eval()
+        for p in model.parameters():
+            p.requires_grad_(False)
+    return model
+
+
+def preprocess(images: list[np.ndarray], imgsz: int = 512) -> torch.Tensor:
+    """
+    BGR 画像を ultralytics の推論時と同じようにレターボックスで imgsz × imgsz にし、(B, 3, H, W) の 0〜1 のテンソルにする
+    """
+    from ultralytics.data.augment import LetterBox
+
+    letterbox = LetterBox((imgsz, imgsz), auto=False)
+    batch = np.stack([letterbox(image=image) for image in images])
+    batch = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2))
+    return torch.from_numpy(batch).float().div_(255)
+
+
+def weighted_box_fusion(boxes: np.ndarray, scores: np.ndarray, labels: np.ndarray, n_models: int,
+                        iou_threshold: float = 0.55, model_weights: np.ndarray = None,
+                        model_ids: np.ndarray = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    複数モデルの検出を Weighted Box Fusion で統合する
+    信頼度の高い順に NMS と同じ規則でクラスタの代表を選び、各ボックスを IoU が閾値を超える代表のうち
+    最も信頼度の高いものに割り当て、クラスタごとに信頼度で重み付けした平均ボックスを求める
+    （代表との IoU で割り当てるため、逐次的に融合ボックスと比較する元の WBF とは僅かに異なる）
+
+    :param boxes: 全モデルの検出 (K, 4)
+    :param scores: 信頼度 (K,)
+    :param labels: クラスインデックス (K,)
+    :param n_models: モデル数（少数のモデルしか検出しなかったクラスタは信頼度を下げる）
+    :param iou_threshold: 同じ物体とみなす IoU
+    :param model_weights: モデルごとの重み (M,)
+    :param model_ids: 各検出を出したモデルの番号 (K,)（model_weights を使う場合に必要）
+    :return: (統合したボックス (C, 4), 信頼度 (C,), クラス (C,))（信頼度の降順）
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+    if len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+    weights = scores if model_weights is None else scores * np.asarray(model_weights, dtype=np.float64)[model_ids]
+
+    # クラスタの代表（信頼度の降順）
+    leaders = nms_xyxy(boxes, scores, iou_threshold, classes=labels)
+
+    # 各ボックスと重なる代表だけを空間インデックスで調べ、同じクラスで IoU が閾値を超える代表のうち最上位のものを選ぶ
+    pi, lj = GridIndex(boxes[leaders]).candidate_pairs(boxes)
+    ious = pair_iou(boxes[pi], boxes[leaders][lj])
+    ok = (ious > iou_threshold) & (labels[pi] == labels[leaders][lj])
+    pi, lj = pi[ok], lj[ok]
+    cluster = np.full(len(boxes), len(leaders), dtype=np.int64)
+    np.minimum.at(cluster, pi, lj)
+    # 代表同士は NMS により IoU が閾値以下なので、代表は必ず自身のクラスタに入る
+    cluster[leaders] = np.arange(len(leaders))
+    assigned = cluster < len(leaders)
+    cluster, w = cluster[assigned], weights[assigned]
+
+    n = len(leaders)
+    total = np.bincount(cluster, weights=w, minlength=n)
+    fused = np.stack([np.bincount(cluster, weights=w * boxes[assigned, k], minlength=n) for k in range(4)], axis=1)
+    fused /= total[:, None]
+    count = np.bincount(cluster, minlength=n)
+    fused_scores = np.bincount(cluster, weights=scores[assigned], minlength=n) / count
+    fused_scores *= np.minimum(count, n_models) / n_models
+    order = np.argsort(-fused_scores, kind="stable")
+    return fused[order], fused_scores[order], labels[leaders][order]
+
+
+class FoldEnsemble:
+    """
+    全 fold のモデルで推論し、WBF で統合する
+
+    使い方:
+        ensemble = FoldEnsemble(fold_checkpoints(Path("runs/BoundingBox")))
+        for path, detections in ensemble.predict_stream(image_paths):
+            ...  # detections: (K, 6) の [x1, y1, x2, y2, conf, cls]
+    """
+
+    def __init__(self, checkpoints: list[Path], imgsz: int = 512, conf: float = 0.25, iou: float = 0.5,
+                 classes: list[int] = None, max_det: int = 1000, wbf_iou: float = 0.55, model_weights=None):
+        """
+        :param checkpoints: 各 fold の best.pt
+        :param imgsz: 推論時の画像サイズ
+        :param conf: 各モデルの検出に使う信頼度の閾値
+        :param iou: 各モデルの NMS の IoU 閾値
+        :param classes: 検出するクラスインデックス（省略時は全クラス）
+        :param wbf_iou: モデル間で同じ物体とみなす IoU
+        :param model_weights: モデルごとの重み（省略時は均等）
+        """
+        self.checkpoints = [Path(c) for c in checkpoints]
+        if not self.checkpoints:
+            raise ValueError("統合するモデルがありません。")
+        self.models = [load_mmap_model(c) for c in self.checkpoints]
+        self.names = self.models[0].names
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.classes = classes
+        self.max_det = max_det
+        self.wbf_iou = wbf_iou
+        self.model_weights = None if model_weights is None else np.asarray(model_weights, dtype=np.float64)
+
+    @torch.inference_mode()
+    def _detect(self, model, batch: torch.Tensor, shapes: list[tuple[int, int]]) -> list[np.ndarray]:
+        from ultralytics.utils import ops
+
+        with TRACER.stage("inference", images=len(batch)):
+            preds = model(batch)
+        # セグメンテーションモデルは (検出, マスクの係数) を返す
+        preds = preds[0] if isinstance(preds, (list, tuple)) else preds
+        with TRACER.stage("nms", images=len(batch)):
+            dets = ops.non_max_suppression(preds, self.conf, self.iou, classes=self.classes, max_det=self.max_det,
+                                           nc=len(model.names))
+        out = []
+        for det, shape in zip(dets, shapes):
+            det = det[:, :6].clone()
+            det[:, :4] = ops.scale_boxes(batch.shape[2:], det[:, :4], shape)
+            out.append(det.cpu().numpy())
+        return out
+
+    def predict_batch(self, images: list[np.ndarray]) -> list[np.ndarray]:
+        """
+        画像のバッチを全モデルで推論し、画像ごとに統合した検出 (K, 6) を返す
+        """
+        shapes = [image.shape[:2] for image in images]
+        with TRACER.stage("preprocess", images=len(images)):
+            batch = preprocess(images, self.imgsz)
+
+        per_model = [self._detect(model, batch, shapes) for model in self.models]
+        fused = []
+        with TRACER.stage("wbf", images=len(images)):
+            for i in range(len(images)):
+                dets = [per_model[m][i] for m in range(len(self.models))]
+                data = np.concatenate(dets)
+                model_ids = np.repeat(np.arange(len(dets)), [len(d) for d in dets])
+                boxes, scores, labels = weighted_box_fusion(data[:, :4], data[:, 4], data[:, 5], len(self.models),
+                                                            self.wbf_iou, self.model_weights, model_ids)
+                fused.append(np.column_stack([boxes, scores, labels]).astype(np.float32))
+        return fused
+
+    def predict_stream(self, image_paths, batch_size: int = 8):
+        """
+        画像を先読みしながら batch_size 枚ずつ推論し、(画像パス, 統合した検出 (K, 6)) を順に返すジェネレータ
+        """
+        image_paths = list(image_paths)
+        chunk, images = [], []
+        for n, (path, image) in enumerate(IMAGE_CACHE.prefetch(image_paths, depth=batch_size), start=1):
+            chunk.append(path)
+            images.append(image)
+            if len(chunk) == batch_size or n == len(image_paths):
+                yield from zip(chunk, self.predict_batch(images))
+                chunk, images = [], []
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="全 fold のモデルで推論し、WBF で統合した結果をストアに保存する")
+    parser.add_argument("--runs", type=Path, default=Path("runs/BoundingBox"), help="no_<画像名> のフォルダが並ぶディレクトリ")
+    parser.add_argument("--images", type=Path, required=True, help="画像ディレクトリ")
+    parser.add_argument("--store", type=Path, default=Path("predict/ensemble_store"), help="結果の出力先")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--wbf-iou", type=float, default=0.55)
+    parser.add_argument("--imgsz", type=int, default=512)
+    parser.add_argument("--batch", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    checkpoints = fold_checkpoints(args.runs)
+    print(f"統合するモデル数: {len(checkpoints)}")
+    ensemble = FoldEnsemble(checkpoints, imgsz=args.imgsz, conf=args.conf, iou=args.iou, wbf_iou=args.wbf_iou)
+    image_paths = sorted(p for p in args.images.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    with PredictionWriter(args.store) as writer:
+        for path, det in ensemble.predict_stream(image_paths, args.batch):
+            writer.add(path.stem, det[:, :4], det[:, 4], det[:, 5], names=ensemble.names)
+            print(f"{path.name}: {len(det)} 個")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+# 推論用のエクスポート済みモデル（ONNX / INT8 量子化 ONNX）の作成・選択
+#
+# best.pt を一度だけ ONNX に変換し、同じ weights フォルダにキャッシュする
+#   best.onnx        : FP32 の ONNX
+#   best_int8.onnx   : 重みを INT8 に動的量子化した ONNX
+#   best.export.json : 変換元の更新時刻・サイズ、タスク、精度チェックの結果
+#
+# 推論スクリプトは load_yolo(best.pt) を通して読み込むと、有効なキャッシュがあれば自動的にそちらを使う
+#
+# 変換と精度チェック（リポジトリのルートから）:
+#   python export_backend.py --runs runs/BoundingBox --images YOLO_dataset_zip/.../images
+
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+from ultralytics import YOLO
+
+from profiling import TRACER
+
+# 自動選択するときの優先順（先頭ほど速い）
+BACKENDS = ("onnx_int8", "onnx", "torch")
+SUFFIXES = {"onnx": ".onnx", "onnx_int8": "_int8.onnx"}
+EXPORT_META_SUFFIX = ".export.json"
+
+# 自動選択する条件（PyTorch の出力を正解とみなしたときの F1）
+MIN_F1 = {"onnx": 0.99, "onnx_int8": 0.98}
+# 自動選択に必要な、精度チェックに使った画像の枚数
+MIN_CHECK_IMAGES = 4
+
+
+def artifact_path(checkpoint, backend: str) -> Path:
+    """
+    best.pt に対応するエクスポート済みファイルのパス
+    """
+    checkpoint = Path(checkpoint)
+    return checkpoint.with_name(checkpoint.stem + SUFFIXES[backend])
+
+
+def _meta_path(checkpoint: Path) -> Path:
+    return checkpoint.with_name(checkpoint.stem + EXPORT_META_SUFFIX)
+
+
+def _stamp(checkpoint: Path) -> list[int]:
+    stat = checkpoint.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def read_export_meta(checkpoint) -> dict:
+    """
+    エクスポートの記録を読み込む。best.pt が変換後に更新されていた場合は空の dict を返す
+    """
+    checkpoint = Path(checkpoint)
+    meta_path = _meta_path(checkpoint)
+    if not meta_path.exists():
+        return {}
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    if meta.get("stamp") != _stamp(checkpoint):
+        return {}
+    return meta
+
+
+def _write_export_meta(checkpoint: Path, meta: dict) -> None:
+    meta_path = _meta_path(checkpoint)
+    tmp_path = meta_path.with_name(meta_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp_path.replace(meta_path)
+
+
+def _quantize_int8(onnx_path: Path, int8_path: Path) -> None:
+    """
+    重みを INT8 に動的量子化する（活性化は実行時に量子化されるため、校正用の画像は不要）
+    ultralytics が読むクラス名などのメタデータも引き継ぐ
+    """
+    import onnx
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(str(onnx_path), str(int8_path), weight_type=QuantType.QUInt8)
+    source = onnx.load(str(onnx_path), load_external_data=False)
+    quantized = onnx.load(str(int8_path))
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, str(int8_path))
+
+
+def export_checkpoint(checkpoint, imgsz: int = 512, int8: bool = True, force: bool = False) -> dict:
+    """
+    best.pt を ONNX（と INT8 量子化版）に変換し、weights フォルダにキャッシュする
+    変換済みで best.pt が更新されていなければ何もしない
+
+    :param checkpoint: best.pt のパス
+    :param imgsz: 推論時の画像サイズ（バッチ数と画像サイズは可変で書き出す）
+    :param int8: INT8 量子化版も作るかどうか
+    :param force: キャッシュがあっても変換し直す
+    :return: エクスポートの記録
+    """
+    checkpoint = Path(checkpoint)
+    meta = {} if force else read_export_meta(checkpoint)
+    wanted = ["onnx"] + (["onnx_int8"] if int8 else [])
+    if all(b in meta.get("backends", {}) and artifact_path(checkpoint, b).exists() for b in wanted):
+        return meta
+
+    start = time.perf_counter()
+    model = YOLO(checkpoint)
+    exported = Path(model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True))
+    if exported != artifact_path(checkpoint, "onnx"):
+        exported.replace(artifact_path(checkpoint, "onnx"))
+    backends = {"onnx": {}}
+    if int8:
+        _quantize_int8(artifact_path(checkpoint, "onnx"), artifact_path(checkpoint, "onnx_int8"))
+        backends["onnx_int8"] = {}
+
+    meta = {"stamp": _stamp(checkpoint), "task": model.task, "imgsz": imgsz, "backends": backends}
+    _write_export_meta(checkpoint, meta)
+    print(f"エクスポートしました: {checkpoint} ({time.perf_counter() - start:.1f}秒)")
+    return meta
+
+
+def resolve_backend(checkpoint, backend: str = "auto") -> tuple[Path, str]:
+    """
+    読み込むファイルを決める
+
+    :param checkpoint: best.pt のパス
+    :param backend: "auto" / "torch" / "onnx" / "onnx_int8"
+        "auto" の場合、有効なキャッシュのうち BACKENDS の順で最初のものを使う
+        （MIN_CHECK_IMAGES 枚以上での精度チェックが記録されていて、F1 が MIN_F1 以上だった場合のみ）
+    :return: (読み込むファイルのパス, バックエンド名)
+    """
+    checkpoint = Path(checkpoint)
+    if backend == "torch" or checkpoint.suffix != ".pt":
+        return checkpoint, "torch"
+
+    meta = read_export_meta(checkpoint)
+    available = [b for b in meta.get("backends", {}) if artifact_path(checkpoint, b).exists()]
+    if backend != "auto":
+        if backend not in available:
+            raise FileNotFoundError(f"エクスポート済みのモデルがありません ({backend}): {checkpoint}")
+        return artifact_path(checkpoint, backend), backend
+
+    for name in BACKENDS:
+        if name not in available:
+            continue
+        check = meta["backends"][name].get("check")
+        if check is None or check.get("images", 0) < MIN_CHECK_IMAGES or check["f1"] < MIN_F1[name]:
+            continue
+        return artifact_path(checkpoint, name), name
+    return checkpoint, "torch"
+
+
+def load_yolo(checkpoint, backend: str = "auto"):
+    """
+    resolve_backend で選んだファイルから YOLO モデルを読み込む
+    ONNX はタスクを推定できない場合があるため、エクスポート時に記録したタスクを渡す
+    """
+    path, name = resolve_backend(checkpoint, backend)
+    with TRACER.stage("load_model", backend=name):
+        if name == "torch":
+            return YOLO(path)
+        print(f"エクスポート済みのモデルを使用します ({name}): {path}")
+        return YOLO(path, task=read_export_meta(checkpoint).get("task"))
+
+
+def _predict_timed(model, image_paths: list[Path], **predict_kwargs) -> tuple[list, float]:
+    # 初回はセッションの初期化を含むため、計測から除く
+    model.predict(str(image_paths[0]), verbose=False, **predict_kwargs)
+    start = time.perf_counter()
+    results = [model.predict(str(p), verbose=False, **predict_kwargs)[0] for p in image_paths]
+    return results, (time.perf_counter() - start) / len(image_paths)
+
+
+def check_export(checkpoint, image_paths: list[Path], iou_threshold: float = 0.5, **predict_kwargs) -> dict:
+    """
+    エクスポート済みのモデルの出力を PyTorch の出力と比較し、速度と精度を記録する
+    PyTorch の検出を正解とみなして P/R/F1 を求め、マッチした組の信頼度の差も調べる
+
+    :param checkpoint: best.pt のパス（export_checkpoint 済み）
+    :param image_paths: 比較に使う画像（"auto" で選ばれるには MIN_CHECK_IMAGES 枚以上必要）
+    :param iou_threshold: 同じ検出とみなす IoU
+    :param predict_kwargs: model.predict に渡す引数（conf, iou, imgsz, device など）
+    :return: {バックエンド名: {'images', 'ms_per_image', 'speedup', 'precision', 'recall', 'f1', 'conf_abs_diff'}}
+    """
+    from verification.vertools.confusion_matrix_detect import match_detections
+
+    checkpoint = Path(checkpoint)
+    meta = read_export_meta(checkpoint)
+    if not meta:
+        raise FileNotFoundError(f"エクスポートされていないか、best.pt が更新されています: {checkpoint}")
+
+    reference, ref_time = _predict_timed(YOLO(checkpoint), image_paths, **predict_kwargs)
+    report = {"torch": {"ms_per_image": ref_time * 1000}}
+    for name in meta["backends"]:
+        results, elapsed = _predict_timed(load_yolo(checkpoint, name), image_paths, **predict_kwargs)
+        tp = fp = fn = 0
+        conf_diff = []
+        for ref, res in zip(reference, results):
+            ref_boxes, ref_conf = ref.boxes.xyxy.cpu().numpy(), ref.boxes.conf.cpu().numpy()
+            boxes, conf = res.boxes.xyxy.cpu().numpy(), res.boxes.conf.cpu().numpy()
+            m = match_detections(boxes, ref_boxes, (iou_threshold,))
+            tp, fp, fn = tp + int(m['tp'][0]), fp + int(m['fp'][0]), fn + int(m['fn'][0])
+            matched = m['pred_match'][0] >= 0
+            conf_diff.append(np.abs(conf[matched] - ref_conf[m['pred_match'][0][matched]]))
+        precision = tp / (tp + fp) if tp + fp > 0 else 1.0
+        recall = tp / (tp + fn) if tp + fn > 0 else 1.0
+        diffs = np.concatenate(conf_diff) if conf_diff else np.zeros(0)
+        report[name] = {
+            "images": len(image_paths),
+            "ms_per_image": elapsed * 1000,
+            "speedup": ref_time / elapsed if elapsed > 0 else None,
+            "precision": precision,
+            "recall": recall,
+            "f1": 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+            "conf_abs_diff": float(diffs.mean()) if len(diffs) else 0.0,
+        }
+        meta["backends"][name]["check"] = report[name]
+
+    _write_export_meta(checkpoint, meta)
+    return report
+
+
+def print_report(checkpoint, report: dict) -> None:
+    print(f"{checkpoint}")
+    for name, r in report.items():
+        if name == "torch":
+            print(f"  {name:10s} {r['ms_per_image']:8.1f} ms/枚")
+        else:
+            print(f"  {name:10s} {r['ms_per_image']:8.1f} ms/枚  x{r['speedup']:.2f}  "
+                  f"P={r['precision']:.4f} R={r['recall']:.4f} F1={r['f1']:.4f}  Δconf={r['conf_abs_diff']:.4f}"
+                  f"  ({r['images']} 枚)")
+
+
+def main(argv=None) -> None:
+    import argparse
+
+    from batch_predict import IMAGE_SUFFIXES, fold_jobs
+
+    parser = argparse.ArgumentParser(description="leave-one-out の各モデルを ONNX に変換し、PyTorch と比較する")
+    parser.add_argument("--runs", type=Path, default=Path("runs/BoundingBox"), help="no_<画像名> のフォルダが並ぶディレクトリ")
+    parser.add_argument("--images", type=Path, default=Path("YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/images"))
+    parser.add_argument("--imgsz", type=int, default=512)
+    parser.add_argument("--conf", type=float, default=0.7)
+    parser.add_argument("--iou", type=float, default=0.2)
+    parser.add_argument("--no-int8", action="store_true", help="INT8 量子化版を作らない")
+    parser.add_argument("--force", action="store_true", help="変換済みでも変換し直す")
+    parser.add_argument("--skip-check", action="store_true", help="精度チェックを行わない")
+    parser.add_argument("--check-images", type=int, default=8,
+                        help=f"精度チェックに使う画像の枚数（自動選択には {MIN_CHECK_IMAGES} 枚以上必要）")
+    args = parser.parse_args(argv)
+
+    all_images = sorted(p for p in args.images.iterdir() if p.suffix.lower() in IMAGE_SUFFIXES)
+    for checkpoint, image_paths in fold_jobs(args.images, args.runs).items():
+        export_checkpoint(checkpoint, imgsz=args.imgsz, int8=not args.no_int8, force=args.force)
+        if not args.skip_check:
+            # fold の画像だけでは枚数が足りないため、他の画像も加えて比較する
+            # （PyTorch の出力との一致を調べるだけなので、学習に使った画像でもよい）
+            others = [p for p in all_images if p not in image_paths]
+            check_paths = image_paths + others[:max(0, args.check_images - len(image_paths))]
+            if len(check_paths) < MIN_CHECK_IMAGES:
+                print(f"精度チェックの画像が {len(check_paths)} 枚しかないため、変換済みのモデルは自動選択されません")
+            report = check_export(checkpoint, check_paths, conf=args.conf, iou=args.iou, imgsz=args.imgsz,
+                                  device="cpu")
+            print_report(checkpoint, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,10 @@
-from ultralytics import YOLO
 from multiprocessing import freeze_support
 from pathlib import Path
 import time
 import sys
 
+from train_scheduler import run_folds
+
 def precheck_paths(fine_path: Path, runs_path: Path):
     # ディレクトリの存在チェック
     if not fine_path.exists() or not fine_path.is_dir():
@@ -28,28 +29,20 @@ if __name__ == '__main__':
     # 時間計測開始
     start = time.perf_counter()
     
-    # "data_for_training" 内の各サブディレクトリに対して学習を実行
-    for spcdr in fine.iterdir():
-        if spcdr.is_dir():
-            print(f"開始: {spcdr.stem} のトレーニング")
-            
-            # 1. モデルの読み込み（事前学習済み重みの利用）
-            model = YOLO("yolo11x.pt")
-            
-            # 2. トレーニングの実行
-            results = model.train(
-                data=spcdr / "custom_dataset.yaml",  # カスタムデータセットのファイルパス
-                epochs=1000,                          # エポック数
-                imgsz=512,                            # 入力画像サイズ
-                batch=16,                             # バッチサイズ（タスクに応じて変更）
-                lr0=0.005,                            # 初期学習率
-                device="cuda",
-                project=runs / "BoundingBox",         # モデルの保存先ディレクトリ
-                name=spcdr.stem                       # 各サブディレクトリ名を保存フォルダ名として利用
-            )
-            
-            print(f"{spcdr.stem} トレーニング終了")
-    
+    # "data_for_training" 内の各サブディレクトリ（fold）を、空いている GPU / CPU コアのグループに割り当てて並列に学習する
+    # 進行状況は runs/BoundingBox/fold_queue.json に保存され、中断しても再実行すれば続きから再開する
+    folds = {spcdr.stem: spcdr / "custom_dataset.yaml" for spcdr in sorted(fine.iterdir()) if spcdr.is_dir()}
+    run_folds(
+        folds,
+        project=runs / "BoundingBox",  # モデルの保存先ディレクトリ（fold 名のフォルダに保存）
+        base_model="yolo11x.pt",       # 事前学習済み重み
+        slots=None,                    # 省略時は GPU ごとに 1 枠（GPU が無ければ CPU 8 コアごとに 1 枠）
+        epochs=1000,                   # エポック数
+        imgsz=512,                     # 入力画像サイズ
+        batch=16,                      # バッチサイズ（タスクに応じて変更）
+        lr0=0.005,                     # 初期学習率
+    )
+
     # 時間計測終了
     end = time.perf_counter()
     elapsed_time = end - start
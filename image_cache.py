@@ -0,0 +1,154 @@
+import hashlib
+import queue
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from profiling import TRACER
+
+
+class ImageCache:
+    """
+    デコード済み画像の LRU キャッシュ
+    同じ顕微鏡画像を fold の評価・閾値の掃引・描画で何度も読み込む場合に、BMP のデコードを一度だけにする
+
+    キーは (パス, 更新時刻, ファイルサイズ, imgsz) なので、画像が更新されると読み直す
+    返す配列は共有されるため書き込み禁止にしてある（描画などで書き換える場合は copy() する）
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30, imgsz: int = None, disk_dir: Path = None):
+        """
+        :param max_bytes: メモリに保持する画像の合計バイト数の上限
+        :param imgsz: 指定した場合、長辺がこの値を超える画像は縮小して保持する
+            （縮小した画像に対する推論結果の座標は縮小後の画素単位になる）
+        :param disk_dir: 指定した場合、デコード済みの配列を .npy として保存し、
+            次回以降（別プロセスを含む）はメモリマップで読み込む
+        """
+        self.max_bytes = max_bytes
+        self.imgsz = imgsz
+        self.disk_dir = Path(disk_dir) if disk_dir is not None else None
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, path: Path) -> tuple:
+        stat = path.stat()
+        return str(path.resolve()), stat.st_mtime_ns, stat.st_size, self.imgsz
+
+    def _decode(self, path: Path) -> np.ndarray:
+        with TRACER.stage("decode"):
+            image = cv2.imread(str(path))
+        if image is None:
+            raise ValueError(f"画像の読み込みに失敗しました: {path}")
+        if self.imgsz is not None and max(image.shape[:2]) > self.imgsz:
+            scale = self.imgsz / max(image.shape[:2])
+            size = (round(image.shape[1] * scale), round(image.shape[0] * scale))
+            with TRACER.stage("resize"):
+                image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return image
+
+    def _load(self, path: Path, key: tuple) -> np.ndarray:
+        if self.disk_dir is None:
+            return self._decode(path)
+        digest = hashlib.sha1("|".join(map(str, key)).encode()).hexdigest()[:16]
+        npy_path = self.disk_dir / f"{path.stem}_{digest}.npy"
+        if npy_path.exists():
+            try:
+                return np.load(npy_path, mmap_mode="r")
+            except (OSError, ValueError):
+                # 書き込み途中などで壊れたファイルは作り直す
+                pass
+        image = self._decode(path)
+        self.disk_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = npy_path.with_name(npy_path.name + f".{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, image)
+        tmp_path.replace(npy_path)
+        return image
+
+    def get(self, path) -> np.ndarray:
+        """
+        画像を BGR の配列として返す（キャッシュに無ければ読み込んで追加する）
+        """
+        path = Path(path)
+        key = self._key(path)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return self._images[key]
+            self.misses += 1
+
+        # デコードはロックの外で行い、別の画像の読み込みを妨げない
+        image = self._load(path, key)
+        image.setflags(write=False)
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = image
+                self._bytes += image.nbytes
+                while self._bytes > self.max_bytes and len(self._images) > 1:
+                    _, old = self._images.popitem(last=False)
+                    self._bytes -= old.nbytes
+        return image
+
+    def clear(self) -> None:
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def prefetch(self, paths, depth: int = 4):
+        """
+        別スレッドで先の画像を読み込みながら、(パス, 画像) を順に返すジェネレータ
+        モデルが推論している間に次の画像のデコードを進める
+
+        :param paths: 画像のパスの反復可能オブジェクト
+        :param depth: 先読みしておく画像の最大枚数
+        """
+        buffer = queue.Queue(maxsize=depth)
+        done = object()
+        stop = threading.Event()
+
+        def worker():
+            try:
+                for path in paths:
+                    if stop.is_set():
+                        return
+                    buffer.put((path, self.get(path)))
+            except Exception as e:
+                buffer.put(e)
+            buffer.put(done)
+
+        thread = threading.Thread(target=worker, name="image-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 途中で打ち切られた場合は、読み込みスレッドを止めてから戻る
+            stop.set()
+            while thread.is_alive():
+                try:
+                    buffer.get_nowait()
+                except queue.Empty:
+                    thread.join(0.01)
+
+
+# プロセス内で共有する既定のキャッシュ（元の解像度のまま保持する）
+IMAGE_CACHE = ImageCache()
+
+
+def imread_cached(path) -> np.ndarray:
+    """
+    cv2.imread の代わりに使う。既定のキャッシュから書き込み禁止の配列を返す
+    """
+    return IMAGE_CACHE.get(path)
@@ -1,73 +1,143 @@
 # 交差検証のため、独立した検証用画像構成を作る
+# 画像とラベルは fold ごとにコピーせず、ハードリンク / シンボリックリンク、
+# またはファイルリスト（train.txt / val.txt）で参照する
 
 
+import os
+import shutil
 from pathlib import Path
 import yaml
 
-        
-def make_independent_val_img_structure(output_dir_path: Path, imgs: Path, txts: Path, classes_txt: Path, notes_json: Path) -> None:
-    file_names = []
-    classes_txt_file = classes_txt.read_bytes()
-    notes_json_file = notes_json.read_bytes()
-
-    for item in imgs.iterdir():
-        file_names.append(item.stem)
-        
-    for name in file_names:
-        # create directory structure and write files
-        folder_train_img = output_dir_path / f"no_{name}" / "train" / "images"
-        folder_train_img.mkdir(parents=True, exist_ok=True)
-        
-        folder_train_lab = output_dir_path / f"no_{name}" / "train" / "labels"
-        folder_train_lab.mkdir(parents=True, exist_ok=True)
-        
-        folder_val_img = output_dir_path / f"no_{name}" / "val" / "images"
-        folder_val_img.mkdir(parents=True, exist_ok=True)
-        
-        folder_val_lab = output_dir_path / f"no_{name}" / "val" / "labels"
-        folder_val_lab.mkdir(parents=True, exist_ok=True)
-        
-        (folder_train_img.parent / classes_txt.name).write_bytes(classes_txt_file)
-        (folder_train_img.parent / notes_json.name).write_bytes(notes_json_file)
-        (folder_val_img.parent / classes_txt.name).write_bytes(classes_txt_file)
-        (folder_val_img.parent / notes_json.name).write_bytes(notes_json_file)
-
-        # copy images and labels to train and val folders
-        for item in imgs.iterdir():
-            if item.stem != name:
-                data = item.read_bytes()
-                (folder_train_img / item.name).write_bytes(data)
-            else:
-                data = item.read_bytes()
-                (folder_val_img / item.name).write_bytes(data)
-                
-        for item in txts.iterdir():
-            if item.stem != name:
-                data = item.read_bytes()
-                (folder_train_lab / item.name).write_bytes(data)
-            else:
-                data = item.read_bytes()
-                (folder_val_lab / item.name).write_bytes(data)
-                
+# mode の選択肢
+# hardlink: ハードリンクで配置（別ドライブなどでリンクできない場合はコピー）
+# symlink : シンボリックリンクで配置
+# copy    : 従来どおりコピー
+# list    : 画像を配置せず、画像パスを列挙した train.txt / val.txt を custom_dataset.yaml から参照する
+MODES = ("hardlink", "symlink", "copy", "list")
+
+
+def _is_up_to_date(src: Path, dst: Path, mode: str) -> bool:
+    """
+    配置先のファイルが、既に src と同じ内容を指しているかを判定する
+    """
+    if not dst.exists() and not dst.is_symlink():
+        return False
+    if mode == "symlink":
+        return dst.is_symlink() and Path(os.readlink(dst)) == src.resolve()
+    if dst.is_symlink():
+        return False
+    if mode == "hardlink" and os.path.samefile(src, dst):
+        return True
+    # コピーの場合（またはハードリンクできずコピーした場合）はサイズと更新時刻で判定する
+    src_stat, dst_stat = src.stat(), dst.stat()
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+def place_file(src: Path, dst: Path, mode: str) -> bool:
+    """
+    src を dst に配置する。既に最新なら何もしない
+
+    :return: ディスクに書き込みを行った場合 True
+    """
+    if _is_up_to_date(src, dst, mode):
+        return False
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    if mode == "symlink":
+        dst.symlink_to(src.resolve())
+        return True
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            # 別ドライブなどでハードリンクが作れない場合はコピーする
+            pass
+    shutil.copy2(src, dst)
+    return True
+
+
+def sync_dir(dst_dir: Path, sources: list[Path], mode: str) -> int:
+    """
+    dst_dir の中身を sources と一致させる（不要なファイルは削除する）
+
+    :return: 書き込み・削除したファイル数
+    """
+    dst_dir.mkdir(parents=True, exist_ok=True)
+    wanted = {src.name: src for src in sources}
+    changed = 0
+    for existing in dst_dir.iterdir():
+        if existing.name not in wanted:
+            existing.unlink()
+            changed += 1
+    for name, src in wanted.items():
+        changed += place_file(src, dst_dir / name, mode)
+    return changed
+
+
+def write_if_changed(path: Path, text: str) -> bool:
+    """
+    内容が変わった場合のみファイルを書き込む
+    """
+    if path.exists() and path.read_text(encoding="utf-8") == text:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text, encoding="utf-8")
+    return True
+
+
+def make_independent_val_img_structure(output_dir_path: Path, imgs: Path, txts: Path, classes_txt: Path,
+                                       notes_json: Path, mode: str = "hardlink") -> None:
+    if mode not in MODES:
+        raise ValueError(f"mode は {MODES} のいずれかを指定してください: {mode}")
+
+    images = sorted(item for item in imgs.iterdir() if item.is_file())
+    labels = sorted(item for item in txts.iterdir() if item.is_file())
+    changed = 0
+
+    for name in [item.stem for item in images]:
+        fold_dir = output_dir_path / f"no_{name}"
+        train_imgs = [item for item in images if item.stem != name]
+        val_imgs = [item for item in images if item.stem == name]
+
+        if mode == "list":
+            # 画像は元の場所のまま、パスの一覧だけを書き出す
+            # （ラベルは ultralytics が images → labels の置き換えで元のディレクトリから探す）
+            changed += write_if_changed(fold_dir / "train.txt", "".join(f"{p.resolve()}\n" for p in train_imgs))
+            changed += write_if_changed(fold_dir / "val.txt", "".join(f"{p.resolve()}\n" for p in val_imgs))
+            train = (fold_dir / "train.txt").resolve()
+            val = (fold_dir / "val.txt").resolve()
+        else:
+            # create directory structure and link files
+            for split, split_imgs in (("train", train_imgs), ("val", val_imgs)):
+                split_dir = fold_dir / split
+                split_stems = {item.stem for item in split_imgs}
+                changed += sync_dir(split_dir / "images", split_imgs, mode)
+                changed += sync_dir(split_dir / "labels", [item for item in labels if item.stem in split_stems], mode)
+                split_dir.mkdir(parents=True, exist_ok=True)
+                changed += place_file(classes_txt, split_dir / classes_txt.name, mode)
+                changed += place_file(notes_json, split_dir / notes_json.name, mode)
+            train = (fold_dir / "train").resolve()
+            val = (fold_dir / "val").resolve()
+
         # create YAML file for ever train and val folder
-        train = folder_train_img.parent.resolve()
-        val = folder_val_img.parent.resolve()
-        
         data = {
             'train' : str(train),
             'val' : str(val),
             'nc' : 1,
             'names' : ['y2o3']
         }
-        with open(output_dir_path / f"no_{name}" / "custom_dataset.yaml", 'w', encoding='utf-8') as f:
-            yaml.dump(data, f, allow_unicode=True)
-            
-
-dataset_source = Path('YOLO_dataset_zip', 'project-6-at-2025-03-23-20-14-00444e1f')
-imgs = dataset_source / 'images'
-txts = dataset_source / 'labels'
-classes_txt = dataset_source / 'classes.txt'
-notes_json = dataset_source / 'notes.json'
-output_dir_path = Path('data_for_training')
-
-make_independent_val_img_structure(output_dir_path, imgs, txts, classes_txt, notes_json)
\ No newline at end of file
+        changed += write_if_changed(fold_dir / "custom_dataset.yaml", yaml.dump(data, allow_unicode=True))
+
+    print(f"fold 数: {len(images)}, 更新したファイル数: {changed}")
+
+
+if __name__ == "__main__":
+    dataset_source = Path('YOLO_dataset_zip', 'project-6-at-2025-03-23-20-14-00444e1f')
+    imgs = dataset_source / 'images'
+    txts = dataset_source / 'labels'
+    classes_txt = dataset_source / 'classes.txt'
+    notes_json = dataset_source / 'notes.json'
+    output_dir_path = Path('data_for_training')
+
+    make_independent_val_img_structure(output_dir_path, imgs, txts, classes_txt, notes_json, mode="hardlink")
@@ -0,0 +1,199 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class MicroBatchScheduler:
+    """
+    1件ずつ届く推論要求を、同じキー（チェックポイント・classes などの推論条件）ごとにまとめて実行するスケジューラ
+    キーごとに max_batch 件たまるか、最も古い要求が max_wait_ms 待った時点でまとめて run_batch を呼ぶ
+
+    使い方:
+        scheduler = MicroBatchScheduler(run_batch, max_batch=8, max_wait_ms=10)
+        future = scheduler.submit(key, image)
+        result = future.result()
+    """
+
+    def __init__(self, run_batch, max_batch: int = 8, max_wait_ms: float = 10.0, latency_window: int = 10000):
+        """
+        :param run_batch: run_batch(key, items) -> 各 item に対応する結果のリスト
+        :param max_batch: 1回にまとめる要求の最大数
+        :param max_wait_ms: 最初の要求からバッチを実行するまでに待つ最大時間（ミリ秒）
+        :param latency_window: レイテンシの統計に使う直近の要求数
+        """
+        self.run_batch = run_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._pending = {}
+        self._depth = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._batch_sizes = Counter()
+        self._latencies = deque(maxlen=latency_window)
+        self._completed = 0
+        self._thread = threading.Thread(target=self._run, name="microbatch", daemon=True)
+        self._thread.start()
+
+    def submit(self, key, item) -> Future:
+        """
+        推論要求を追加し、結果を受け取る Future を返す
+
+        :param key: まとめて実行できる要求を識別するキー（ハッシュ可能な値）
+        :param item: run_batch に渡す入力（画像パスや画像の配列）
+        """
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("スケジューラは停止済みです。")
+            self._pending.setdefault(key, []).append((item, future, time.perf_counter()))
+            self._depth += 1
+            self._cond.notify()
+        return future
+
+    def _pop(self, key) -> list:
+        items = self._pending.pop(key)
+        batch, rest = items[:self.max_batch], items[self.max_batch:]
+        if rest:
+            self._pending[key] = rest
+        self._depth -= len(batch)
+        return batch
+
+    def _next_batch(self):
+        # 実行できるバッチが揃うまで待ち、(キー, 要求のリスト) を返す。停止時は None
+        with self._cond:
+            while True:
+                if not self._pending:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                # max_batch 件たまったキーがあれば先に実行する
+                key = next((k for k, items in self._pending.items() if len(items) >= self.max_batch), None)
+                if key is None:
+                    # なければ最も古い要求を持つキーについて、待ち時間が過ぎたかを見る
+                    key, items = min(self._pending.items(), key=lambda kv: kv[1][0][2])
+                    remaining = items[0][2] + self.max_wait - time.perf_counter()
+                    if remaining > 0 and not self._closed:
+                        self._cond.wait(remaining)
+                        continue
+                return key, self._pop(key)
+
+    def _run(self) -> None:
+        while True:
+            next_batch = self._next_batch()
+            if next_batch is None:
+                return
+            key, batch = next_batch
+            try:
+                results = self.run_batch(key, [item for item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"結果の数が要求の数と一致しません: {len(results)} != {len(batch)}")
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                results = None
+
+            done = time.perf_counter()
+            with self._cond:
+                self._batch_sizes[len(batch)] += 1
+                self._latencies.extend(done - submitted for _, _, submitted in batch)
+                self._completed += len(batch)
+            if results is not None:
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+
+    def stats(self) -> dict:
+        """
+        キューの深さ・バッチサイズの分布・レイテンシ（p50/p99、ミリ秒）を返す
+        """
+        with self._cond:
+            latencies = np.array(self._latencies, dtype=np.float64) * 1000
+            return {
+                "queue_depth": self._depth,
+                "completed": self._completed,
+                "batch_sizes": dict(sorted(self._batch_sizes.items())),
+                "latency_ms_p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "latency_ms_p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+    def close(self) -> None:
+        """
+        残っている要求をすべて実行してから停止する
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+class PredictScheduler:
+    """
+    perform_inference の前段に置くスケジューラ
+    (チェックポイント, classes, conf, iou, imgsz) が同じ要求をまとめ、1回のバッチ predict で処理する
+    モデルはチェックポイントごとに初回の要求時に一度だけ読み込む
+    """
+
+    def __init__(self, max_batch: int = 8, max_wait_ms: float = 10.0, device: str = "cpu"):
+        self.device = device
+        self._models = {}
+        self._class_indices = {}
+        self.scheduler = MicroBatchScheduler(self._run_batch, max_batch, max_wait_ms)
+
+    def model(self, checkpoint: str):
+        # 読み込みはスケジューラのスレッド（または要求を受け付ける前の起動処理）からのみ行う
+        if checkpoint not in self._models:
+            from custom_model_predict_2 import load_model
+            self._models[checkpoint] = load_model(checkpoint)
+        return self._models[checkpoint]
+
+    def class_indices(self, checkpoint: str, classes: tuple[str, ...]) -> list[int]:
+        """
+        クラス名からインデックスを求める（チェックポイントとクラスの組み合わせごとに一度だけ）
+        """
+        key = (checkpoint, classes)
+        if key not in self._class_indices:
+            from custom_model_predict_2 import get_target_class_indices
+            self._class_indices[key] = get_target_class_indices(self.model(checkpoint), list(classes))
+        return self._class_indices[key]
+
+    def submit(self, checkpoint: str, source, classes=("y2o3",), conf: float = 0.4, iou: float = 0.5,
+               imgsz: int = 512) -> Future:
+        """
+        1枚分の推論要求を追加する
+
+        :param checkpoint: best.pt のパス
+        :param source: 画像パスまたは画像の配列
+        :return: ultralytics の Results を受け取る Future
+        """
+        return self.scheduler.submit((str(checkpoint), tuple(classes), float(conf), float(iou), int(imgsz)), source)
+
+    def predict(self, checkpoint: str, source, **params):
+        """
+        submit して結果を待つ（呼び出し側から見ると perform_inference と同じ 1 枚単位の呼び出し）
+        """
+        return self.submit(checkpoint, source, **params).result()
+
+    def _run_batch(self, key, sources) -> list:
+        checkpoint, classes, conf, iou, imgsz = key
+        model = self.model(checkpoint)
+        return model.predict(
+            source=[str(s) if not hasattr(s, "shape") else s for s in sources],
+            conf=conf,
+            iou=iou,
+            imgsz=imgsz,
+            device=self.device,
+            classes=self.class_indices(checkpoint, classes),
+            max_det=1000,
+            batch=len(sources),
+            verbose=False,
+            retina_masks=True
+        )
+
+    def stats(self) -> dict:
+        return self.scheduler.stats()
+
+    def close(self) -> None:
+        self.scheduler.close()
@@ -0,0 +1,146 @@
+# 推論用の常駐サーバー
+# モデルを読み込んだまま localhost で待ち受け、画像パスまたは画像のバイト列を受け取って検出結果を返す
+#
+# 起動:   python predict_server.py
+# 例:     curl -X POST localhost:8765/predict -H "Content-Type: application/json" -d '{"image_path": "fine/val/images/xxx.bmp"}'
+#         curl -X POST "localhost:8765/predict?model=default" --data-binary @xxx.bmp -H "Content-Type: application/octet-stream"
+#         curl localhost:8765/stats
+
+import json
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+from microbatch import PredictScheduler
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# 常駐させるモデル {名前: best.pt のパス}
+MODELS = {
+    "default": "runs/segment/5d5_epochs_600/weights/best.pt",
+}
+# 出力するラベル名の置き換え
+CUSTOM_MAPPING = {
+    "y2o3": "y",
+}
+DEFAULT_PARAMS = {"classes": ["y2o3"], "conf": 0.4, "iou": 0.5, "imgsz": 512}
+
+
+def mapped_names(model) -> dict[int, str]:
+    """
+    モデルのクラス名を CUSTOM_MAPPING に従って置き換える
+    """
+    return {idx: CUSTOM_MAPPING.get(name, name) for idx, name in model.names.items()}
+
+
+class PredictHandler(BaseHTTPRequestHandler):
+    models: dict[str, str] = {}
+    scheduler: PredictScheduler = None
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, data: dict) -> None:
+        self._send(status, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/health":
+            self._send_json(200, {"models": list(self.models)})
+        elif path == "/stats":
+            # キューの深さ・バッチサイズの分布・レイテンシ
+            self._send_json(200, self.scheduler.stats())
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                # JSON: {"image_path": ..., "model": ..., "classes": [...], "conf": ..., ...}
+                request = json.loads(body)
+                image = cv2.imread(request["image_path"])
+                if image is None:
+                    raise FileNotFoundError(f"画像の読み込みに失敗しました: {request['image_path']}")
+            else:
+                # 画像のバイト列: 推論条件はクエリ文字列で指定する
+                request = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if "classes" in request:
+                    request["classes"] = request["classes"].split(",")
+                image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if image is None:
+                    raise ValueError("画像のデコードに失敗しました。")
+
+            checkpoint = self.models[request.get("model", "default")]
+            params = {key: request.get(key, value) for key, value in DEFAULT_PARAMS.items()}
+            # 同時に届いた同じ条件の要求は、スケジューラが 1 回のバッチ推論にまとめる
+            res = self.scheduler.predict(checkpoint, image, **params)
+            boxes = res.boxes.data.cpu().numpy().astype(np.float32)
+        except KeyError as e:
+            self._send_json(400, {"error": f"不明なモデルまたは項目です: {e}"})
+            return
+        except Exception as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        if "application/octet-stream" in self.headers.get("Accept", ""):
+            # バイナリ: float32 の (N, 6) [x1, y1, x2, y2, conf, cls]
+            self._send(200, boxes.tobytes(), "application/octet-stream")
+        else:
+            self._send_json(200, {"boxes": boxes.tolist(), "names": mapped_names(self.scheduler.model(checkpoint))})
+
+    def log_message(self, format, *args):
+        # リクエストごとのログは出さない
+        pass
+
+
+def serve(models: dict[str, str] = MODELS, host: str = HOST, port: int = PORT,
+          max_batch: int = 8, max_wait_ms: float = 10.0, device: str = "cpu") -> None:
+    """
+    モデルを読み込み、localhost で推論要求を待ち受ける
+
+    :param max_batch: 1回の推論にまとめる要求の最大数
+    :param max_wait_ms: 要求をまとめるために待つ最大時間（ミリ秒）
+    """
+    scheduler = PredictScheduler(max_batch, max_wait_ms, device)
+    for path in models.values():
+        # 最初の要求を待たずに、起動時にすべてのモデルを読み込んでおく
+        scheduler.model(path)
+    PredictHandler.models = dict(models)
+    PredictHandler.scheduler = scheduler
+    server = ThreadingHTTPServer((host, port), PredictHandler)
+    print(f"推論サーバーを起動しました: http://{host}:{port}  モデル: {list(models)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("推論サーバーを停止します。")
+    finally:
+        server.server_close()
+        scheduler.close()
+
+
+def request_prediction(image_path: str, model: str = "default", host: str = HOST, port: int = PORT, **params) -> dict:
+    """
+    常駐サーバーに画像パスを送り、検出結果を受け取るクライアント
+    """
+    body = json.dumps({"image_path": str(image_path), "model": model, **params}).encode("utf-8")
+    req = urllib.request.Request(f"http://{host}:{port}/predict", data=body,
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    serve()
@@ -1,41 +1,166 @@
+import hashlib
+import json
+import operator
 import os
+import re
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-def process_file(file_path, output_folder):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-    
-    processed_lines = []
-    for line in lines:
-        parts = line.strip().split()
-        if parts:
-            try:
-                first_int = int(parts[0])
-                if first_int in {0, 1, 2}:  # 0, 1, 2 の場合
-                    parts[0] = '0'  # すべて0に統一
-                else:
-                    print(f"On my god it is {first_int}")
-                # elif first_int in {4}:
-                #     parts[0] = '3'
-                #     print("4が出現！",file_path)
-                processed_lines.append(' '.join(parts))
-            except ValueError:
-                continue  # 整数でない場合はスキップ
-    
+import numpy as np
+
+# クラスの置き換え表（ここに無いクラスはそのまま残す）
+CLASS_REMAP = {0: 0, 1: 0, 2: 0}  # 0, 1, 2 はすべて0に統一
+# CLASS_REMAP = {0: 0, 1: 0, 2: 0, 4: 3}
+
+# 前回処理したファイルの内容ハッシュを保存するファイル（出力フォルダ内）
+HASH_STATE_NAME = ".label_hashes.json"
+
+
+# タブ・\r などの空白を半角スペースに置き換える表
+_BLANKS = str.maketrans('\t\r\f\v', '    ')
+# 空白をまとめた後の空でない各行を (クラス番号, 残りの列) に分ける。先頭が整数でない行はクラス番号が空になる
+_LINE = re.compile(r'^(?:([+-]?[0-9]+)(?![^ \n])|[^ \n]+)(.*)$', re.MULTILINE)
+
+
+def remap_lines(text: str, class_remap: dict[int, int]) -> tuple[str, dict]:
+    """
+    ラベルファイルの内容を受け取り、クラス番号を置き換えた内容と統計を返す
+    行の分割とクラス番号の取り出しはファイル全体に対する正規表現で一度に行い、
+    クラス番号の変換・置き換えは NumPy の配列でまとめて行い、各行の残りの列はそのまま書き戻す
+    クラス番号が整数でない行はスキップし、列の区切りは半角スペース 1 つにそろえる
+
+    :param text: ラベルファイルの内容
+    :param class_remap: {元のクラス: 置き換え後のクラス}
+    :return: (出力する内容, {'classes_in', 'classes_out', 'unmapped', 'skipped', 'odd_coords'})
+    """
+    # 空白の並びを半角スペース 1 つにまとめる（str の置換はファイル全体に対して C で行われる）
+    text = text.translate(_BLANKS)
+    while '  ' in text:
+        text = text.replace('  ', ' ')
+    text = text.replace('\n ', '\n').replace(' \n', '\n').strip(' ')
+    # 残りの列は文字列のまま（object 配列で）持ち、クラス番号だけを数値の配列にする
+    rows = np.array(_LINE.findall(text), dtype=object).reshape(-1, 2)
+    valid = rows[:, 0] != ''
+    classes = rows[valid, 0].astype(str).astype(np.int64)
+    rests = rows[valid, 1]
+
+    # 置き換え表をベクトル化して一括で適用する
+    src = np.array(list(class_remap.keys()), dtype=np.int64)
+    dst = np.array(list(class_remap.values()), dtype=np.int64)
+    order = np.argsort(src)
+    src, dst = src[order], dst[order]
+    mapped_mask = np.isin(classes, src)
+    mapped = classes.copy()
+    mapped[mapped_mask] = dst[np.searchsorted(src, classes[mapped_mask])]
+
+    # 座標の数が奇数の行（x, y の組になっていない行）を数える（残りの列は各値の前にスペースが 1 つある）
+    n_coords = np.char.count(rests.astype(str), ' ')
+
+    # 置き換えたクラス番号を各行の先頭に戻す
+    lines = map(operator.add, mapped.astype(str).tolist(), rests.tolist())
+    stats = {
+        'classes_in': Counter(classes.tolist()),
+        'classes_out': Counter(mapped.tolist()),
+        'unmapped': Counter(classes[~mapped_mask].tolist()),
+        'skipped': int((~valid).sum()),
+        'odd_coords': int((n_coords % 2 == 1).sum()),
+    }
+    return '\n'.join(lines) + '\n', stats
+
+
+def process_file(file_path, output_folder, class_remap=CLASS_REMAP, data: bytes = None) -> dict:
+    """
+    1つのラベルファイルのクラス番号を置き換えて output_folder に書き出す
+
+    :return: remap_lines の統計
+    """
+    if data is None:
+        data = Path(file_path).read_bytes()
+    text, stats = remap_lines(data.decode('utf-8'), class_remap)
+
     os.makedirs(output_folder, exist_ok=True)
-    output_file_path = output_folder / file_path.name
+    output_file_path = Path(output_folder) / Path(file_path).name
     with open(output_file_path, 'w', encoding='utf-8') as output_file:
-        output_file.write('\n'.join(processed_lines) + '\n')
+        output_file.write(text)
+    return stats
 
-def process_all_files(input_folder):
+
+def iter_txt_files(input_path: Path):
+    """
+    フォルダ内の *.txt を一覧を作らずに順に返す
+    """
+    with os.scandir(input_path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.txt'):
+                yield Path(entry.path)
+
+
+def _remap_signature(class_remap: dict[int, int]) -> str:
+    return json.dumps(sorted(class_remap.items()))
+
+
+def _process_if_changed(txt_file: Path, output_folder: Path, class_remap: dict, previous: dict, signature: str):
+    data = txt_file.read_bytes()
+    digest = hashlib.sha1(signature.encode() + data).hexdigest()
+    if previous.get(txt_file.name) == digest and (output_folder / txt_file.name).exists():
+        return txt_file.name, digest, None
+    return txt_file.name, digest, process_file(txt_file, output_folder, class_remap, data=data)
+
+
+def process_all_files(input_folder, class_remap=CLASS_REMAP, workers: int = 8, max_in_flight: int = 256) -> dict:
+    """
+    フォルダ内の全ラベルファイルをスレッドプールで処理する
+    前回から内容（または置き換え表）が変わっていないファイルはスキップする
+
+    :param input_folder: ラベルファイルのフォルダ（出力は input_folder/output）
+    :param class_remap: {元のクラス: 置き換え後のクラス}
+    :param workers: スレッド数
+    :param max_in_flight: 同時に処理待ちにしておくファイル数の上限
+    :return: 全体の統計
+    """
     input_path = Path(input_folder)
     output_folder = input_path / 'output'
-    txt_files = list(input_path.glob("*.txt"))
-    
-    for txt_file in txt_files:
-        process_file(txt_file, output_folder)
-    
-    print(f"処理完了: {len(txt_files)} 個のファイルを処理しました。")
+    output_folder.mkdir(parents=True, exist_ok=True)
+    state_path = output_folder / HASH_STATE_NAME
+    previous = json.loads(state_path.read_text(encoding='utf-8')) if state_path.exists() else {}
+    signature = _remap_signature(class_remap)
+
+    hashes = {}
+    total = {'classes_in': Counter(), 'classes_out': Counter(), 'unmapped': Counter(),
+             'skipped': 0, 'odd_coords': 0, 'processed': 0, 'unchanged': 0}
+
+    def collect(future):
+        name, digest, stats = future.result()
+        hashes[name] = digest
+        if stats is None:
+            total['unchanged'] += 1
+            return
+        total['processed'] += 1
+        for key in ('classes_in', 'classes_out', 'unmapped'):
+            total[key].update(stats[key])
+        total['skipped'] += stats['skipped']
+        total['odd_coords'] += stats['odd_coords']
+
+    # ファイル一覧を作らず、処理待ちの数を制限しながら順に投入する
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for txt_file in iter_txt_files(input_path):
+            pending.append(pool.submit(_process_if_changed, txt_file, output_folder, class_remap, previous, signature))
+            if len(pending) >= max_in_flight:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+
+    state_path.write_text(json.dumps(hashes), encoding='utf-8')
+
+    print(f"処理完了: {total['processed']} 個のファイルを処理しました（変更なし: {total['unchanged']} 個）。")
+    print(f"クラスごとの行数（置き換え前）: {dict(sorted(total['classes_in'].items()))}")
+    print(f"クラスごとの行数（置き換え後）: {dict(sorted(total['classes_out'].items()))}")
+    if total['unmapped']:
+        print(f"置き換え表に無いクラス: {dict(sorted(total['unmapped'].items()))}")
+    print(f"スキップした行: {total['skipped']}, 座標数が奇数の行: {total['odd_coords']}")
+    return total
 
 if __name__ == "__main__":
     input_folder = "YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/labels"
@@ -0,0 +1,217 @@
+# 処理段階ごとの時間計測とトレースの出力
+#
+# 各スクリプトの主要な処理（モデル読み込み・画像のデコード・推論・NMS・描画・保存など）は
+# TRACER.stage("名前") で囲んである。環境変数 YOLO_TRACE に出力先を指定して実行すると計測が有効になり、
+# 終了時に段階ごとの集計を表示してトレースを書き出す
+#   YOLO_TRACE=predict/trace.json  python -m verification.save_to_json   # Chrome トレース形式（chrome://tracing, Perfetto）
+#   YOLO_TRACE=predict/trace.jsonl python -m verification.save_to_json   # 1行1イベントの JSONL
+#   YOLO_PROFILE=predict/run.prof  python -m verification.save_to_json   # cProfile（snakeviz などで表示）
+# py-spy で外側から計測する場合もそのまま使える（py-spy record -o profile.svg -- python -m ...）
+# cProfile はメインプロセスのみ。parallel_eval のワーカーのイベントは結果と一緒に親プロセスへ集める
+
+import atexit
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+TRACE_ENV = "YOLO_TRACE"
+PROFILE_ENV = "YOLO_PROFILE"
+
+
+def peak_rss_mb() -> float:
+    """
+    プロセスの最大常駐メモリ（MB）。取得できない環境では None
+    """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux は KB、macOS はバイト単位
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        # Windows では peak_wset が最大値
+        return getattr(info, "peak_wset", info.rss) / (1024 * 1024)
+    except ImportError:
+        return None
+
+
+class Tracer:
+    """
+    処理段階ごとの経過時間を記録する
+    無効な場合、stage() は何も記録しない（計測のコストはほぼ無い）
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # プロセス間で時刻を揃えるため、perf_counter の値を UNIX 時刻に換算して記録する
+        self._origin = time.perf_counter_ns()
+        self._wall_origin = time.time_ns()
+
+    @contextmanager
+    def image(self, name: str):
+        """
+        この中で記録したイベントに画像名を付ける（スレッドごと）
+        """
+        previous = getattr(self._local, "image", None)
+        self._local.image = name
+        try:
+            yield
+        finally:
+            self._local.image = previous
+
+    @contextmanager
+    def stage(self, name: str, **args):
+        """
+        with で囲んだ処理の経過時間を name として記録する
+
+        :param name: 段階の名前（load_model, decode, inference, nms, render, serialize など）
+        :param args: イベントに付ける情報（画像数など）
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._add(name, start, time.perf_counter_ns() - start, args)
+
+    def record(self, name: str, duration_ms: float, **args) -> None:
+        """
+        別の場所で計測された時間を記録する（ultralytics の Results.speed など）
+        """
+        if self.enabled:
+            duration = int(duration_ms * 1e6)
+            self._add(name, time.perf_counter_ns() - duration, duration, args)
+
+    def record_speed(self, result, image: str = None) -> None:
+        """
+        ultralytics の Results.speed（前処理・推論・後処理のミリ秒）を記録する
+        """
+        if not self.enabled:
+            return
+        for key, name in (("preprocess", "preprocess"), ("inference", "inference"), ("postprocess", "postprocess")):
+            value = (getattr(result, "speed", None) or {}).get(key)
+            if value is not None:
+                self.record(name, value, **({"image": image} if image else {}))
+
+    def _add(self, name: str, start_ns: int, duration_ns: int, args: dict) -> None:
+        image = getattr(self._local, "image", None)
+        if image is not None and "image" not in args:
+            args = {**args, "image": image}
+        event = {
+            "name": name,
+            "ts_us": (self._wall_origin + start_ns - self._origin) / 1000,
+            "dur_us": duration_ns / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def drain(self) -> list[dict]:
+        """
+        記録済みのイベントを取り出して空にする
+        （ワーカープロセスの atexit は呼ばれないため、イベントは結果と一緒に親プロセスへ返す）
+        """
+        with self._lock:
+            events, self.events = self.events, []
+        return events
+
+    def extend(self, events: list[dict]) -> None:
+        """
+        ワーカープロセスから返されたイベントを追加する
+        """
+        with self._lock:
+            self.events.extend(events)
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+        段階ごとの回数・合計・平均・最大（秒 / ミリ秒）
+        """
+        durations = defaultdict(list)
+        with self._lock:
+            for event in self.events:
+                durations[event["name"]].append(event["dur_us"] / 1000)
+        return {
+            name: {"count": len(ms), "total_s": sum(ms) / 1000, "mean_ms": sum(ms) / len(ms), "max_ms": max(ms)}
+            for name, ms in durations.items()
+        }
+
+    def print_summary(self) -> None:
+        summary = self.summary()
+        if not summary:
+            return
+        print("段階ごとの処理時間:")
+        for name, s in sorted(summary.items(), key=lambda kv: -kv[1]["total_s"]):
+            print(f"  {name:12s} {s['count']:6d}回  合計 {s['total_s']:8.2f}秒  "
+                  f"平均 {s['mean_ms']:8.2f}ms  最大 {s['max_ms']:8.2f}ms")
+        peak = peak_rss_mb()
+        if peak is not None:
+            print(f"  最大メモリ使用量: {peak:.0f} MB")
+
+    def write(self, path) -> None:
+        """
+        トレースを書き出す。拡張子が .jsonl なら1行1イベント、それ以外は Chrome トレース形式
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            events = list(self.events)
+        if path.suffix == ".jsonl":
+            with open(path, "w", encoding="utf-8") as f:
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                f.write(json.dumps({"name": "peak_rss_mb", "value": peak_rss_mb()}) + "\n")
+        else:
+            trace = [
+                {"name": e["name"], "ph": "X", "ts": e["ts_us"], "dur": e["dur_us"],
+                 "pid": e["pid"], "tid": e["tid"], "args": e["args"]}
+                for e in events
+            ]
+            trace.append({"name": "peak_rss_mb", "ph": "C", "ts": events[-1]["ts_us"] if events else 0,
+                          "pid": os.getpid(), "args": {"MB": peak_rss_mb()}})
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        print(f"トレースを {path} に保存しました。（イベント数: {len(events)}）")
+
+
+def _start_profile(path: Path) -> None:
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def stop():
+        profiler.disable()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+        print(f"cProfile の結果を {path} に保存しました。")
+
+    atexit.register(stop)
+
+
+TRACER = Tracer(enabled=bool(os.environ.get(TRACE_ENV)))
+
+if os.environ.get(TRACE_ENV):
+    def _finish_trace():
+        TRACER.print_summary()
+        TRACER.write(os.environ[TRACE_ENV])
+
+    atexit.register(_finish_trace)
+
+if os.environ.get(PROFILE_ENV) and multiprocessing.parent_process() is None:
+    _start_profile(Path(os.environ[PROFILE_ENV]))
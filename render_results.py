@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from image_cache import imread_cached
+from profiling import TRACER
+
+# 描画パラメータ（custom_model_predict_2.process_results と同じ見た目）
+BOX_COLOR = (255, 0, 0)       # 緑色
+BOX_THICKNESS = 1
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+FONT_SCALE = 0.5              # 小さいフォントサイズ
+TEXT_THICKNESS = 1
+TEXT_COLOR = (255, 255, 255)  # 白色
+ALPHA = 0.5                   # 背景（黒）の不透明度
+
+
+def label_rects(boxes: np.ndarray, text_sizes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    各ボックスのラベル位置と背景矩形をまとめて計算する
+
+    :param boxes: (N, 4) の整数 xyxy ボックス
+    :param text_sizes: (N, 3) の [文字幅, 文字高さ, ベースライン]
+    :return: (テキストの原点 (N, 2), 背景矩形 (N, 4) [x1, y1, x2, y2])
+    """
+    x1, y1 = boxes[:, 0], boxes[:, 1]
+    tw, th, bl = text_sizes.T
+    # テキスト背景の左上座標（バウンディングボックス上部、画像外に出ないよう調整）
+    text_x = x1
+    text_y = np.where(y1 - 10 > th + bl, y1 - 10, y1 + th + bl)
+    origins = np.stack([text_x, text_y], axis=1)
+    rects = np.stack([text_x, text_y - th - bl, text_x + tw, text_y + bl], axis=1)
+    return origins, rects
+
+
+def darken_rects(image: np.ndarray, rects: np.ndarray, alpha: float = ALPHA) -> None:
+    """
+    複数の矩形領域を一度に半透明の黒で塗る（image をその場で書き換える）
+    矩形が重なった部分は、1つずつ重ねて描いた場合と同じく重なった回数だけ暗くなる
+
+    :param image: (H, W, 3) の画像
+    :param rects: (N, 4) の [x1, y1, x2, y2]（x2, y2 を含む）
+    """
+    if len(rects) == 0:
+        return
+    height, width = image.shape[:2]
+    # cv2.rectangle と同様に右下の画素も含め、画像内に収める
+    x1 = np.clip(rects[:, 0], 0, width)
+    y1 = np.clip(rects[:, 1], 0, height)
+    x2 = np.clip(rects[:, 2] + 1, 0, width)
+    y2 = np.clip(rects[:, 3] + 1, 0, height)
+    valid = (x2 > x1) & (y2 > y1)
+    if not valid.any():
+        return
+    x1, y1, x2, y2 = x1[valid], y1[valid], x2[valid], y2[valid]
+
+    # 影響範囲だけを切り出し、2次元の差分配列で各画素が何枚の矩形に覆われるかを数える
+    ox, oy = x1.min(), y1.min()
+    region_w, region_h = x2.max() - ox, y2.max() - oy
+    diff = np.zeros((region_h + 1, region_w + 1), dtype=np.int32)
+    np.add.at(diff, (y1 - oy, x1 - ox), 1)
+    np.add.at(diff, (y1 - oy, x2 - ox), -1)
+    np.add.at(diff, (y2 - oy, x1 - ox), -1)
+    np.add.at(diff, (y2 - oy, x2 - ox), 1)
+    count = diff.cumsum(axis=0).cumsum(axis=1)[:region_h, :region_w]
+
+    covered = count > 0
+    region = image[oy:oy + region_h, ox:ox + region_w]
+    factor = (1 - alpha) ** count[covered]
+    region[covered] = np.rint(region[covered] * factor[:, None]).astype(image.dtype)
+
+
+def render_detections(image: np.ndarray, boxes: np.ndarray, names: dict) -> np.ndarray:
+    """
+    検出結果を画像に描画する
+    ボックスと文字はそれぞれ描画し、ラベル背景の半透明処理は全ボックス分を一度にまとめて行う
+
+    :param image: 元画像（書き換えられる）
+    :param boxes: (N, 6) の [x1, y1, x2, y2, conf, cls]
+    :param names: {クラスインデックス: 表示するラベル}
+    :return: 描画後の画像
+    """
+    with TRACER.stage("render", boxes=len(boxes)):
+        return _render(image, np.asarray(boxes).reshape(-1, 6), names)
+
+
+def _render(image: np.ndarray, boxes: np.ndarray, names: dict) -> np.ndarray:
+    if len(boxes) == 0:
+        return image
+    xyxy = boxes[:, :4].astype(np.int64)
+    labels = [names[int(c)] for c in boxes[:, 5]]
+
+    # テキストサイズはラベルごとに一度だけ計算する
+    sizes = {}
+    for label in set(labels):
+        (text_width, text_height), baseline = cv2.getTextSize(label, FONT, FONT_SCALE, TEXT_THICKNESS)
+        sizes[label] = (text_width, text_height, baseline)
+    text_sizes = np.array([sizes[label] for label in labels], dtype=np.int64)
+    origins, rects = label_rects(xyxy, text_sizes)
+
+    for x1, y1, x2, y2 in xyxy:
+        cv2.rectangle(image, (int(x1), int(y1)), (int(x2), int(y2)), BOX_COLOR, BOX_THICKNESS)
+    darken_rects(image, rects, ALPHA)
+    for label, (text_x, text_y) in zip(labels, origins):
+        cv2.putText(image, label, (int(text_x), int(text_y)), FONT,
+                    FONT_SCALE, TEXT_COLOR, TEXT_THICKNESS, cv2.LINE_AA)
+    return image
+
+
+def render_to_file(image_path, boxes: np.ndarray, names: dict, output_path) -> bool:
+    """
+    画像を読み込んで検出結果を描画し、output_path に保存する
+
+    :return: 保存できた場合 True
+    """
+    try:
+        # キャッシュの画像は共有されているため、コピーに描画する
+        image = imread_cached(image_path).copy()
+    except (OSError, ValueError) as e:
+        print(e)
+        return False
+    render_detections(image, boxes, names)
+    with TRACER.stage("serialize"):
+        return cv2.imwrite(str(output_path), image)
+
+
+def render_batch(jobs, workers: int = 4) -> list[bool]:
+    """
+    複数の画像の描画をスレッドプールで並列に行う（OpenCV と NumPy の処理中は GIL が解放される）
+
+    :param jobs: (画像パス, boxes, names, 出力パス) のリスト
+    :param workers: スレッド数
+    :return: 各画像の保存結果（jobs と同じ順）
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda job: render_to_file(*job), jobs))
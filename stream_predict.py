@@ -0,0 +1,199 @@
+# ディレクトリや連番画像を 1 枚ずつ流れ作業で推論する
+#
+# model.predict(source=ディレクトリ) は全画像の Results をリストにまとめて返すため、
+# retina_masks=True では元の解像度のマスクが画像の枚数分メモリに残る
+# ここでは stream=True で 1 枚ずつ結果を受け取り、書き出し・描画・評価の各処理（シンク）に渡したら手放す
+# 推論と後段の処理は別スレッドで重ねて行い、未処理の結果は最大 depth 枚までしか溜めない
+#
+# 使い方:
+#   with PredictionWriter(Path("predict/store")) as writer:
+#       metrics = MetricSink(labels_dir)
+#       consume(stream_predict(model, images_dir, conf=0.7, iou=0.2), [StoreSink(writer), metrics])
+#       print(metrics.summary())
+
+import json
+import queue
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from profiling import TRACER
+from render_results import render_detections
+from verification.vertools.confusion_matrix_detect import compute_detection_metrics, read_xyxy_from_txt
+
+
+def stream_predict(model, source, depth: int = 2, **predict_kwargs):
+    """
+    推論結果を 1 枚ずつ返すジェネレータ
+    推論は別スレッドで進め、受け取り側の処理が終わっていない結果が depth 枚に達したら推論を待たせる
+
+    :param model: 読み込み済みの YOLO モデル
+    :param source: 画像・ディレクトリ・動画など model.predict の source に渡せるもの
+    :param depth: 先に推論しておく結果の最大枚数
+    :param predict_kwargs: model.predict に渡す引数（conf, iou, save など。stream は常に True）
+    """
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def worker():
+        try:
+            for res in model.predict(source=source, stream=True, **predict_kwargs):
+                TRACER.record_speed(res, Path(res.path).stem)
+                buffer.put(res)
+                if stop.is_set():
+                    return
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(done)
+
+    thread = threading.Thread(target=worker, name="stream-predict", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # 途中で打ち切られた場合は、推論スレッドを止めてから戻る
+        stop.set()
+        while thread.is_alive():
+            try:
+                buffer.get_nowait()
+            except queue.Empty:
+                thread.join(0.01)
+
+
+def consume(results, sinks) -> int:
+    """
+    結果を 1 枚ずつ全てのシンクに渡す（結果はシンクに渡し終えたら保持しない）
+    最後に close() を持つシンクは閉じる
+
+    :param results: stream_predict などが返す Results の反復可能オブジェクト
+    :param sinks: Results を 1 つ受け取る呼び出し可能オブジェクトのリスト
+    :return: 処理した結果の数
+    """
+    n = 0
+    try:
+        for res in results:
+            for sink in sinks:
+                sink(res)
+            n += 1
+    finally:
+        for sink in sinks:
+            if hasattr(sink, "close"):
+                sink.close()
+    return n
+
+
+def _detections(res) -> np.ndarray:
+    """
+    Results のボックスを (K, 6) の [x1, y1, x2, y2, conf, cls] の numpy 配列にする
+    """
+    if res.boxes is None:
+        return np.zeros((0, 6), dtype=np.float32)
+    return res.boxes.data[:, :6].cpu().numpy()
+
+
+class StoreSink:
+    """
+    結果を列形式のストア（prediction_store.PredictionWriter）に追記する
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def __call__(self, res) -> None:
+        det = _detections(res)
+        with TRACER.stage("serialize", image=Path(res.path).stem):
+            self.writer.add(Path(res.path).stem, det[:, :4], det[:, 4], det[:, 5], names=res.names)
+
+
+class JsonSink:
+    """
+    結果を画像ごとの JSON（従来の predict/result_no_<画像名>.json と同じ形式）に書き出す
+    """
+
+    def __init__(self, output_dir: Path, prefix: str = "result_no_"):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+
+    def __call__(self, res) -> None:
+        stem = Path(res.path).stem
+        objs = [
+            {
+                "name": res.names[int(c)],
+                "class": int(c),
+                "confidence": float(conf),
+                "box": {"x1": float(x1), "y1": float(y1), "x2": float(x2), "y2": float(y2)},
+            }
+            for x1, y1, x2, y2, conf, c in _detections(res)
+        ]
+        with TRACER.stage("serialize", image=stem):
+            with open(self.output_dir / f"{self.prefix}{stem}.json", "w", encoding="utf-8") as f:
+                json.dump([objs], f, ensure_ascii=False)
+
+
+class RenderSink:
+    """
+    結果を元画像に描画して output_dir/<画像名>.png に保存する（描画は render_results と同じ見た目）
+    """
+
+    def __init__(self, output_dir: Path, custom_mapping: dict = None):
+        """
+        :param custom_mapping: {クラス名: 表示するラベル}
+        """
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.custom_mapping = custom_mapping or {}
+
+    def __call__(self, res) -> None:
+        stem = Path(res.path).stem
+        names = {idx: self.custom_mapping.get(name, name) for idx, name in res.names.items()}
+        # orig_img は Results が保持している配列なので、コピーに描画する
+        image = render_detections(res.orig_img.copy(), _detections(res), names)
+        with TRACER.stage("serialize", image=stem):
+            cv2.imwrite(str(self.output_dir / f"{stem}.png"), image)
+
+
+class MetricSink:
+    """
+    各画像の検出を GT ラベルと照合し、TP/FP/FN を積算する
+    """
+
+    def __init__(self, labels_dir: Path, iou_threshold: float = 0.6):
+        """
+        :param labels_dir: GT ラベル（YOLO 形式の txt）のディレクトリ。ラベルが無い画像は数えない
+        :param iou_threshold: 評価に使う IoU の閾値
+        """
+        self.labels_dir = Path(labels_dir)
+        self.iou_threshold = iou_threshold
+        self.images = {}
+
+    def __call__(self, res) -> None:
+        stem = Path(res.path).stem
+        label_path = self.labels_dir / f"{stem}.txt"
+        if not label_path.exists():
+            return
+        with TRACER.stage("evaluate", image=stem):
+            self.images[stem] = compute_detection_metrics(_detections(res)[:, :4], read_xyxy_from_txt(label_path),
+                                                          self.iou_threshold)
+
+    def summary(self) -> dict[str, float]:
+        """
+        全画像を合計した TP/FP/FN と、適合率・再現率・F1 スコア
+        """
+        tp = sum(m['tp'] for m in self.images.values())
+        fp = sum(m['fp'] for m in self.images.values())
+        fn = sum(m['fn'] for m in self.images.values())
+        precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
+        recall = tp / (tp + fn) if (tp + fn) > 0 else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if (precision + recall) > 0 else 0.0
+        return {'images': len(self.images), 'tp': tp, 'fp': fp, 'fn': fn,
+                'precision': precision, 'recall': recall, 'f1': f1}
@@ -0,0 +1,414 @@
+# ASHA（非同期 successive halving）によるハイパーパラメータの探索
+#
+# 各試行（lr0, batch などの組み合わせ）は最大 max_epochs まで学習する予定で始めるが、
+# min_epochs, min_epochs * eta, ... の区切り（rung）ごとに一旦止めて検証 mAP（fitness）を記録する
+# 同じ rung に到達した試行のうち上位 1/eta に入ったものだけを、止めた時点のチェックポイントから再開する
+# 最後の rung まで残った試行は、conf / iou の組み合わせごとに検証して最適な閾値も記録する
+#
+# 結果は SQLite（runs/sweep/sweep.db）に保存する。途中で止めても、同じコマンドで続きから再開できる
+#   python sweep.py --data data_for_training/no_xxx/custom_dataset.yaml --trials 27
+#   python sweep.py --report
+
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import shutil
+import sqlite3
+import time
+from pathlib import Path
+
+from profiling import TRACER
+from train_scheduler import apply_slot, default_slots, format_seconds, set_resume_args
+
+SWEEP_DIR = Path("runs/sweep")
+DB_NAME = "sweep.db"
+
+# 学習の探索範囲（リストは選択肢、(下限, 上限) は対数一様分布）
+TRAIN_SPACE = {
+    "lr0": (1e-4, 1e-2),
+    "batch": [8, 16],
+}
+# 最後まで残った試行で試す推論時の閾値
+EVAL_SPACE = {
+    "conf": [0.3, 0.4, 0.5, 0.7],
+    "iou": [0.2, 0.3, 0.5],
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY,
+    config TEXT NOT NULL,
+    state TEXT NOT NULL,          -- running / paused / done / failed
+    rung INTEGER NOT NULL,        -- 完了した rung（未完了なら -1）
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    trial_id INTEGER NOT NULL,
+    rung INTEGER NOT NULL,
+    epoch INTEGER NOT NULL,
+    fitness REAL,
+    map50 REAL,
+    map REAL,
+    seconds REAL,
+    PRIMARY KEY (trial_id, rung)
+);
+CREATE TABLE IF NOT EXISTS evals (
+    trial_id INTEGER NOT NULL,
+    conf REAL NOT NULL,
+    iou REAL NOT NULL,
+    precision REAL,
+    recall REAL,
+    map50 REAL,
+    map REAL,
+    PRIMARY KEY (trial_id, conf, iou)
+);
+"""
+
+
+def rung_epochs(min_epochs: int, max_epochs: int, eta: int) -> list[int]:
+    """
+    各 rung で止めるエポック数（最後は max_epochs）
+    """
+    epochs = []
+    e = min_epochs
+    while e < max_epochs:
+        epochs.append(e)
+        e *= eta
+    epochs.append(max_epochs)
+    return epochs
+
+
+def sample_config(space: dict, rng: random.Random) -> dict:
+    """
+    探索範囲から1つの組み合わせを選ぶ
+    """
+    config = {}
+    for name, values in space.items():
+        if isinstance(values, tuple):
+            low, high = values
+            config[name] = float(math.exp(rng.uniform(math.log(low), math.log(high))))
+        else:
+            config[name] = rng.choice(values)
+    return config
+
+
+class SweepStore:
+    """
+    試行の設定・各 rung の結果・閾値ごとの評価を保存する SQLite
+    書き込むのは親プロセスだけ
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        # 前回の実行が途中で止まった試行は、最後に完了した rung で一時停止していたものとして扱う
+        self.conn.execute("UPDATE trials SET state = 'paused' WHERE state = 'running'")
+        self.conn.commit()
+
+    def add_trial(self, config: dict) -> int:
+        cur = self.conn.execute(
+            "INSERT INTO trials (config, state, rung, created_at) VALUES (?, 'running', -1, ?)",
+            (json.dumps(config), time.strftime("%Y-%m-%d %H:%M:%S")))
+        self.conn.commit()
+        return cur.lastrowid
+
+    def set_state(self, trial_id: int, state: str, rung: int = None) -> None:
+        if rung is None:
+            self.conn.execute("UPDATE trials SET state = ? WHERE id = ?", (state, trial_id))
+        else:
+            self.conn.execute("UPDATE trials SET state = ?, rung = ? WHERE id = ?", (state, rung, trial_id))
+        self.conn.commit()
+
+    def add_result(self, trial_id: int, rung: int, result: dict, seconds: float) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (trial_id, rung, result["epoch"], result["fitness"], result.get("map50"), result.get("map"), seconds))
+        for row in result.get("evals", []):
+            self.conn.execute(
+                "INSERT OR REPLACE INTO evals VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (trial_id, row["conf"], row["iou"], row["precision"], row["recall"], row["map50"], row["map"]))
+        self.conn.commit()
+
+    def trials(self) -> list[sqlite3.Row]:
+        return self.conn.execute("SELECT * FROM trials ORDER BY id").fetchall()
+
+    def config(self, trial_id: int) -> dict:
+        row = self.conn.execute("SELECT config FROM trials WHERE id = ?", (trial_id,)).fetchone()
+        return json.loads(row["config"])
+
+    def rung_results(self, rung: int) -> list[sqlite3.Row]:
+        """
+        rung に到達した試行の結果（fitness の降順）
+        """
+        return self.conn.execute(
+            "SELECT r.trial_id, r.fitness, t.state, t.rung FROM results r JOIN trials t ON t.id = r.trial_id "
+            "WHERE r.rung = ? ORDER BY r.fitness DESC", (rung,)).fetchall()
+
+    def leaderboard(self, limit: int = 10) -> list[dict]:
+        """
+        最も進んだ rung の fitness が高い順に、試行の設定と最適な閾値を返す
+        """
+        rows = self.conn.execute(
+            "SELECT t.id, t.config, t.state, r.rung, r.epoch, r.fitness, r.map50, r.map "
+            "FROM trials t JOIN results r ON r.trial_id = t.id AND r.rung = t.rung "
+            "ORDER BY r.rung DESC, r.fitness DESC LIMIT ?", (limit,)).fetchall()
+        board = []
+        for row in rows:
+            best_eval = self.conn.execute(
+                "SELECT conf, iou, precision, recall, map50, map FROM evals WHERE trial_id = ? "
+                "ORDER BY map DESC LIMIT 1", (row["id"],)).fetchone()
+            board.append({**dict(row), "config": json.loads(row["config"]),
+                          "best_eval": dict(best_eval) if best_eval else None})
+        return board
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def next_job(store: SweepStore, n_trials: int, n_rungs: int, eta: int, running: set) -> tuple:
+    """
+    ASHA の規則で次の仕事を決める
+    上の rung から順に、上位 1/eta に入っていて一時停止中の試行があれば昇格させ、無ければ新しい試行を始める
+    試行数が eta の累乗でないと上の rung で昇格できる試行がいなくなる（例: 20 → 6 → 2 → 0）ため、
+    新しい試行も実行中の試行も無く、まだ最後の rung に到達した試行が無い場合は、
+    最も進んだ rung で一時停止している試行のうち fitness が最も高いものを昇格させる
+
+    :return: ("promote", 試行 ID, 再開する rung) / ("new", 試行 ID or None, 0) / None（今は仕事が無い）
+    """
+    # 最初の rung を終える前に中断された試行は、同じ設定で始めからやり直す
+    for row in store.trials():
+        if row["state"] == "paused" and row["rung"] == -1 and row["id"] not in running:
+            return "new", row["id"], 0
+    for rung in range(n_rungs - 2, -1, -1):
+        results = store.rung_results(rung)
+        top = results[:len(results) // eta]
+        for row in top:
+            if row["state"] == "paused" and row["rung"] == rung and row["trial_id"] not in running:
+                return "promote", row["trial_id"], rung + 1
+    if len(store.trials()) < n_trials:
+        return "new", None, 0
+    if not running and not store.rung_results(n_rungs - 1):
+        for rung in range(n_rungs - 2, -1, -1):
+            for row in store.rung_results(rung):
+                if row["state"] == "paused" and row["rung"] == rung:
+                    return "promote", row["trial_id"], rung + 1
+    return None
+
+
+def _stop_at_epoch(model, stop_epoch: int, snapshot: Path, result_path: Path) -> None:
+    """
+    stop_epoch まで学習したら止めるコールバックを登録する
+    ultralytics は学習の終了時に last.pt から optimizer を取り除き再開できなくするため、
+    止める直前の last.pt を snapshot に複製しておく
+    """
+    def on_model_save(trainer):
+        if trainer.epoch + 1 >= stop_epoch:
+            shutil.copy2(trainer.last, snapshot)
+
+    def on_fit_epoch_end(trainer):
+        if trainer.epoch + 1 >= stop_epoch or trainer.stop:
+            metrics = trainer.metrics or {}
+            result = {
+                "epoch": trainer.epoch + 1,
+                "fitness": float(trainer.fitness or 0.0),
+                "map50": next((float(v) for k, v in metrics.items() if k.startswith("metrics/mAP50(")), None),
+                "map": next((float(v) for k, v in metrics.items() if k.startswith("metrics/mAP50-95(")), None),
+            }
+            result_path.write_text(json.dumps(result), encoding="utf-8")
+            trainer.stop = True
+
+    model.add_callback("on_model_save", on_model_save)
+    model.add_callback("on_fit_epoch_end", on_fit_epoch_end)
+
+
+def _run_segment(trial_dir: str, data: str, base_model: str, config: dict, slot: dict,
+                 stop_epoch: int, max_epochs: int, resume: bool, eval_space: dict) -> None:
+    """
+    1つの試行を stop_epoch まで学習する（子プロセスで実行される）
+    結果は trial_dir/rung_result.json に書き出す
+    """
+    apply_slot(slot)
+    from ultralytics import YOLO
+
+    trial_dir = Path(trial_dir)
+    snapshot = trial_dir / "weights" / "rung.pt"
+    last = trial_dir / "weights" / "last.pt"
+    result_path = trial_dir / "rung_result.json"
+    result_path.unlink(missing_ok=True)
+
+    if resume:
+        # 前の rung で止めた時点の状態（optimizer を含む）から再開する
+        shutil.copy2(snapshot, last)
+        set_resume_args(last, workers=slot['workers'])
+        model = YOLO(last)
+        _stop_at_epoch(model, stop_epoch, snapshot, result_path)
+        model.train(resume=True, device=slot['device'])
+    else:
+        model = YOLO(base_model)
+        _stop_at_epoch(model, stop_epoch, snapshot, result_path)
+        model.train(data=data, epochs=max_epochs, project=str(trial_dir.parent), name=trial_dir.name,
+                    exist_ok=True, device=slot['device'], workers=slot['workers'], **config)
+
+    result = json.loads(result_path.read_text(encoding="utf-8"))
+    if result["epoch"] >= max_epochs or result["epoch"] < stop_epoch:
+        # 最後の rung まで学習した（または早期終了した）試行は、推論時の閾値ごとに検証する
+        best = YOLO(trial_dir / "weights" / "best.pt")
+        result["evals"] = []
+        for conf in eval_space["conf"]:
+            for iou in eval_space["iou"]:
+                metrics = best.val(data=data, conf=conf, iou=iou, device=slot['device'], verbose=False, plots=False)
+                result["evals"].append({
+                    "conf": conf, "iou": iou,
+                    "precision": float(metrics.box.mp), "recall": float(metrics.box.mr),
+                    "map50": float(metrics.box.map50), "map": float(metrics.box.map),
+                })
+        result_path.write_text(json.dumps(result), encoding="utf-8")
+
+
+def run_sweep(data: Path,
+              sweep_dir: Path = SWEEP_DIR,
+              base_model: str = "yolo11x.pt",
+              n_trials: int = 27,
+              min_epochs: int = 50,
+              max_epochs: int = 1000,
+              eta: int = 3,
+              train_space: dict = TRAIN_SPACE,
+              eval_space: dict = EVAL_SPACE,
+              slots: list[dict] = None,
+              seed: int = 0,
+              **train_kwargs) -> list[dict]:
+    """
+    ASHA でハイパーパラメータを探索する
+
+    :param data: 探索に使う custom_dataset.yaml
+    :param sweep_dir: 試行ごとの学習結果と sweep.db の保存先
+    :param n_trials: 試す組み合わせの数
+    :param min_epochs: 最初の rung のエポック数
+    :param max_epochs: 最後の rung のエポック数
+    :param eta: 各 rung で次に進める割合の逆数（上位 1/eta を再開する）
+    :param train_space: 学習の探索範囲（sample_config を参照）
+    :param eval_space: 最後まで残った試行で試す conf / iou
+    :param slots: 同時に学習する枠（省略時は train_scheduler.default_slots()）
+    :param train_kwargs: 全試行に共通の model.train の引数（imgsz など）
+    :return: 上位の試行（SweepStore.leaderboard）
+    """
+    sweep_dir = Path(sweep_dir)
+    store = SweepStore(sweep_dir / DB_NAME)
+    rungs = rung_epochs(min_epochs, max_epochs, eta)
+    slots = slots or default_slots()
+    rng = random.Random(seed + len(store.trials()))
+    print(f"rung ごとのエポック数: {rungs}, 試行数: {n_trials}, 同時に学習する枠: {[s['device'] for s in slots]}")
+
+    context = multiprocessing.get_context("spawn")
+    running = {}  # 枠の番号: (試行 ID, rung, プロセス, 開始時刻)
+    try:
+        while True:
+            for i, (trial_id, rung, process, started) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                seconds = time.perf_counter() - started
+                result_path = sweep_dir / f"trial_{trial_id}" / "rung_result.json"
+                TRACER.record("sweep_segment", seconds * 1000, trial=trial_id, rung=rung)
+                if process.exitcode != 0 or not result_path.exists():
+                    store.set_state(trial_id, "failed")
+                    print(f"試行 {trial_id}: 失敗 (終了コード {process.exitcode})")
+                else:
+                    result = json.loads(result_path.read_text(encoding="utf-8"))
+                    store.add_result(trial_id, rung, result, seconds)
+                    # 最後の rung に到達したか、早期終了で止まった試行はそれ以上進めない
+                    finished = rung == len(rungs) - 1 or result["epoch"] < rungs[rung]
+                    store.set_state(trial_id, "done" if finished else "paused", rung)
+                    print(f"試行 {trial_id}: rung {rung}（{result['epoch']} エポック）fitness={result['fitness']:.4f} "
+                          f"({format_seconds(seconds)})")
+                del running[i]
+
+            busy = {trial_id for trial_id, _, _, _ in running.values()}
+            for i, slot in enumerate(slots):
+                if i in running:
+                    continue
+                job = next_job(store, n_trials, len(rungs), eta, busy)
+                if job is None:
+                    break
+                kind, trial_id, rung = job
+                if kind == "new" and trial_id is None:
+                    config = {**train_kwargs, **sample_config(train_space, rng)}
+                    trial_id = store.add_trial(config)
+                    print(f"試行 {trial_id} を開始: {config}")
+                elif kind == "new":
+                    config = store.config(trial_id)
+                    store.set_state(trial_id, "running")
+                    print(f"試行 {trial_id} を始めからやり直します: {config}")
+                else:
+                    config = store.config(trial_id)
+                    store.set_state(trial_id, "running")
+                    print(f"試行 {trial_id} を rung {rung}（{rungs[rung]} エポック）へ進めます")
+                process = context.Process(
+                    target=_run_segment,
+                    args=(str(sweep_dir / f"trial_{trial_id}"), str(data), base_model, config, slot,
+                          rungs[rung], max_epochs, kind == "promote", eval_space),
+                    name=f"sweep-{trial_id}",
+                )
+                process.start()
+                running[i] = (trial_id, rung, process, time.perf_counter())
+                busy.add(trial_id)
+
+            if not running:
+                break
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("中断します。次回の実行で、実行中だった試行は最後に完了した rung から再開します。")
+        for trial_id, _, process, _ in running.values():
+            process.terminate()
+            process.join()
+        store.close()
+        raise
+
+    board = store.leaderboard()
+    store.close()
+    return board
+
+
+def print_leaderboard(board: list[dict]) -> None:
+    for row in board:
+        line = (f"試行 {row['id']:3d} [{row['state']}] rung {row['rung']}（{row['epoch']} エポック） "
+                f"fitness={row['fitness']:.4f} mAP50={row['map50'] or 0:.4f} mAP50-95={row['map'] or 0:.4f}  {row['config']}")
+        if row["best_eval"]:
+            e = row["best_eval"]
+            line += f"  最適な閾値: conf={e['conf']}, iou={e['iou']} (P={e['precision']:.3f}, R={e['recall']:.3f})"
+        print(line)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="ASHA によるハイパーパラメータ探索")
+    parser.add_argument("--data", type=Path, help="探索に使う custom_dataset.yaml")
+    parser.add_argument("--dir", type=Path, default=SWEEP_DIR, help="学習結果と sweep.db の保存先")
+    parser.add_argument("--model", default="yolo11x.pt", help="事前学習済みの重み")
+    parser.add_argument("--trials", type=int, default=27)
+    parser.add_argument("--min-epochs", type=int, default=50)
+    parser.add_argument("--max-epochs", type=int, default=1000)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--imgsz", type=int, default=512)
+    parser.add_argument("--report", action="store_true", help="探索せずに結果だけを表示する")
+    args = parser.parse_args(argv)
+
+    if args.report:
+        store = SweepStore(args.dir / DB_NAME)
+        print_leaderboard(store.leaderboard())
+        store.close()
+        return
+    if args.data is None:
+        parser.error("--data を指定してください。")
+    board = run_sweep(args.data, args.dir, args.model, args.trials, args.min_epochs, args.max_epochs, args.eta,
+                      imgsz=args.imgsz)
+    print_leaderboard(board)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+from image_cache import imread_cached
+from profiling import TRACER
+
+
+def tile_origins(length: int, tile: int, overlap: int) -> list[int]:
+    """
+    1次元方向のタイルの開始位置を求める
+    最後のタイルは画像の端に揃え、タイルが画像からはみ出さないようにする
+    """
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    if stride <= 0:
+        raise ValueError(f"overlap ({overlap}) はタイルサイズ ({tile}) より小さくしてください。")
+    origins = list(range(0, length - tile, stride))
+    origins.append(length - tile)
+    return origins
+
+
+def iter_tile_batches(image: np.ndarray, tile: int = 512, overlap: int = 64, batch_size: int = 8):
+    """
+    画像を重なりのあるタイルに分割し、batch_size 枚ずつ返すジェネレータ
+    タイルは元画像のビューなので、一度に保持するのは 1 バッチ分だけ
+
+    :return: ([(x0, y0), ...], [タイル画像, ...]) を順に返す
+    """
+    height, width = image.shape[:2]
+    origins = [(x0, y0) for y0 in tile_origins(height, tile, overlap) for x0 in tile_origins(width, tile, overlap)]
+    for start in range(0, len(origins), batch_size):
+        chunk = origins[start:start + batch_size]
+        yield chunk, [np.ascontiguousarray(image[y0:y0 + tile, x0:x0 + tile]) for x0, y0 in chunk]
+
+
+def nms_xyxy(boxes: np.ndarray, scores: np.ndarray, iou_threshold: float, classes: np.ndarray = None) -> np.ndarray:
+    """
+    NumPy による NMS。classes を与えるとクラスごとに独立して抑制する
+
+    :param boxes: (N, 4) の xyxy ボックス
+    :param scores: (N,) の信頼度
+    :param iou_threshold: この値より大きく重なるボックスを削除する
+    :param classes: (N,) のクラスインデックス
+    :return: 残したボックスのインデックス（信頼度の降順）
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    if classes is not None:
+        # クラスごとに座標をずらし、異なるクラス同士が重ならないようにする
+        offset = (boxes.max() + 1) * np.asarray(classes, dtype=np.float64)
+        boxes = boxes + offset[:, None]
+
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        w = np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None)
+        h = np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None)
+        inter = w * h
+        union = areas[i] + areas[rest] - inter
+        iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+
+def perform_tiled_inference(model, image_path, target_class_indices, tile=512, overlap=64, batch_size=8,
+                            conf=0.4, iou=0.5, merge_iou=0.5, device="cpu"):
+    """
+    大きな画像を縮小せずにタイル分割して推論し、タイルの継ぎ目で重複した検出を NMS でまとめる
+    戻り値は perform_inference と同じく Results のリストなので、process_results にそのまま渡せる
+
+    :param tile: タイルの一辺の画素数（推論時の imgsz と同じ）
+    :param overlap: 隣り合うタイルの重なりの画素数（最大の粒子より大きくする）
+    :param batch_size: 1回の推論でまとめるタイルの枚数
+    :param merge_iou: タイル間で重複した検出をまとめる NMS の IoU 閾値
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"画像ファイルが存在しません: {image_path}")
+    image = imread_cached(image_path)
+
+    detections = []
+    for origins, tiles in iter_tile_batches(image, tile, overlap, batch_size):
+        with TRACER.stage("predict", images=len(tiles)):
+            results = model.predict(
+                source=tiles,
+                conf=conf,
+                iou=iou,
+                device=device,
+                imgsz=tile,
+                classes=target_class_indices,
+                max_det=1000,
+                batch=len(tiles),
+                verbose=False
+            )
+        for (x0, y0), res in zip(origins, results):
+            data = res.boxes.data.cpu().numpy()
+            if len(data):
+                # タイル座標から元画像の座標に戻す
+                data[:, [0, 2]] += x0
+                data[:, [1, 3]] += y0
+                detections.append(data)
+
+    data = np.concatenate(detections) if detections else np.zeros((0, 6), dtype=np.float32)
+    with TRACER.stage("nms", boxes=len(data)):
+        keep = nms_xyxy(data[:, :4], data[:, 4], merge_iou, classes=data[:, 5])
+    merged = torch.from_numpy(np.ascontiguousarray(data[keep]))
+    print(f"タイル推論: 検出数 {len(data)} → 統合後 {len(merged)}")
+    return [Results(image, path=str(image_path), names=model.names, boxes=merged)]
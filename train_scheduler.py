@@ -0,0 +1,315 @@
+# leave-one-out の各 fold の学習を、空いている GPU（または CPU コアのグループ）に割り当てて並列に実行する
+#
+# 進行状況は runs/BoundingBox/fold_queue.json に保存するため、途中で止めても次回の実行で続きから再開できる
+#   ・best.pt があり、未完了の記録も無い fold は学習済みとしてスキップする
+#   ・途中で止まった fold は last.pt から再開する（ultralytics の resume）
+#   ・失敗した fold は実行ごとに max_attempts 回まで再実行する
+
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+
+from profiling import TRACER
+
+QUEUE_NAME = "fold_queue.json"
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+
+def default_slots(slots_per_gpu: int = 1, cores_per_slot: int = 8) -> list[dict]:
+    """
+    同時に学習を走らせる枠を決める
+    GPU があれば GPU ごとに slots_per_gpu 枠、無ければ CPU コアを cores_per_slot 個ずつのグループに分ける
+
+    :return: [{'device': "0" / "cpu", 'cpus': 割り当てるコア番号のリスト（GPU の場合は None）, 'workers': データローダのプロセス数}, ...]
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    try:
+        import torch
+        n_gpus = torch.cuda.device_count()
+    except ImportError:
+        n_gpus = 0
+
+    if n_gpus > 0:
+        n_slots = n_gpus * slots_per_gpu
+        # データローダのプロセスは CPU コアを枠の数で分け合う
+        workers = max(1, len(cores) // n_slots)
+        return [{'device': str(gpu), 'cpus': None, 'workers': workers}
+                for gpu in range(n_gpus) for _ in range(slots_per_gpu)]
+
+    n_slots = max(1, len(cores) // cores_per_slot)
+    groups = [cores[i::n_slots] for i in range(n_slots)]
+    return [{'device': "cpu", 'cpus': group, 'workers': min(2, len(group))} for group in groups]
+
+
+def fold_weights(project: Path, name: str) -> tuple[Path, Path]:
+    """
+    fold の best.pt と last.pt のパス
+    """
+    weights = Path(project) / name / "weights"
+    return weights / "best.pt", weights / "last.pt"
+
+
+def epochs_done(project: Path, name: str) -> int:
+    """
+    ultralytics が書き出す results.csv の行数から、終わったエポック数を求める
+    """
+    csv_path = Path(project) / name / "results.csv"
+    if not csv_path.exists():
+        return 0
+    with open(csv_path, encoding="utf-8") as f:
+        return max(0, sum(1 for line in f if line.strip()) - 1)
+
+
+class FoldQueue:
+    """
+    fold ごとの学習の状態を JSON ファイルに保存するキュー
+    状態が変わるたびに書き出すため、中断されても次回の実行で続きから始められる
+    """
+
+    def __init__(self, path: Path, folds: dict[str, Path], project: Path, max_attempts: int = 2):
+        """
+        :param path: キューの保存先（fold_queue.json）
+        :param folds: {fold 名: custom_dataset.yaml のパス}
+        :param project: 学習結果の保存先（runs/BoundingBox）
+        :param max_attempts: 1つの fold を試す最大回数
+        """
+        self.path = Path(path)
+        self.project = Path(project)
+        self.max_attempts = max_attempts
+        saved = json.loads(self.path.read_text(encoding="utf-8"))["folds"] if self.path.exists() else {}
+
+        self.folds = {}
+        for name, data in folds.items():
+            job = saved.get(name, {"state": None, "attempts": 0})
+            job["data"] = str(data)
+            # 試行回数は実行ごとに数え直す（前回の実行で回数を使い切って失敗した fold も再実行する）
+            job["attempts"] = 0
+            best, last = fold_weights(self.project, name)
+            if job["state"] is None:
+                # キューに記録が無い fold は、以前に（スケジューラを使わずに）学習し終えたかを重みから判定する
+                finished = best.exists() and (not last.exists() or _training_finished(last))
+                job["state"] = DONE if finished else PENDING
+            elif job["state"] == RUNNING:
+                # 前回の実行が途中で止まった
+                job["state"] = PENDING
+            elif job["state"] == DONE and not best.exists():
+                job["state"] = PENDING
+            self.folds[name] = job
+        self.save()
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps({"folds": self.folds}, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp_path.replace(self.path)
+
+    def is_waiting(self, name: str) -> bool:
+        """
+        まだ実行する予定がある（未実行、または再試行できる失敗）か
+        """
+        job = self.folds[name]
+        return job["state"] == PENDING or (job["state"] == FAILED and job["attempts"] < self.max_attempts)
+
+    def next_job(self) -> str:
+        """
+        次に学習する fold 名（無ければ None）
+        """
+        return next((name for name in self.folds if self.is_waiting(name)), None)
+
+    def start(self, name: str, device: str) -> bool:
+        """
+        fold を実行中にする
+
+        :return: last.pt から再開する場合 True
+        """
+        job = self.folds[name]
+        _, last = fold_weights(self.project, name)
+        # 学習を終えた last.pt は ultralytics が再開できないため、事前学習済みの重みから学習し直す
+        resume = last.exists() and not _training_finished(last)
+        job.update(state=RUNNING, attempts=job["attempts"] + 1, device=device, resume=resume,
+                   started_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.save()
+        return resume
+
+    def finish(self, name: str, ok: bool, seconds: float) -> None:
+        job = self.folds[name]
+        job.update(state=DONE if ok else FAILED, seconds=job.get("seconds", 0.0) + seconds,
+                   finished_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.save()
+
+    def interrupt(self, name: str, seconds: float) -> None:
+        job = self.folds[name]
+        job.update(state=PENDING, attempts=job["attempts"] - 1, seconds=job.get("seconds", 0.0) + seconds)
+        self.save()
+
+    def counts(self) -> dict[str, int]:
+        counts = {}
+        for job in self.folds.values():
+            counts[job["state"]] = counts.get(job["state"], 0) + 1
+        return counts
+
+
+def _training_finished(last: Path) -> bool:
+    # ultralytics は学習の終了時に last.pt の epoch を -1 にする
+    import torch
+    checkpoint = torch.load(last, map_location="cpu", weights_only=False)
+    return checkpoint.get("epoch", -1) == -1
+
+
+def set_resume_args(last: Path, **args) -> None:
+    """
+    last.pt に保存された学習条件（train_args）を書き換える
+    ultralytics の resume は imgsz・batch・device 以外の引数を last.pt のものから読むため、
+    workers など枠ごとに変える条件は再開前にここで書き込む
+    """
+    import torch
+    last = Path(last)
+    checkpoint = torch.load(last, map_location="cpu", weights_only=False)
+    checkpoint["train_args"] = {**checkpoint.get("train_args", {}), **args}
+    tmp_path = last.with_name(last.name + ".tmp")
+    torch.save(checkpoint, tmp_path)
+    tmp_path.replace(last)
+
+
+def apply_slot(slot: dict) -> None:
+    """
+    子プロセスを枠に割り当てたリソースに合わせる（CPU の枠では割り当てたコアだけを使う）
+    """
+    if slot['cpus']:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, slot['cpus'])
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            os.environ[var] = str(len(slot['cpus']))
+        import torch
+        torch.set_num_threads(len(slot['cpus']))
+
+
+def _train_fold(data: str, project: str, name: str, base_model: str, slot: dict, resume: bool,
+                train_kwargs: dict) -> None:
+    """
+    1つの fold を学習する（子プロセスで実行される）
+    """
+    apply_slot(slot)
+    from ultralytics import YOLO
+
+    _, last = fold_weights(Path(project), name)
+    if resume:
+        # 学習条件は last.pt に保存されたものを使い、デバイスとデータローダのプロセス数を割り当てた枠に合わせる
+        set_resume_args(last, workers=slot['workers'])
+        YOLO(last).train(resume=True, device=slot['device'])
+    else:
+        YOLO(base_model).train(data=data, project=project, name=name, exist_ok=True,
+                               device=slot['device'], workers=slot['workers'], **train_kwargs)
+
+
+def format_seconds(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    return f"{minutes // 60}時間{minutes % 60:02d}分"
+
+
+def run_folds(folds: dict[str, Path],
+              project: Path = Path("runs/BoundingBox"),
+              base_model: str = "yolo11x.pt",
+              slots: list[dict] = None,
+              epochs: int = 1000,
+              max_attempts: int = 2,
+              report_interval: float = 300,
+              **train_kwargs) -> dict[str, str]:
+    """
+    各 fold の学習を空いている枠に割り当てて並列に実行する
+
+    :param folds: {fold 名: custom_dataset.yaml のパス}
+    :param project: 学習結果の保存先（<project>/<fold 名>/weights/best.pt）
+    :param base_model: 事前学習済みの重み
+    :param slots: 同時に学習する枠（省略時は default_slots()）
+    :param epochs: エポック数（ETA の計算にも使う）
+    :param max_attempts: 1つの fold を試す最大回数
+    :param report_interval: 進捗と残り時間を表示する間隔（秒）
+    :param train_kwargs: model.train に渡す引数（imgsz, batch, lr0 など）
+    :return: {fold 名: 最終的な状態}
+    """
+    project = Path(project)
+    slots = slots or default_slots()
+    queue = FoldQueue(project / QUEUE_NAME, folds, project, max_attempts)
+    print(f"fold 数: {len(folds)}, 状態: {queue.counts()}, 同時に学習する枠: {[s['device'] for s in slots]}")
+
+    # 子プロセスは CUDA を初期化するため spawn で起動する
+    context = multiprocessing.get_context("spawn")
+    running = {}  # 枠の番号: (fold 名, プロセス, 開始時刻, 開始時のエポック数)
+    last_report = time.perf_counter()
+    try:
+        while True:
+            for i, (name, process, started, _) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                seconds = time.perf_counter() - started
+                best, _ = fold_weights(project, name)
+                ok = process.exitcode == 0 and best.exists()
+                queue.finish(name, ok, seconds)
+                TRACER.record("train", seconds * 1000, fold=name, device=slots[i]['device'])
+                print(f"{name}: {'終了' if ok else f'失敗 (終了コード {process.exitcode})'} ({format_seconds(seconds)})")
+                del running[i]
+
+            for i, slot in enumerate(slots):
+                if i in running:
+                    continue
+                name = queue.next_job()
+                if name is None:
+                    break
+                resume = queue.start(name, slot['device'])
+                print(f"開始: {name} のトレーニング（デバイス: {slot['device']}{'、last.pt から再開' if resume else ''}）")
+                process = context.Process(
+                    target=_train_fold,
+                    args=(queue.folds[name]["data"], str(project), name, base_model, slot, resume,
+                          dict(train_kwargs, epochs=epochs)),
+                    name=f"train-{name}",
+                )
+                process.start()
+                running[i] = (name, process, time.perf_counter(), epochs_done(project, name))
+
+            if not running:
+                break
+            if time.perf_counter() - last_report >= report_interval:
+                report_progress(queue, running, project, epochs, len(slots))
+                last_report = time.perf_counter()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("中断します。次回の実行で、実行中だった fold は last.pt から再開します。")
+        for name, process, started, _ in running.values():
+            process.terminate()
+            process.join()
+            queue.interrupt(name, time.perf_counter() - started)
+        raise
+
+    print(f"全 fold の状態: {queue.counts()}")
+    return {name: job["state"] for name, job in queue.folds.items()}
+
+
+def report_progress(queue: FoldQueue, running: dict, project: Path, epochs: int, n_slots: int) -> None:
+    """
+    実行中の fold のエポック数と残り時間、全体の残り時間の目安を表示する
+    （早期終了（patience）で打ち切られた場合は、表示より早く終わる）
+    """
+    now = time.perf_counter()
+    remaining = []
+    epoch_seconds = []
+    for name, _, started, start_epoch in running.values():
+        done = epochs_done(project, name)
+        if done > start_epoch:
+            per_epoch = (now - started) / (done - start_epoch)
+            epoch_seconds.append(per_epoch)
+            eta = per_epoch * max(0, epochs - done)
+            remaining.append(eta)
+            print(f"  {name}: {done}/{epochs} エポック, 残り {format_seconds(eta)}")
+        else:
+            print(f"  {name}: {done}/{epochs} エポック")
+
+    waiting = sum(1 for name in queue.folds if queue.is_waiting(name))
+    if epoch_seconds:
+        # 待っている fold は、実行中の fold と同じ速さで全エポック回るとみなす
+        per_fold = sum(epoch_seconds) / len(epoch_seconds) * epochs
+        total = max(remaining) + per_fold * waiting / n_slots
+        print(f"  待機中: {waiting} fold, 全体の残り: 約 {format_seconds(total)}")
@@ -0,0 +1,156 @@
+import math
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+from ultralytics.engine.results import Results
+
+from ensemble_predict import weighted_box_fusion
+from image_cache import imread_cached
+from profiling import TRACER
+
+# テスト時拡張（TTA）: 画像を複数の倍率・左右反転で推論し、検出結果を元の座標に戻して WBF で統合する
+#
+# 倍率の異なる画像は、最大の倍率に合わせた同じ大きさの画像（左上に配置し、残りは灰色で埋める）にすることで、
+# 1 回の model.predict で 1 つのバッチとして推論する
+# （export_backend.py の ONNX は dynamic=True で変換しているため、変換済みのモデルでも同じように推論できる）
+
+PAD_VALUE = 114  # ultralytics のレターボックスと同じ灰色
+STRIDE = 32
+
+
+def augment_views(image: np.ndarray, imgsz: int = 512, scales=(1.0, 1.5), flip: bool = True):
+    """
+    倍率と左右反転を組み合わせた画像を作る
+    各画像は長辺が imgsz × 倍率 になるように縮小・拡大し、全て同じ大きさ（正方形）の画像の左上に置く
+
+    :param image: BGR 画像
+    :param imgsz: 倍率 1 のときの長辺の画素数
+    :param scales: 倍率のリスト
+    :param flip: True の場合、各倍率で左右反転した画像も作る
+    :return: (画像のリスト, {'scale': 倍率 (V,), 'ratio': 元画像からの倍率 (V,),
+              'width': 縮小・拡大後の幅 (V,), 'height': 縮小・拡大後の高さ (V,), 'flip': (V,)})
+    """
+    height, width = image.shape[:2]
+    canvas_size = math.ceil(max(scales) * imgsz / STRIDE) * STRIDE
+    views, view_scales, ratios, sizes, flips = [], [], [], [], []
+    for scale in scales:
+        ratio = imgsz * scale / max(height, width)
+        size = (round(width * ratio), round(height * ratio))
+        interpolation = cv2.INTER_AREA if ratio < 1 else cv2.INTER_LINEAR
+        resized = cv2.resize(image, size, interpolation=interpolation)
+        for flipped in ((False, True) if flip else (False,)):
+            canvas = np.full((canvas_size, canvas_size, 3), PAD_VALUE, dtype=image.dtype)
+            canvas[:size[1], :size[0]] = resized[:, ::-1] if flipped else resized
+            views.append(canvas)
+            view_scales.append(scale)
+            ratios.append(ratio)
+            sizes.append(size)
+            flips.append(flipped)
+    sizes = np.array(sizes, dtype=np.float64).reshape(-1, 2)
+    params = {'scale': np.array(view_scales, dtype=np.float64), 'ratio': np.array(ratios),
+              'width': sizes[:, 0], 'height': sizes[:, 1], 'flip': np.array(flips)}
+    return views, params
+
+
+def deaugment_boxes(data: np.ndarray, view_ids: np.ndarray, params: dict) -> np.ndarray:
+    """
+    各拡張画像での検出を、元画像の座標にまとめて戻す
+    拡張画像の余白にかかった部分は切り取り、面積が無くなった検出は除く
+
+    :param data: (K, 6) の [x1, y1, x2, y2, conf, cls]（拡張画像の座標）
+    :param view_ids: (K,) の各検出の拡張画像の番号
+    :param params: augment_views の戻り値
+    :return: (K', 6) の元画像の座標での検出
+    """
+    data = np.array(data, dtype=np.float64).reshape(-1, 6)
+    ratio = params['ratio'][view_ids]
+    width = params['width'][view_ids]
+    flipped = params['flip'][view_ids]
+
+    x1 = np.clip(data[:, 0], 0, width)
+    x2 = np.clip(data[:, 2], 0, width)
+    data[:, [1, 3]] = np.clip(data[:, [1, 3]], 0, params['height'][view_ids][:, None])
+    # 左右反転した画像では x → width - x（左右の端が入れ替わる）
+    data[:, 0] = np.where(flipped, width - x2, x1)
+    data[:, 2] = np.where(flipped, width - x1, x2)
+    data[:, :4] /= ratio[:, None]
+    keep = (data[:, 2] > data[:, 0]) & (data[:, 3] > data[:, 1])
+    return data[keep]
+
+
+def needs_tta(data: np.ndarray, small_size: float = 16, low_conf: float = 0.6, trigger_fraction: float = 0.3) -> bool:
+    """
+    最初の推論の結果から、TTA を行うべきかを判定する
+    小さい検出（√(幅 × 高さ) が small_size 画素未満）か信頼度の低い検出（low_conf 未満）の割合が
+    trigger_fraction 以上の場合、または何も検出されなかった場合（小さな粒子を見逃している可能性がある）に True
+
+    :param data: (K, 6) の [x1, y1, x2, y2, conf, cls]（元画像の座標）
+    """
+    if len(data) == 0:
+        return True
+    size = np.sqrt((data[:, 2] - data[:, 0]) * (data[:, 3] - data[:, 1]))
+    uncertain = (size < small_size) | (data[:, 4] < low_conf)
+    return bool(uncertain.mean() >= trigger_fraction)
+
+
+def perform_tta_inference(model, image_path, target_class_indices, imgsz=512, scales=(1.0, 1.5), flip=True,
+                          adaptive=False, conf=0.4, iou=0.5, wbf_iou=0.55, small_size=16, low_conf=0.6,
+                          trigger_fraction=0.3, device="cpu"):
+    """
+    TTA で推論する
+    戻り値は perform_inference と同じく Results のリストなので、process_results にそのまま渡せる
+
+    :param scales: 倍率のリスト（小さな粒子を拾うには 1 より大きい倍率を含める）
+    :param flip: 各倍率で左右反転した画像も推論する
+    :param adaptive: True の場合、まず imgsz で通常どおり推論し、needs_tta が True の画像だけ残りの拡張画像を推論する
+    :param wbf_iou: 拡張画像の間で同じ物体とみなす IoU
+    :param small_size: adaptive のときに小さい検出とみなす大きさ（画素）
+    :param low_conf: adaptive のときに信頼度が低いとみなす値
+    :param trigger_fraction: adaptive のときに TTA を行う、小さい・信頼度の低い検出の割合
+    """
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"画像ファイルが存在しません: {image_path}")
+    image = imread_cached(image_path)
+    predict_kwargs = dict(conf=conf, iou=iou, device=device, classes=target_class_indices, max_det=1000,
+                          verbose=False)
+
+    detections = []
+    if adaptive:
+        with TRACER.stage("predict", images=1):
+            res = model.predict(source=image, imgsz=imgsz, **predict_kwargs)[0]
+        # 配列を渡した推論の Results は path が image0.jpg になるため、画像のパスに直す
+        res.path = str(image_path)
+        TRACER.record_speed(res, Path(image_path).stem)
+        base = res.boxes.data[:, :6].cpu().numpy()
+        if not needs_tta(base, small_size, low_conf, trigger_fraction):
+            print(f"TTA: 最初の推論の検出 {len(base)} 個で十分なため、拡張画像は推論しません")
+            return [res]
+        detections.append(base)
+
+    with TRACER.stage("augment"):
+        views, params = augment_views(image, imgsz, scales, flip)
+    if adaptive:
+        # 倍率 1・反転なしの画像は最初の推論で済んでいる
+        rest = np.flatnonzero((params['scale'] != 1.0) | params['flip'])
+        if len(rest) == 0:
+            return [res]
+        views = [views[i] for i in rest]
+        params = {key: value[rest] for key, value in params.items()}
+
+    with TRACER.stage("predict", images=len(views)):
+        results = model.predict(source=views, imgsz=views[0].shape[0], batch=len(views), **predict_kwargs)
+    data = [res.boxes.data[:, :6].cpu().numpy() for res in results]
+    view_ids = np.repeat(np.arange(len(data)), [len(d) for d in data])
+    with TRACER.stage("deaugment", boxes=len(view_ids)):
+        detections.append(deaugment_boxes(np.concatenate(data), view_ids, params))
+
+    n_views = len(views) + (1 if adaptive else 0)
+    data = np.concatenate(detections)
+    with TRACER.stage("wbf", boxes=len(data)):
+        boxes, scores, labels = weighted_box_fusion(data[:, :4], data[:, 4], data[:, 5], n_views, wbf_iou)
+    fused = torch.from_numpy(np.column_stack([boxes, scores, labels]).astype(np.float32))
+    print(f"TTA: {n_views} 枚の拡張画像の検出 {len(data)} 個 → 統合後 {len(fused)} 個")
+    return [Results(image, path=str(image_path), names=model.names, boxes=fused)]
@@ -0,0 +1,178 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import freeze_support
+from pathlib import Path
+
+from profiling import TRACER
+from verification.vertools.confusion_matrix_detect import (cached_detection_metrics, compute_detection_metrics,
+                                                           read_xyxy_from_txt)
+from verification.vertools.prediction_store import PredictionStore, PredictionWriter
+from verification.vertools.result_cache import CACHE_DIR, ResultCache
+
+
+def _init_worker(threads: int) -> None:
+    """
+    ワーカープロセスの初期化
+    プロセス数 × スレッド数がコア数を超えないよう、torch/BLAS のスレッド数を制限する
+    """
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        # torch が無い（評価のみ）場合や、既にスレッドが起動している場合はそのまま続ける
+        pass
+
+
+def _gt_boxes(labels_dir: Path, stem: str):
+    label_path = Path(labels_dir) / f"{stem}.txt"
+    return read_xyxy_from_txt(label_path)
+
+
+def _predict_fold(checkpoint: Path, image_paths: list[Path], labels_dir: Path, iou_threshold: float,
+                  batch_size: int, predict_kwargs: dict) -> dict:
+    """
+    1つの fold を推論し、画像ごとの検出結果と評価指標を返す（ワーカープロセスで実行される）
+    """
+    from batch_predict import load_fold_model, predict_in_batches
+
+    model, load_time = load_fold_model(checkpoint)
+    infer_time = 0.0
+    images = {}
+    for chunk, results, elapsed in predict_in_batches(model, image_paths, batch_size, **predict_kwargs):
+        infer_time += elapsed
+        for img_path, r in zip(chunk, results):
+            boxes = r.boxes.xyxy.cpu().numpy()
+            with TRACER.stage("evaluate", image=img_path.stem):
+                metrics = compute_detection_metrics(boxes, _gt_boxes(labels_dir, img_path.stem), iou_threshold)
+            images[img_path.stem] = {
+                'boxes': boxes,
+                'conf': r.boxes.conf.cpu().numpy(),
+                'cls': r.boxes.cls.cpu().numpy(),
+                'names': r.names,
+                'metrics': metrics,
+            }
+    # ワーカーで記録した計測結果は親プロセスに返してまとめて書き出す
+    return {'fold': checkpoint.parent.parent.name, 'load_time': load_time, 'inference_time': infer_time,
+            'images': images, 'trace': TRACER.drain()}
+
+
+def _evaluate_stored(store_dir: Path, image_name: str, labels_dir: Path, iou_threshold: float,
+                     cache_dir: Path = None) -> dict:
+    """
+    推論済みのストアから1枚分を読み込み、評価指標だけを計算する（ワーカープロセスで実行される）
+    cache_dir を指定した場合は、予測とラベルが前回と同じならキャッシュした評価指標を返す
+    """
+    pred_boxes = PredictionStore(store_dir).get(image_name)['boxes']
+    with TRACER.stage("evaluate", image=image_name):
+        if cache_dir is None:
+            metrics = compute_detection_metrics(pred_boxes, _gt_boxes(labels_dir, image_name), iou_threshold)
+        else:
+            with ResultCache(cache_dir) as cache:
+                metrics = cached_detection_metrics(cache, pred_boxes, Path(labels_dir) / f"{image_name}.txt",
+                                                   iou_threshold)
+    return {'fold': image_name, 'images': {image_name: {'metrics': metrics}}, 'trace': TRACER.drain()}
+
+
+def default_workers(n_jobs: int) -> int:
+    """
+    ジョブ数と CPU コア数から、既定のワーカー数を決める
+    """
+    return max(1, min(n_jobs, os.cpu_count() or 1))
+
+
+def evaluate_folds_parallel(images_dir: Path,
+                            labels_dir: Path,
+                            runs_dir: Path = Path("runs/BoundingBox"),
+                            store_dir: Path = Path("predict/store"),
+                            iou_threshold: float = 0.6,
+                            workers: int = None,
+                            threads_per_worker: int = None,
+                            batch_size: int = 8,
+                            **predict_kwargs) -> list[dict]:
+    """
+    leave-one-out の各 fold の推論と評価をプロセスプールで並列に実行する
+    結果は fold 名の順に並べ直し、その順で列形式のストアへ書き出す
+
+    :param images_dir: 画像ディレクトリ
+    :param labels_dir: GT ラベル（YOLO 形式の txt）のディレクトリ
+    :param runs_dir: no_<画像名> のフォルダが並ぶディレクトリ
+    :param store_dir: 推論結果の出力先
+    :param iou_threshold: 評価に使う IoU の閾値
+    :param workers: プロセス数（省略時は fold 数と CPU コア数の小さい方）
+    :param threads_per_worker: 1プロセスあたりの torch スレッド数（省略時は コア数 / プロセス数）
+    :param batch_size: 1回の推論でまとめる画像の枚数
+    :param predict_kwargs: model.predict に渡す引数
+    :return: fold ごとの結果のリスト（fold 名順）
+    """
+    from batch_predict import fold_jobs
+
+    jobs = fold_jobs(images_dir, runs_dir)
+    workers = workers or default_workers(len(jobs))
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+    print(f"fold 数: {len(jobs)}, プロセス数: {workers}, プロセスあたりのスレッド数: {threads_per_worker}")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+        futures = [
+            pool.submit(_predict_fold, checkpoint, image_paths, labels_dir, iou_threshold, batch_size, predict_kwargs)
+            for checkpoint, image_paths in jobs.items()
+        ]
+        # 完了順ではなく投入順（fold 名順）で結果を受け取る
+        fold_results = [future.result() for future in futures]
+    for fold in fold_results:
+        TRACER.extend(fold.pop('trace'))
+
+    with PredictionWriter(store_dir) as writer:
+        for fold in fold_results:
+            for name, image in fold['images'].items():
+                writer.add(name, image['boxes'], image['conf'], image['cls'], names=image['names'])
+
+    print(f"全処理時間: {time.perf_counter() - start:.2f}秒")
+    return fold_results
+
+
+def evaluate_store_parallel(store_dir: Path,
+                            labels_dir: Path,
+                            iou_threshold: float = 0.6,
+                            workers: int = None,
+                            cache_dir: Path = CACHE_DIR) -> list[dict]:
+    """
+    推論済みのストアに含まれる全画像の評価指標を、プロセスプールで並列に計算する
+
+    :param store_dir: 推論結果のストア
+    :param labels_dir: GT ラベルのディレクトリ
+    :param iou_threshold: 評価に使う IoU の閾値
+    :param workers: プロセス数
+    :param cache_dir: 評価指標のキャッシュの保存先。None でキャッシュを使わない
+    :return: 画像ごとの結果のリスト（ストア内の画像順）
+    """
+    image_names = PredictionStore(store_dir).images
+    workers = workers or default_workers(len(image_names))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(1,)) as pool:
+        futures = [pool.submit(_evaluate_stored, store_dir, name, labels_dir, iou_threshold, cache_dir)
+                   for name in image_names]
+        results = [future.result() for future in futures]
+    for result in results:
+        TRACER.extend(result.pop('trace'))
+    return results
+
+
+if __name__ == '__main__':
+    freeze_support()  # Windows でのマルチプロセシングのサポート
+
+    dataset_source = Path("YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f")
+    results = evaluate_folds_parallel(dataset_source / "images",
+                                      dataset_source / "labels",
+                                      runs_dir=Path("runs/BoundingBox"),
+                                      store_dir=Path("predict/store"),
+                                      iou_threshold=0.6,
+                                      conf=0.7,
+                                      iou=0.2,
+                                      device='cpu')
+    for fold in results:
+        for name, image in fold['images'].items():
+            print(f"{name}:", image['metrics'])
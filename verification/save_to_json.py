@@ -1,33 +1,22 @@
-from ultralytics import YOLO
 from pathlib import Path
-import json
 
-images = Path("YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/images")
-
-for img_path in images.iterdir():
-    # モデルの読み込み
-    print(f"使用画像：{img_path}, 使用モデル：no_{img_path.stem}/weights/best.pt")
-    
-    model = YOLO(Path(f"runs/BoundingBox/no_{img_path.stem}/weights/best.pt"))
-    results = model.predict(img_path,
-                save=True,  # 結果の保存
-                save_txt=False,  # テキストファイルとして保存する
-                save_conf=False,  # テキストファイル信頼度情報がを書き込む
-                conf=0.7,
-                iou=0.2,
-                device='cpu',
-                )
+from batch_predict import run_leave_one_out
 
-    json_list = []
-
-    for r in results:
-        json_list.append(json.loads(r.to_json()))
-        
-    with open(Path(f"predict/result_no_{img_path.stem}.json"), "w") as f:
-        json.dump(json_list, f, indent=2)
+# リポジトリのルートから python -m verification.save_to_json で実行する
+images = Path("YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/images")
 
-# 一枚のみの時は、以下のようにしても良い
-# for r in results:
-#     json_data = r.to_json()
-#     with open(Path("predict/result.json"), "w") as f:
-#         f.write(json_data)
+# 推論結果は画像ごとの JSON ではなく、列形式のストア predict/store にまとめて書き出す
+# 既存の predict/result_no_*.json は python -m verification.vertools.prediction_store で変換できる
+# 各 no_<画像名> のモデルは一度だけ読み込み、割り当てられた画像をまとめて推論する
+# python export_backend.py で ONNX に変換済みの fold は、自動的に変換済みのモデルで推論する
+run_leave_one_out(images,
+                  runs_dir=Path("runs/BoundingBox"),
+                  store_dir=Path("predict/store"),
+                  batch_size=8,
+                  backend="auto",  # "torch" で常に best.pt を使う
+                  cache_dir=Path("predict/cache"),  # 前回と同じモデル・画像・引数の結果を再利用する（None で無効）
+                  save=True,  # 描画画像を predict/annotated に保存する（キャッシュ済みの画像は保存済みの検出から描画する）
+                  conf=0.7,
+                  iou=0.2,
+                  device='cpu',
+                  )
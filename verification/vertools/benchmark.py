@@ -0,0 +1,167 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from verification.vertools.confusion_matrix_detect import (compute_detection_metrics, polygon_to_xyxy,
+                                                           read_polygon_from_txt, read_xyxy_from_json)
+
+# 1枚あたりのボックス数（既定のワークロード）
+DEFAULT_DENSITIES = (10, 100, 1000, 10000)
+# 計測する処理の名前（結果の JSON のキー）
+STAGES = ("read_polygon_from_txt", "polygon_to_xyxy", "read_xyxy_from_json", "compute_detection_metrics", "total")
+
+
+def make_synthetic_image(rng: np.random.Generator, n_boxes: int, image_size: int = 512,
+                         n_vertices: int = 8) -> tuple[str, list]:
+    """
+    1枚分の合成データを作る
+    GT は粒子を模した多角形（YOLO セグメンテーション形式）、予測は GT を少しずらしたボックスと誤検出の混在
+
+    :return: (GT ラベルファイルの内容, save_to_json 形式の予測リスト)
+    """
+    # 粒子の中心と半径（正規化座標）
+    centers = rng.uniform(0.02, 0.98, size=(n_boxes, 2))
+    radii = rng.uniform(3, 15, size=(n_boxes, 1)) / image_size
+    angles = np.linspace(0, 2 * np.pi, n_vertices, endpoint=False)
+    xs = np.clip(centers[:, :1] + radii * np.cos(angles), 0, 1)
+    ys = np.clip(centers[:, 1:] + radii * np.sin(angles), 0, 1)
+    polygons = np.empty((n_boxes, 2 * n_vertices))
+    polygons[:, 0::2] = xs
+    polygons[:, 1::2] = ys
+    label_text = "".join("0 " + " ".join(f"{v:.6f}" for v in poly) + "\n" for poly in polygons)
+
+    # 予測: 9割は GT の近く、残りは誤検出
+    boxes = np.stack([xs.min(1), ys.min(1), xs.max(1), ys.max(1)], axis=1) * image_size
+    n_fp = n_boxes // 10
+    boxes = boxes[rng.permutation(n_boxes)[:n_boxes - n_fp]] + rng.normal(0, 1.0, size=(n_boxes - n_fp, 4))
+    fp_xy = rng.uniform(0, image_size - 20, size=(n_fp, 2))
+    fp = np.concatenate([fp_xy, fp_xy + rng.uniform(5, 20, size=(n_fp, 2))], axis=1)
+    boxes = np.concatenate([boxes, fp])
+    conf = rng.uniform(0.3, 1.0, size=len(boxes))
+    preds = [[
+        {"name": "y2o3", "class": 0, "confidence": round(float(c), 5),
+         "box": {"x1": float(b[0]), "y1": float(b[1]), "x2": float(b[2]), "y2": float(b[3])}}
+        for b, c in zip(boxes, conf)
+    ]]
+    return label_text, preds
+
+
+def write_workload(work_dir: Path, density: int, n_images: int, seed: int = 0) -> list[tuple[Path, Path]]:
+    """
+    合成データをファイルに書き出す
+
+    :return: [(GT ラベルのパス, 予測 JSON のパス), ...]
+    """
+    rng = np.random.default_rng(seed + density)
+    pairs = []
+    for i in range(n_images):
+        label_text, preds = make_synthetic_image(rng, density)
+        label_path = work_dir / f"labels/synth_{density}_{i}.txt"
+        json_path = work_dir / f"predict/result_no_synth_{density}_{i}.json"
+        label_path.parent.mkdir(parents=True, exist_ok=True)
+        json_path.parent.mkdir(parents=True, exist_ok=True)
+        label_path.write_text(label_text)
+        with open(json_path, "w") as f:
+            json.dump(preds, f, indent=2)
+        pairs.append((label_path, json_path))
+    return pairs
+
+
+def time_workload(pairs: list[tuple[Path, Path]], iou_threshold: float = 0.6) -> dict[str, float]:
+    """
+    全画像について評価の流れを一通り実行し、処理ごとの合計時間を計測する
+    """
+    times = dict.fromkeys(STAGES, 0.0)
+    for label_path, json_path in pairs:
+        t0 = time.perf_counter()
+        polygons = read_polygon_from_txt(label_path)
+        t1 = time.perf_counter()
+        gt_boxes = polygon_to_xyxy(polygons)
+        t2 = time.perf_counter()
+        pred_boxes = read_xyxy_from_json(json_path)
+        t3 = time.perf_counter()
+        compute_detection_metrics(pred_boxes, gt_boxes, iou_threshold)
+        t4 = time.perf_counter()
+        times["read_polygon_from_txt"] += t1 - t0
+        times["polygon_to_xyxy"] += t2 - t1
+        times["read_xyxy_from_json"] += t3 - t2
+        times["compute_detection_metrics"] += t4 - t3
+        times["total"] += t4 - t0
+    return times
+
+
+def run_benchmarks(densities=DEFAULT_DENSITIES, n_images: int = 10, repeat: int = 3, seed: int = 0) -> dict:
+    """
+    各密度のワークロードを repeat 回計測し、処理ごとの最小時間（秒）を返す
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for density in densities:
+            pairs = write_workload(Path(tmp), density, n_images, seed)
+            runs = [time_workload(pairs) for _ in range(repeat)]
+            results[str(density)] = {
+                stage: {"min": min(r[stage] for r in runs), "median": statistics.median(r[stage] for r in runs)}
+                for stage in STAGES
+            }
+            print(f"boxes/image={density:>6}, images={n_images}: "
+                  + ", ".join(f"{stage}={results[str(density)][stage]['min'] * 1000:.1f}ms" for stage in STAGES))
+    return {
+        "meta": {"n_images": n_images, "repeat": repeat, "seed": seed,
+                 "python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()},
+        "results": results,
+    }
+
+
+def check_regressions(current: dict, baseline: dict, tolerance: float = 0.25, min_seconds: float = 0.005) -> list[str]:
+    """
+    基準の結果と比べて、(1 + tolerance) 倍より遅くなった処理を列挙する
+    min_seconds 未満の計測値はばらつきが大きいため比較しない
+
+    :return: 退行した処理の説明のリスト（空なら問題なし）
+    """
+    regressions = []
+    for density, stages in current["results"].items():
+        for stage, value in stages.items():
+            base = baseline.get("results", {}).get(density, {}).get(stage)
+            if base is None or base["min"] < min_seconds:
+                continue
+            if value["min"] > base["min"] * (1 + tolerance):
+                regressions.append(f"boxes/image={density} {stage}: {base['min']:.4f}s → {value['min']:.4f}s")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="検証ツールの処理時間を合成データで計測する")
+    parser.add_argument("--densities", type=int, nargs="+", default=list(DEFAULT_DENSITIES), help="1枚あたりのボックス数")
+    parser.add_argument("--images", type=int, default=10, help="密度ごとの画像枚数")
+    parser.add_argument("--repeat", type=int, default=3, help="計測の繰り返し回数")
+    parser.add_argument("--output", type=Path, default=None, help="結果を書き出す JSON ファイル")
+    parser.add_argument("--baseline", type=Path, default=None, help="比較する基準の結果 JSON")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="許容する遅延の割合")
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.densities, args.images, args.repeat)
+    if args.output:
+        args.output.write_text(json.dumps(current, indent=2), encoding="utf-8")
+        print(f"結果を {args.output} に保存しました。")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = check_regressions(current, baseline, args.tolerance)
+        for line in regressions:
+            print(f"性能低下: {line}")
+        if regressions:
+            return 1
+        print("性能低下は見つかりませんでした。")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,40 +1,46 @@
 from pathlib import Path
 import json
 
+import numpy as np
+
+from verification.vertools.label_cache import labels_to_xyxy, read_label_arrays
+from verification.vertools.result_cache import array_digest
+from verification.vertools.spatial_index import GridIndex, match_detections_indexed
+
+# 予測数 × GT 数がこれを超える場合は、IoU 行列を作らず空間インデックスで候補を絞る
+DENSE_PAIR_LIMIT = 250_000
+
 def read_polygon_from_txt(file_path) -> list[list[float]]:
     """
     YOLO形式のラベルファイルを読み込む
     :param file_path: ラベルファイルのパス
-    :return: ラベル情報のリスト
+    :return: ラベル情報のリスト（クラス番号を除いた座標の列）
     """
-    with open(file_path, "r") as f:
-        lines = f.readlines()
-        # 前後の空白を削除し[2:-1]、floatに変換する
-        return [list(map(float, line[2:-1].split(" "))) for line in lines]
-    
-def polygon_to_xyxy(polygons:list, image_width=512, image_height=512) -> list[tuple[float, float, float, float]]:
+    arrays = read_label_arrays(file_path)
+    coords, offsets = arrays['coords'], arrays['offsets']
+    return [coords[start:stop].tolist() for start, stop in zip(offsets[:-1], offsets[1:])]
+
+def read_xyxy_from_txt(file_path, image_width=512, image_height=512) -> np.ndarray:
+    """
+    YOLO形式のラベルファイルから、各多角形の外接ボックスを直接求める
+    （read_polygon_from_txt → polygon_to_xyxy と同じ結果を、リストを作らずに得る）
+    :param file_path: ラベルファイルのパス
+    :return: (N, 4) の xyxy ボックス
+    """
+    return labels_to_xyxy(read_label_arrays(file_path), image_width, image_height)
+
+def polygon_to_xyxy(polygons:list, image_width=512, image_height=512) -> np.ndarray:
     """
     xyxy形式で出力される
+    :param polygons: read_polygon_from_txt の出力
+    :return: (N, 4) の xyxy ボックス
     """
-    result = []
-    
-    for polygon in polygons:
-        # 2次元の座標を取得
-        xs = polygon[::2]
-        ys = polygon[1::2]
-        
-        # 座標を512x512の画像サイズに変換
-        x_coords = [x * image_width for x in xs]
-        y_coords = [y * image_height for y in ys]
-        
-        # 最小値と最大値を取得
-        min_x = min(x_coords)
-        min_y = min(y_coords)
-        max_x = max(x_coords)
-        max_y = max(y_coords)
-        
-        result.append((min_x, min_y, max_x, max_y))
-    return result
+    counts = [len(polygon) for polygon in polygons]
+    arrays = {
+        'coords': np.fromiter((v for polygon in polygons for v in polygon), dtype=np.float64, count=sum(counts)),
+        'offsets': np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]).astype(np.int64),
+    }
+    return labels_to_xyxy(arrays, image_width, image_height)
 
 def compute_iou(box1, box2) -> float:
     """
@@ -78,6 +84,116 @@ def read_xyxy_from_json(json_path: Path) -> list[tuple[float, float, float, floa
         
     return boxes
 
+def compute_iou_matrix(boxes1, boxes2) -> np.ndarray:
+    """
+    2つのボックス集合の全ペアの IoU をまとめて計算する
+    compute_iou と同じ式を NumPy のブロードキャストで評価する
+
+    :param boxes1: (N, 4) の配列、または (x1, y1, x2, y2) のリスト
+    :param boxes2: (M, 4) の配列、または (x1, y1, x2, y2) のリスト
+    :return: (N, M) の IoU 行列
+    """
+    b1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    b2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+
+    # 交差部分の座標 (N, M)
+    xi1 = np.maximum(b1[:, None, 0], b2[None, :, 0])
+    yi1 = np.maximum(b1[:, None, 1], b2[None, :, 1])
+    xi2 = np.minimum(b1[:, None, 2], b2[None, :, 2])
+    yi2 = np.minimum(b1[:, None, 3], b2[None, :, 3])
+
+    # 交差部分の面積
+    intersection = np.clip(xi2 - xi1, 0, None) * np.clip(yi2 - yi1, 0, None)
+
+    # 各ボックスの面積
+    area1 = (b1[:, 2] - b1[:, 0]) * (b1[:, 3] - b1[:, 1])
+    area2 = (b2[:, 2] - b2[:, 0]) * (b2[:, 3] - b2[:, 1])
+
+    # IoUの計算（union が 0 のペアは 0 とする）
+    union = area1[:, None] + area2[None, :] - intersection
+    iou = np.zeros_like(union)
+    np.divide(intersection, union, out=iou, where=union != 0)
+    return iou
+
+def match_detections(pred_boxes, gt_boxes, iou_thresholds=(0.5,), iou_matrix=None,
+                     index: GridIndex = None) -> dict[str, np.ndarray]:
+    """
+    予測ボックスを先頭から順に、未マッチの GT のうち IoU 最大のものと貪欲にマッチさせる
+    IoU 行列は一度だけ計算し、複数の閾値についてまとめてマッチングを行う
+    ボックス数が多い場合（または index を渡した場合）は、空間インデックスで近くの GT だけと比較する
+
+    :param pred_boxes: 予測ボックス (P, 4)
+    :param gt_boxes: グラウンドトゥルースボックス (G, 4)
+    :param iou_thresholds: IoU の閾値のリスト (T,)
+    :param iou_matrix: 計算済みの (P, G) IoU 行列（省略時はここで計算）
+    :param index: gt_boxes から作成済みの GridIndex
+    :return: {
+        'thresholds': 閾値 (T,),
+        'tp', 'fp', 'fn': 閾値ごとの個数 (T,),
+        'pred_match': 各予測がマッチした GT のインデックス、未マッチは -1 (T, P)
+    }
+    """
+    if iou_matrix is None:
+        if index is None and len(pred_boxes) * len(gt_boxes) > DENSE_PAIR_LIMIT:
+            index = GridIndex(gt_boxes)
+        if index is not None:
+            return match_detections_indexed(pred_boxes, iou_thresholds=iou_thresholds, index=index)
+
+    thresholds = np.atleast_1d(np.asarray(iou_thresholds, dtype=np.float64))
+    if iou_matrix is None:
+        iou_matrix = compute_iou_matrix(pred_boxes, gt_boxes)
+    n_pred, n_gt = iou_matrix.shape
+    n_thr = len(thresholds)
+
+    matched_gt = np.zeros((n_thr, n_gt), dtype=bool)
+    pred_match = np.full((n_thr, n_pred), -1, dtype=np.int64)
+    tp = np.zeros(n_thr, dtype=np.int64)
+    rows = np.arange(n_thr)
+
+    for i in range(n_pred):
+        ious = iou_matrix[i]
+        if n_gt == 0 or not ious.any():
+            # どの GT とも重ならない予測（閾値 0 のときのみ TP になり得る）
+            hit = thresholds <= 0
+            tp += hit
+            continue
+
+        # 閾値ごとにマッチ済みの GT を除外し、IoU 最大の GT を選ぶ（同値は先頭を優先）
+        masked = np.where(matched_gt, -1.0, ious[None, :])
+        best_j = masked.argmax(axis=1)
+        best_iou = np.maximum(masked[rows, best_j], 0.0)
+
+        hit = best_iou >= thresholds
+        tp += hit
+        claim = hit & (best_iou > 0)
+        matched_gt[rows[claim], best_j[claim]] = True
+        pred_match[rows[claim], i] = best_j[claim]
+
+    return {
+        'thresholds': thresholds,
+        'tp': tp,
+        'fp': n_pred - tp,
+        'fn': n_gt - tp,
+        'pred_match': pred_match
+    }
+
+def _summarize_counts(tp: int, fp: int, fn: int) -> dict[str, float]:
+    """
+    TP/FP/FN から適合率・再現率・F1 スコアを計算する
+    """
+    precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
+    recall    = tp / (tp + fn) if (tp + fn) > 0 else 0.0
+    f1        = (2 * precision * recall / (precision + recall)) if (precision + recall) > 0 else 0.0
+
+    return {
+        'tp': tp,
+        'fp': fp,
+        'fn': fn,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1
+    }
+
 def compute_detection_metrics(pred_boxes: list[tuple[float, float, float, float]],
                               gt_boxes: list[tuple[float, float, float, float]],
                               iou_threshold: float = 0.5) -> dict[str, float]:
@@ -96,39 +212,22 @@ def compute_detection_metrics(pred_boxes: list[tuple[float, float, float, float]
         'f1': F1 スコア
     }
     """
-    matched_gt = set()
-    tp = 0
+    return compute_detection_metrics_multi(pred_boxes, gt_boxes, [iou_threshold])[iou_threshold]
 
-    # 予測ボックスごとに、未マッチの GT と照合
-    for pred in pred_boxes:
-        best_iou = 0
-        best_j = -1
-        for j, gt in enumerate(gt_boxes):
-            if j in matched_gt:
-                continue
-            iou = compute_iou(pred, gt)
-            if iou > best_iou:
-                best_iou = iou
-                best_j = j
-
-        if best_iou >= iou_threshold:
-            tp += 1
-            matched_gt.add(best_j)
-
-    fp = len(pred_boxes) - tp
-    fn = len(gt_boxes) - tp
-
-    precision = tp / (tp + fp) if (tp + fp) > 0 else 0.0
-    recall    = tp / (tp + fn) if (tp + fn) > 0 else 0.0
-    f1        = (2 * precision * recall / (precision + recall)) if (precision + recall) > 0 else 0.0
+def compute_detection_metrics_multi(pred_boxes, gt_boxes, iou_thresholds) -> dict[float, dict[str, float]]:
+    """
+    複数の IoU 閾値について評価指標を一度に計算する
+    IoU 行列の計算は一回だけで済む
 
+    :param pred_boxes: 予測ボックス (P, 4)
+    :param gt_boxes: グラウンドトゥルースボックス (G, 4)
+    :param iou_thresholds: IoU の閾値のリスト
+    :return: {閾値: compute_detection_metrics と同じ形式の辞書}
+    """
+    matches = match_detections(pred_boxes, gt_boxes, iou_thresholds)
     return {
-        'tp': tp,
-        'fp': fp,
-        'fn': fn,
-        'precision': precision,
-        'recall': recall,
-        'f1': f1
+        thr: _summarize_counts(int(tp), int(fp), int(fn))
+        for thr, tp, fp, fn in zip(iou_thresholds, matches['tp'], matches['fp'], matches['fn'])
     }
 
 
@@ -139,10 +238,51 @@ def compute_detection_metrics(pred_boxes: list[tuple[float, float, float, float]
 
 # print(compute_detection_metrics(pred_boxes, gt_boxes, iou_threshold=0.5))
 
-for i in range(1, 11):
-    pred_boxes = read_xyxy_from_json(Path(f"predict/result_no_spcdr_{i}.json"))
-    gt_boxes = read_polygon_from_txt(Path(f"YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/labels/spcdr_{i}.txt"))
-    gt_boxes = polygon_to_xyxy(gt_boxes)
+def cached_detection_metrics(cache, pred_boxes, label_path, iou_threshold: float = 0.5) -> dict[str, float]:
+    """
+    compute_detection_metrics の結果を、予測ボックスとラベルファイルの内容・閾値をキーにしてキャッシュする
+    同じ入力で再実行した場合は、ラベルの読み込みもマッチングも行わない
+
+    :param cache: result_cache.ResultCache
+    :param pred_boxes: 予測ボックス (P, 4)
+    :param label_path: GT ラベル（YOLO 形式の txt）のパス
+    :param iou_threshold: IoU の閾値
+    :return: compute_detection_metrics と同じ形式の辞書
+    """
+    pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+    key = cache.key("detection_metrics", array_digest(pred_boxes), cache.file_digest(label_path), float(iou_threshold))
+    metrics = cache.get_json(key)
+    if metrics is None:
+        metrics = compute_detection_metrics(pred_boxes, read_xyxy_from_txt(label_path), iou_threshold)
+        cache.put_json(key, metrics, kind="metrics")
+    return metrics
+
+def read_xyxy_from_store(store, image_name: str) -> np.ndarray:
+    """
+    列形式のストア（prediction_store.PredictionStore）から1枚分の xyxy ボックスを取り出す
+    :param store: PredictionStore
+    :param image_name: 画像名（例: spcdr_1）
+    :return: (K, 4) の配列
+    """
+    return store.get(image_name)['boxes']
+
+
+if __name__ == "__main__":
+    from verification.vertools.prediction_store import PredictionStore
+    from verification.vertools.result_cache import ResultCache
+
+    # 列形式のストアがあればそちらを使い、なければ従来の JSON を読む
+    store = PredictionStore(Path("predict/store")) if Path("predict/store/meta.json").exists() else None
+    # 予測ボックスとラベルが前回と同じ画像は、キャッシュした評価指標を使う
+    cache = ResultCache()
+
+    for i in range(1, 11):
+        if store is not None:
+            pred_boxes = read_xyxy_from_store(store, f"spcdr_{i}")
+        else:
+            pred_boxes = read_xyxy_from_json(Path(f"predict/result_no_spcdr_{i}.json"))
+        label_path = Path(f"YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/labels/spcdr_{i}.txt")
 
-    print(f"spcdr_{i}:", end=" ")
-    print(compute_detection_metrics(pred_boxes, gt_boxes, iou_threshold=0.6))
+        print(f"spcdr_{i}:", end=" ")
+        print(cached_detection_metrics(cache, pred_boxes, label_path, iou_threshold=0.6))
+    cache.close()
@@ -0,0 +1,101 @@
+from pathlib import Path
+import os
+import zipfile
+
+import numpy as np
+
+# キャッシュ形式を変えた場合はこの番号を上げる（古いキャッシュは読み直される）
+CACHE_VERSION = 1
+
+
+def parse_label_text(text: str) -> dict[str, np.ndarray]:
+    """
+    YOLO 形式（検出・セグメンテーション）のラベルファイルの内容をまとめて配列に変換する
+    クラス番号の桁数や、最終行の改行の有無には依存しない
+    座標を持たない行は読み飛ばす
+
+    :param text: ラベルファイルの内容
+    :return: {
+        'classes': 各行のクラス番号 (N,),
+        'coords': 全行の座標を連結したもの (K,),
+        'offsets': 各行の座標の開始位置 (N + 1,)（i 行目は coords[offsets[i]:offsets[i + 1]]）
+    }
+    """
+    rows = [line.split() for line in text.splitlines()]
+    rows = [tokens for tokens in rows if len(tokens) > 2]
+    counts = np.fromiter((len(tokens) - 1 for tokens in rows), dtype=np.int64, count=len(rows))
+    # 文字列から数値への変換は NumPy に一括で任せる
+    classes = np.array([tokens[0] for tokens in rows], dtype=np.float64).astype(np.int64)
+    coords = np.array([value for tokens in rows for value in tokens[1:]], dtype=np.float64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return {'classes': classes, 'coords': coords, 'offsets': offsets}
+
+
+def _cache_path(label_path: Path) -> Path:
+    # ラベルと同じフォルダに隠しファイルとして置く（ultralytics は *.txt しか読まない）
+    return label_path.with_name(f".{label_path.name}.npz")
+
+
+def read_label_arrays(label_path, use_cache: bool = True) -> dict[str, np.ndarray]:
+    """
+    ラベルファイルを parse_label_text の形式で読み込む
+    読み込んだ結果はラベルの横にバイナリのキャッシュとして保存し、
+    ファイルの更新時刻とサイズが変わっていなければ次回からはキャッシュを使う
+
+    :param label_path: ラベルファイルのパス
+    :param use_cache: False の場合はキャッシュを読み書きしない
+    """
+    label_path = Path(label_path)
+    stat = label_path.stat()
+    stamp = np.array([CACHE_VERSION, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+    cache_path = _cache_path(label_path)
+
+    if use_cache and cache_path.exists():
+        try:
+            with np.load(cache_path) as data:
+                if np.array_equal(data['stamp'], stamp):
+                    return {key: data[key] for key in ('classes', 'coords', 'offsets')}
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # 壊れたキャッシュ（書き込み途中で止まったものなど）は読み直して上書きする
+            pass
+
+    arrays = parse_label_text(label_path.read_text(encoding='utf-8'))
+    if use_cache:
+        try:
+            # 書き込み途中で落ちても壊れたキャッシュが残らないように置き換える
+            tmp_path = cache_path.with_name(cache_path.name + f'.{os.getpid()}.tmp')
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, stamp=stamp, **arrays)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # 書き込めない場所（読み取り専用のデータセットなど）ではキャッシュしない
+            pass
+    return arrays
+
+
+def labels_to_xyxy(arrays: dict[str, np.ndarray], image_width=512, image_height=512) -> np.ndarray:
+    """
+    各行の多角形の外接ボックスをまとめて計算する
+
+    :param arrays: read_label_arrays / parse_label_text の出力
+    :return: (N, 4) の xyxy ボックス（画素単位）
+    """
+    coords, offsets = arrays['coords'], arrays['offsets']
+    n = len(offsets) - 1
+    if n == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+
+    # 各値が行内で何番目か（偶数: x, 奇数: y）
+    counts = np.diff(offsets)
+    position = np.arange(len(coords)) - np.repeat(offsets[:-1], counts)
+    is_x = position % 2 == 0
+    starts = offsets[:-1]
+
+    xs = coords * image_width
+    ys = coords * image_height
+    return np.stack([
+        np.minimum.reduceat(np.where(is_x, xs, np.inf), starts),
+        np.minimum.reduceat(np.where(is_x, np.inf, ys), starts),
+        np.maximum.reduceat(np.where(is_x, xs, -np.inf), starts),
+        np.maximum.reduceat(np.where(is_x, -np.inf, ys), starts),
+    ], axis=1)
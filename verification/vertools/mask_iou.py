@@ -0,0 +1,181 @@
+import hashlib
+import os
+import zipfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from verification.vertools.confusion_matrix_detect import _summarize_counts, read_polygon_from_txt
+from verification.vertools.spatial_index import GridIndex, greedy_match_pairs
+
+# ラスタライズした GT マスクのキャッシュ先
+MASK_CACHE_DIR = Path("predict/.mask_cache")
+
+
+class MaskSet:
+    """
+    1枚の画像に含まれるインスタンスマスクの集合
+    画像全体のマスクは持たず、各マスクを自身のボックスで切り出した bool 配列として保持する
+    """
+
+    def __init__(self, boxes: np.ndarray, crops: list[np.ndarray]):
+        """
+        :param boxes: (N, 4) の画素単位の [x0, y0, x1, y1)（右下は含まない）
+        :param crops: 各マスクをボックスで切り出した (y1 - y0, x1 - x0) の bool 配列
+        """
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.crops = crops
+        self.areas = np.array([int(c.sum()) for c in crops], dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.crops)
+
+    @classmethod
+    def from_polygons(cls, polygons: list[list[float]], width: int = 512, height: int = 512) -> "MaskSet":
+        """
+        YOLO 形式の正規化済み多角形をラスタライズする
+        座標の数が奇数の行は最後の値を捨て、点が 1 つも無い行は警告を出して飛ばす
+
+        :param polygons: read_polygon_from_txt の出力
+        :param width: 画像の幅
+        :param height: 画像の高さ
+        """
+        boxes = []
+        crops = []
+        for polygon in polygons:
+            points = np.asarray(polygon[:len(polygon) // 2 * 2], dtype=np.float64).reshape(-1, 2) * (width, height)
+            if len(points) == 0:
+                print(f"警告: 座標が {len(polygon)} 個しかない多角形を飛ばします")
+                continue
+            x0, y0 = np.clip(np.floor(points.min(axis=0)).astype(np.int64), 0, (width - 1, height - 1))
+            x1, y1 = np.clip(np.ceil(points.max(axis=0)).astype(np.int64) + 1, 1, (width, height))
+            canvas = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+            shifted = np.round(points - (x0, y0)).astype(np.int32)
+            cv2.fillPoly(canvas, [shifted], 1)
+            boxes.append((x0, y0, x1, y1))
+            crops.append(canvas.astype(bool))
+        return cls(np.array(boxes, dtype=np.int64).reshape(-1, 4), crops)
+
+    @classmethod
+    def from_dense(cls, masks: np.ndarray) -> "MaskSet":
+        """
+        (N, H, W) のマスク（ultralytics の results.masks.data など）から作る
+        """
+        boxes = []
+        crops = []
+        for mask in np.asarray(masks) > 0.5:
+            ys = np.flatnonzero(mask.any(axis=1))
+            xs = np.flatnonzero(mask.any(axis=0))
+            if len(xs) == 0:
+                boxes.append((0, 0, 0, 0))
+                crops.append(np.zeros((0, 0), dtype=bool))
+                continue
+            x0, x1, y0, y1 = xs[0], xs[-1] + 1, ys[0], ys[-1] + 1
+            boxes.append((x0, y0, x1, y1))
+            crops.append(mask[y0:y1, x0:x1].copy())
+        return cls(np.array(boxes, dtype=np.int64).reshape(-1, 4), crops)
+
+    def save(self, path: Path) -> None:
+        """
+        ビット単位に詰めて npz に保存する
+        書き込み途中で中断されても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+        """
+        path = Path(path)
+        packed = [np.packbits(c.reshape(-1)) for c in self.crops]
+        offsets = np.cumsum([0] + [len(p) for p in packed])
+        tmp_path = path.with_name(path.name + f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, boxes=self.boxes, offsets=offsets,
+                     bits=np.concatenate(packed) if packed else np.zeros(0, dtype=np.uint8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "MaskSet":
+        with np.load(path) as data:
+            boxes, offsets, bits = data['boxes'], data['offsets'], data['bits']
+        crops = []
+        for (x0, y0, x1, y1), start, stop in zip(boxes, offsets[:-1], offsets[1:]):
+            size = (y1 - y0) * (x1 - x0)
+            crops.append(np.unpackbits(bits[start:stop], count=size).astype(bool).reshape(y1 - y0, x1 - x0))
+        return cls(boxes, crops)
+
+
+def load_gt_masks(label_path: Path, width: int = 512, height: int = 512, cache_dir: Path = MASK_CACHE_DIR) -> MaskSet:
+    """
+    GT ラベルファイルを読み込んでラスタライズする
+    結果はラベルファイルのパス・更新時刻・サイズと画像サイズをキーにキャッシュする
+    キャッシュが壊れていて読めない場合は、ラベルファイルから作り直して上書きする
+    """
+    label_path = Path(label_path)
+    stat = label_path.stat()
+    key = hashlib.sha1(f"{label_path.resolve()}|{stat.st_mtime_ns}|{stat.st_size}|{width}x{height}".encode()).hexdigest()
+    cache_path = Path(cache_dir) / f"{label_path.stem}_{key[:16]}.npz"
+    if cache_path.exists():
+        try:
+            return MaskSet.load(cache_path)
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            pass
+
+    masks = MaskSet.from_polygons(read_polygon_from_txt(label_path), width, height)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    masks.save(cache_path)
+    return masks
+
+
+def mask_pair_iou(pred: MaskSet, gt: MaskSet, pi: np.ndarray, gj: np.ndarray) -> np.ndarray:
+    """
+    指定した組についてだけマスク IoU を計算する（共通部分は 2 つのボックスの重なり領域だけで数える）
+    """
+    ious = np.zeros(len(pi), dtype=np.float64)
+    for k, (i, j) in enumerate(zip(pi.tolist(), gj.tolist())):
+        px0, py0, px1, py1 = pred.boxes[i]
+        gx0, gy0, gx1, gy1 = gt.boxes[j]
+        x0, y0, x1, y1 = max(px0, gx0), max(py0, gy0), min(px1, gx1), min(py1, gy1)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        a = pred.crops[i][y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        b = gt.crops[j][y0 - gy0:y1 - gy0, x0 - gx0:x1 - gx0]
+        intersection = int(np.count_nonzero(a & b))
+        union = pred.areas[i] + gt.areas[j] - intersection
+        ious[k] = intersection / union if union > 0 else 0.0
+    return ious
+
+
+def match_masks(pred: MaskSet, gt: MaskSet, iou_thresholds=(0.5,)) -> dict:
+    """
+    マスク IoU で予測と GT を貪欲にマッチさせる（ボックスが重なる組だけを比較する）
+    戻り値は confusion_matrix_detect.match_detections と同じ形式
+    """
+    # 画素ボックスは右下を含まないため、面積が正の重なりがあれば共有する画素がある
+    index = GridIndex(gt.boxes)
+    pi, gj = index.candidate_pairs(pred.boxes)
+    ious = mask_pair_iou(pred, gt, pi, gj)
+    return greedy_match_pairs(pi, gj, ious, len(pred), len(gt), iou_thresholds)
+
+
+def compute_mask_metrics(pred: MaskSet, gt: MaskSet, iou_thresholds=(0.5,)) -> dict[float, dict[str, float]]:
+    """
+    マスク IoU による評価指標を計算する
+    戻り値は compute_detection_metrics_multi と同じ形式
+    """
+    matches = match_masks(pred, gt, iou_thresholds)
+    return {
+        thr: _summarize_counts(int(tp), int(fp), int(fn))
+        for thr, tp, fp, fn in zip(iou_thresholds, matches['tp'], matches['fp'], matches['fn'])
+    }
+
+
+if __name__ == "__main__":
+    from ultralytics import YOLO
+
+    # retina_masks=True で学習・推論したセグメンテーションモデルをマスク単位で評価する
+    model = YOLO("runs/segment/5d5_epochs_600/weights/best.pt")
+    dataset_source = Path("YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f")
+
+    for img_path in sorted((dataset_source / "images").iterdir()):
+        res = model.predict(img_path, conf=0.4, iou=0.5, device="cpu", retina_masks=True, verbose=False)[0]
+        height, width = res.orig_shape
+        pred = MaskSet.from_dense(res.masks.data.cpu().numpy()) if res.masks is not None else MaskSet([], [])
+        gt = load_gt_masks(dataset_source / "labels" / f"{img_path.stem}.txt", width, height)
+        print(f"{img_path.stem}:", compute_mask_metrics(pred, gt, [0.5, 0.75])[0.5])
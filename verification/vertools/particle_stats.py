@@ -0,0 +1,255 @@
+from pathlib import Path
+import argparse
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from verification.vertools.prediction_store import PredictionStore, write_columns
+
+# 検出結果（列形式のストア）から、Y2O3 析出物の大きさ・数密度・空間分布の統計量を計算する
+#
+# 全画像の粒子を 1 つの配列のまま扱い、画像ごとの集計は image_id を使った bincount で行う
+# 最近接距離と Ripley の K 関数は、画像ごとに x 方向へずらした粒子の中心から KD 木を作って求める
+# （ずらす幅は画像内の最大距離より大きいため、別の画像の粒子とは組にならない）
+#
+# 実行（リポジトリのルートから）:
+#   python -m verification.vertools.particle_stats --store predict/store --pixel-size 1.0
+
+# Ripley の K 関数で一度に列挙する粒子の組の数の目安（組ごとに数十バイトのメモリを使う）
+PAIR_BUDGET = 2_000_000
+
+
+def particle_sizes(boxes: np.ndarray, mask_areas: np.ndarray = None, pixel_size: float = 1.0) -> dict[str, np.ndarray]:
+    """
+    各粒子の面積と円相当径を求める
+    マスクの面積が無い場合は、粒子をボックスに内接する楕円とみなす（面積 π/4·w·h、円相当径 √(w·h)）
+
+    :param boxes: (N, 4) の xyxy ボックス（画素単位）
+    :param mask_areas: (N,) のマスクの画素数（mask_iou.MaskSet.areas など）
+    :param pixel_size: 1 画素の長さ（nm/px など）。結果はこの単位になる
+    :return: {'area': 面積 (N,), 'eq_diameter': 円相当径 (N,), 'aspect': 縦横比（長辺 / 短辺）(N,)}
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    if mask_areas is None:
+        area = np.pi / 4 * w * h
+    else:
+        area = np.asarray(mask_areas, dtype=np.float64).reshape(-1)
+    area = area * pixel_size ** 2
+    aspect = np.full(len(boxes), np.nan)
+    np.divide(np.maximum(w, h), np.minimum(w, h), out=aspect, where=np.minimum(w, h) > 0)
+    return {'area': area, 'eq_diameter': np.sqrt(4 * area / np.pi), 'aspect': aspect}
+
+
+def size_histograms(values: np.ndarray, image_ids: np.ndarray, n_images: int, bins=30) -> tuple[np.ndarray, np.ndarray]:
+    """
+    画像ごとのヒストグラムを、全画像で共通のビンでまとめて求める
+
+    :param values: (N,) の値（円相当径など）
+    :param image_ids: (N,) の各粒子の画像番号
+    :param n_images: 画像数
+    :param bins: ビンの数、またはビンの境界
+    :return: (画像ごとの度数 (n_images, B), ビンの境界 (B + 1,))
+    """
+    edges = np.histogram_bin_edges(values, bins=bins)
+    n_bins = len(edges) - 1
+    # 右端の値は最後のビンに含める（np.histogram と同じ）
+    which = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, n_bins - 1)
+    inside = (values >= edges[0]) & (values <= edges[-1])
+    counts = np.bincount(image_ids[inside] * n_bins + which[inside], minlength=n_images * n_bins)
+    return counts.reshape(n_images, n_bins), edges
+
+
+def _offset_centers(centers: np.ndarray, image_ids: np.ndarray, margin: float) -> np.ndarray:
+    """
+    画像ごとに x 方向へずらし、画像内のどの 2 点よりも別の画像の点の方が遠くなるようにする
+    """
+    if len(centers) == 0:
+        return centers
+    span = centers.max(axis=0) - centers.min(axis=0)
+    spacing = 2 * float(np.hypot(*span)) + margin + 1.0
+    shifted = centers - centers.min(axis=0)
+    shifted[:, 0] += image_ids * spacing
+    return shifted
+
+
+def nearest_neighbour_distances(centers: np.ndarray, image_ids: np.ndarray) -> np.ndarray:
+    """
+    各粒子から同じ画像内で最も近い粒子までの距離（画像内に 1 個しか無い粒子は NaN）
+
+    :param centers: (N, 2) の粒子の中心
+    :param image_ids: (N,) の各粒子の画像番号
+    :return: (N,) の距離
+    """
+    distances = np.full(len(centers), np.nan)
+    if len(centers) < 2:
+        return distances
+    tree = cKDTree(_offset_centers(centers, image_ids, 0.0))
+    d, j = tree.query(tree.data, k=2)
+    same = image_ids[j[:, 1]] == image_ids
+    distances[same] = d[same, 1]
+    return distances
+
+
+def ripley_k(centers: np.ndarray, image_ids: np.ndarray, n_images: int, image_areas: np.ndarray,
+             radii: np.ndarray) -> np.ndarray:
+    """
+    画像ごとの Ripley の K 関数 K(r) = A / (n (n - 1)) · #{(i, j), i ≠ j : d_ij ≤ r}（端の補正なし）
+    ランダム（ポアソン）配置では πr² になり、それより大きければ凝集、小さければ排他的な配置
+
+    :param centers: (N, 2) の粒子の中心
+    :param image_ids: (N,) の各粒子の画像番号
+    :param n_images: 画像数
+    :param image_areas: (n_images,) の各画像の面積
+    :param radii: (R,) の距離（昇順）
+    :return: (n_images, R) の K(r)（粒子が 2 個未満の画像は NaN）
+    """
+    radii = np.asarray(radii, dtype=np.float64)
+    image_areas = np.asarray(image_areas, dtype=np.float64)
+    n_radii = len(radii)
+    n = np.bincount(image_ids, minlength=n_images).astype(np.float64)
+    counts = np.zeros(n_images * (n_radii + 1), dtype=np.int64)
+    if len(centers) >= 2 and n_radii > 0:
+        # 組の数は粒子数の 2 乗で増えるため、見積もった組の数が PAIR_BUDGET 以下になるように画像を分けて数える
+        order = np.argsort(image_ids, kind='stable')
+        starts = np.searchsorted(image_ids[order], np.arange(n_images + 1))
+        expected = n ** 2 / 2 * np.minimum(1.0, np.pi * radii[-1] ** 2 / image_areas)
+        groups = np.floor(np.cumsum(expected) / PAIR_BUDGET).astype(np.int64)
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(groups)) + 1, [n_images]])
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            rows = order[starts[lo]:starts[hi]]
+            if len(rows) < 2:
+                continue
+            tree = cKDTree(_offset_centers(centers[rows], image_ids[rows], radii[-1]))
+            pairs = tree.query_pairs(radii[-1], output_type='ndarray')
+            d = np.linalg.norm(tree.data[pairs[:, 0]] - tree.data[pairs[:, 1]], axis=1)
+            # 距離 d の組は r >= d の全ての r で数える
+            first = np.searchsorted(radii, d, side='left')
+            counts += np.bincount(image_ids[rows][pairs[:, 0]] * (n_radii + 1) + first,
+                                  minlength=n_images * (n_radii + 1))
+    pair_counts = counts.reshape(n_images, n_radii + 1)[:, :n_radii].cumsum(axis=1)
+
+    k = np.full((n_images, n_radii), np.nan)
+    valid = n >= 2
+    # query_pairs は i < j の組だけを返すので 2 倍する
+    k[valid] = image_areas[valid, None] * 2 * pair_counts[valid] / (n[valid] * (n[valid] - 1))[:, None]
+    return k
+
+
+def analyze_particles(boxes: np.ndarray, image_ids: np.ndarray, n_images: int, image_size=(512, 512),
+                      pixel_size: float = 1.0, mask_areas: np.ndarray = None, bins=30,
+                      radii: np.ndarray = None) -> dict:
+    """
+    全画像の粒子の統計量をまとめて計算する
+
+    :param boxes: (N, 4) の xyxy ボックス（画素単位）
+    :param image_ids: (N,) の各粒子の画像番号（0 〜 n_images - 1）
+    :param n_images: 画像数
+    :param image_size: 画像の (幅, 高さ)（画素）。画像ごとに異なる場合は (n_images, 2) の配列
+    :param pixel_size: 1 画素の長さ
+    :param mask_areas: (N,) のマスクの画素数（省略時はボックスから求める）
+    :param bins: 円相当径のヒストグラムのビンの数、またはビンの境界
+    :param radii: Ripley の K 関数を求める距離（省略時は画像の短辺の 1/4 までを 20 等分）
+    :return: {
+        'particles': {'area', 'eq_diameter', 'aspect', 'nn_distance'}（粒子ごと (N,)）,
+        'images': {'count', 'density', 'mean_diameter', 'std_diameter', 'mean_nn', 'clark_evans',
+                   'size_hist' (n_images, B), 'ripley_k' (n_images, R)}（画像ごと）,
+        'bin_edges': (B + 1,), 'radii': (R,)
+    }
+    """
+    if n_images == 0:
+        raise ValueError("粒子統計を計算する画像がありません（ストアが空の可能性があります）。")
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    image_ids = np.asarray(image_ids, dtype=np.int64).reshape(-1)
+    sizes = np.broadcast_to(np.asarray(image_size, dtype=np.float64), (n_images, 2)) * pixel_size
+    image_areas = sizes[:, 0] * sizes[:, 1]
+    if radii is None:
+        radii = np.linspace(0, sizes.min() / 4, 21)[1:]
+
+    particles = particle_sizes(boxes, mask_areas, pixel_size)
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2 * pixel_size
+    particles['nn_distance'] = nearest_neighbour_distances(centers, image_ids)
+
+    count = np.bincount(image_ids, minlength=n_images).astype(np.float64)
+    d = particles['eq_diameter']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_d = np.bincount(image_ids, weights=d, minlength=n_images) / count
+        var_d = np.bincount(image_ids, weights=d ** 2, minlength=n_images) / count - mean_d ** 2
+        has_nn = ~np.isnan(particles['nn_distance'])
+        mean_nn = (np.bincount(image_ids[has_nn], weights=particles['nn_distance'][has_nn], minlength=n_images)
+                   / np.bincount(image_ids[has_nn], minlength=n_images))
+        density = count / image_areas
+        # Clark-Evans の比: ランダム配置での平均最近接距離 1 / (2√ρ) との比（< 1 で凝集、> 1 で規則的）
+        clark_evans = mean_nn * 2 * np.sqrt(density)
+    size_hist, edges = size_histograms(d, image_ids, n_images, bins)
+
+    return {
+        'particles': particles,
+        'images': {
+            'count': count.astype(np.int32),
+            'density': density,
+            'mean_diameter': mean_d,
+            'std_diameter': np.sqrt(np.maximum(var_d, 0)),
+            'mean_nn': mean_nn,
+            'clark_evans': clark_evans,
+            'size_hist': size_hist.astype(np.int32),
+            'ripley_k': ripley_k(centers, image_ids, n_images, image_areas, radii),
+        },
+        'bin_edges': edges,
+        'radii': radii,
+    }
+
+
+def analyze_store(store_dir: Path, image_size=(512, 512), pixel_size: float = 1.0, bins=30, radii=None,
+                  classes: list[int] = None) -> dict:
+    """
+    列形式のストアの全画像の粒子統計を計算し、同じストアに列として書き込む
+    ストアに 'mask_area' 列（画素数）があれば、面積はボックスではなくマスクから求める
+
+    :param store_dir: prediction_store 形式のストア
+    :param classes: 集計するクラスインデックス（省略時は全クラス）。対象外の行の粒子ごとの列は NaN になる
+    :return: analyze_particles の戻り値
+    """
+    store = PredictionStore(store_dir)
+    rows = np.ones(len(store), dtype=bool) if classes is None else np.isin(store.cls, classes)
+    mask_areas = store.column('mask_area')[rows] if 'mask_area' in store.extra else None
+    stats = analyze_particles(store.boxes[rows], store.image_id[rows], len(store.images), image_size,
+                              pixel_size, mask_areas, bins, radii)
+
+    particle_columns = {}
+    for name, values in stats['particles'].items():
+        column = np.full(len(store), np.nan, dtype=np.float32)
+        column[rows] = values
+        particle_columns[name] = column
+    attrs = {'particle_stats': {'bin_edges': stats['bin_edges'].tolist(), 'radii': stats['radii'].tolist(),
+                                'pixel_size': pixel_size, 'image_size': np.asarray(image_size).tolist(),
+                                'classes': classes}}
+    write_columns(store_dir, particle_columns)
+    write_columns(store_dir, stats['images'], per_image=True, attrs=attrs)
+    return stats
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="検出結果から粒子の大きさ・数密度・空間分布の統計量を計算してストアに保存する")
+    parser.add_argument("--store", type=Path, default=Path("predict/store"))
+    parser.add_argument("--pixel-size", type=float, default=1.0, help="1 画素の長さ（結果はこの単位）")
+    parser.add_argument("--width", type=int, default=512, help="画像の幅（画素）")
+    parser.add_argument("--height", type=int, default=512, help="画像の高さ（画素）")
+    parser.add_argument("--bins", type=int, default=30, help="円相当径のヒストグラムのビンの数")
+    parser.add_argument("--classes", type=int, nargs="*", help="集計するクラスインデックス")
+    args = parser.parse_args(argv)
+
+    stats = analyze_store(args.store, (args.width, args.height), args.pixel_size, args.bins, classes=args.classes)
+    images = stats['images']
+    names = PredictionStore(args.store).images
+    print(f"{'画像':<20} {'個数':>6} {'数密度':>10} {'平均径':>8} {'最近接':>8} {'CE 比':>6}")
+    for i, name in enumerate(names):
+        print(f"{name:<20} {images['count'][i]:>6d} {images['density'][i]:>10.3g} {images['mean_diameter'][i]:>8.2f} "
+              f"{images['mean_nn'][i]:>8.2f} {images['clark_evans'][i]:>6.2f}")
+    print(f"結果を {args.store} に保存しました（粒子ごと: area, eq_diameter, aspect, nn_distance、"
+          f"画像ごと: {', '.join(images)}）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+from pathlib import Path
+
+import numpy as np
+
+from verification.vertools.confusion_matrix_detect import match_detections, read_xyxy_from_txt
+
+# COCO 形式の IoU 閾値 0.50:0.05:0.95
+COCO_IOU_THRESHOLDS = np.round(np.arange(0.5, 0.96, 0.05), 2)
+
+
+def match_by_confidence(pred_boxes, pred_conf, gt_boxes, iou_thresholds=COCO_IOU_THRESHOLDS, index=None) -> np.ndarray:
+    """
+    1枚の画像について、信頼度の高い予測から順に GT とマッチさせる
+
+    :param pred_boxes: 予測ボックス (P, 4)
+    :param pred_conf: 予測の信頼度 (P,)
+    :param gt_boxes: GT ボックス (G, 4)
+    :param iou_thresholds: IoU の閾値 (T,)
+    :param index: gt_boxes から作成済みの GridIndex（同じ GT を何度も評価する場合に使い回す）
+    :return: 各予測が TP かどうか (T, P)（入力の予測の並び順）
+    """
+    pred_conf = np.asarray(pred_conf, dtype=np.float64).reshape(-1)
+    order = np.argsort(-pred_conf, kind="stable")
+    pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)[order]
+    matches = match_detections(pred_boxes, gt_boxes, iou_thresholds, index=index)
+
+    tp = np.zeros((len(matches['thresholds']), len(order)), dtype=bool)
+    tp[:, order] = matches['pred_match'] >= 0
+    return tp
+
+
+def average_precision(recall: np.ndarray, precision: np.ndarray) -> float:
+    """
+    COCO と同じ 101 点補間で AP を求める
+
+    :param recall: 信頼度の降順に並べた累積の再現率
+    :param precision: 同じ並びの累積の適合率
+    """
+    if len(recall) == 0:
+        return 0.0
+    # 適合率を右側から累積最大にして包絡線を作る
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+    points = np.linspace(0, 1, 101)
+    idx = np.searchsorted(recall, points, side="left")
+    valid = idx < len(recall)
+    return float(np.sum(envelope[idx[valid]]) / len(points))
+
+
+def evaluate_pr(images, iou_thresholds=COCO_IOU_THRESHOLDS, f1_iou: float = 0.5) -> dict:
+    """
+    複数画像の予測をまとめて評価し、PR 曲線・各 IoU の AP・F1 が最大になる信頼度を求める
+    全予測の信頼度のソートは一度だけ行い、全ての IoU 閾値を同時に計算する
+
+    :param images: (予測ボックス (P, 4), 信頼度 (P,), GT ボックス (G, 4)) の反復可能オブジェクト
+    :param iou_thresholds: AP を計算する IoU 閾値
+    :param f1_iou: F1 が最大になる信頼度を探すときの IoU 閾値
+    :return: {
+        'iou_thresholds': (T,), 'ap': (T,), 'map50': AP@0.5, 'map': AP@0.5:0.95,
+        'conf': 信頼度の降順 (K,), 'precision': (T, K), 'recall': (T, K),
+        'best_f1': {'conf', 'precision', 'recall', 'f1', 'iou'}
+    }
+    """
+    thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    all_thresholds = np.union1d(thresholds, [f1_iou])
+
+    tp_parts = []
+    conf_parts = []
+    n_gt = 0
+    for pred_boxes, pred_conf, gt_boxes in images:
+        tp_parts.append(match_by_confidence(pred_boxes, pred_conf, gt_boxes, all_thresholds))
+        conf_parts.append(np.asarray(pred_conf, dtype=np.float64).reshape(-1))
+        n_gt += len(np.asarray(gt_boxes).reshape(-1, 4))
+
+    conf = np.concatenate(conf_parts) if conf_parts else np.zeros(0)
+    tp = np.concatenate(tp_parts, axis=1) if tp_parts else np.zeros((len(all_thresholds), 0), dtype=bool)
+
+    # 全予測を信頼度の降順に一度だけ並べ替え、累積和で PR 曲線を作る
+    order = np.argsort(-conf, kind="stable")
+    conf = conf[order]
+    tp_cum = np.cumsum(tp[:, order], axis=1)
+    n_pred = np.arange(1, len(conf) + 1)
+    precision_all = tp_cum / np.maximum(n_pred, 1)
+    recall_all = tp_cum / n_gt if n_gt > 0 else np.zeros_like(precision_all)
+
+    ap_all = np.array([average_precision(r, p) for r, p in zip(recall_all, precision_all)])
+    rows = np.searchsorted(all_thresholds, thresholds)
+    ap = ap_all[rows]
+
+    # F1 は同じ信頼度の予測をまとめて採用した位置（信頼度が変わる直前）だけで評価する
+    f1_row = int(np.searchsorted(all_thresholds, f1_iou))
+    best_f1 = {'conf': None, 'precision': 0.0, 'recall': 0.0, 'f1': 0.0, 'iou': f1_iou}
+    if len(conf):
+        last_of_tie = np.append(conf[1:] != conf[:-1], True)
+        p, r = precision_all[f1_row][last_of_tie], recall_all[f1_row][last_of_tie]
+        f1 = np.divide(2 * p * r, p + r, out=np.zeros_like(p), where=(p + r) > 0)
+        k = int(np.argmax(f1))
+        best_f1.update(conf=float(conf[last_of_tie][k]), precision=float(p[k]), recall=float(r[k]), f1=float(f1[k]))
+
+    map50_row = np.flatnonzero(np.isclose(thresholds, 0.5))
+    return {
+        'iou_thresholds': thresholds,
+        'ap': ap,
+        'map50': float(ap[map50_row[0]]) if len(map50_row) else None,
+        'map': float(ap.mean()) if len(ap) else 0.0,
+        'conf': conf,
+        'precision': precision_all[rows],
+        'recall': recall_all[rows],
+        'best_f1': best_f1,
+    }
+
+
+if __name__ == "__main__":
+    from verification.vertools.prediction_store import PredictionStore
+
+    # 信頼度が必要なため、列形式のストアから読み込む
+    # （JSON しかない場合は python -m verification.vertools.prediction_store で変換する）
+    store = PredictionStore(Path("predict/store"))
+    labels = Path("YOLO_dataset_zip/project-6-at-2025-03-23-20-14-00444e1f/labels")
+
+    def iter_images():
+        for name, pred in store.iter_images():
+            gt_boxes = read_xyxy_from_txt(labels / f"{name}.txt")
+            yield pred['boxes'], pred['conf'], gt_boxes
+
+    result = evaluate_pr(iter_images())
+    for thr, ap in zip(result['iou_thresholds'], result['ap']):
+        print(f"AP@{thr:.2f}: {ap:.4f}")
+    print(f"mAP@0.5: {result['map50']:.4f}")
+    print(f"mAP@0.5:0.95: {result['map']:.4f}")
+    best = result['best_f1']
+    print(f"F1 最大 (IoU={best['iou']}): conf={best['conf']}, "
+          f"P={best['precision']:.4f}, R={best['recall']:.4f}, F1={best['f1']:.4f}")
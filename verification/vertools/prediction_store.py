@@ -0,0 +1,305 @@
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+
+# 列ごとのファイル名と dtype、1行あたりの要素数
+COLUMNS = {
+    'boxes': ('boxes.f32', np.float32, 4),
+    'conf': ('conf.f32', np.float32, 1),
+    'cls': ('cls.i32', np.int32, 1),
+    'image_id': ('image_id.i32', np.int32, 1),
+}
+META_NAME = 'meta.json'
+FORMAT_VERSION = 1
+
+
+class PredictionWriter:
+    """
+    推論結果を列ごとのバイナリファイルへ追記していくライター
+    1 ラン = 1 ディレクトリで、close() 時に meta.json を書き出す
+
+    使い方:
+        with PredictionWriter(Path("predict/store")) as writer:
+            writer.add("spcdr_1", boxes, conf, cls)
+    """
+
+    def __init__(self, store_dir: Path, append: bool = False):
+        """
+        :param store_dir: 出力先ディレクトリ
+        :param append: True の場合は既存のストアに追記する
+        """
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+        self.images = []
+        self.image_ids = {}
+        self.ranges = {}
+        self.names = {}
+        self.count = 0
+
+        meta_path = self.store_dir / META_NAME
+        if append and meta_path.exists():
+            meta = _read_meta(self.store_dir)
+            self.images = list(meta['images'])
+            self.image_ids = {name: i for i, name in enumerate(self.images)}
+            self.ranges = {int(k): [list(r) for r in v] for k, v in meta['ranges'].items()}
+            self.names = {int(k): v for k, v in meta['names'].items()}
+            self.count = meta['count']
+            mode = 'ab'
+        else:
+            mode = 'wb'
+            if meta_path.exists():
+                meta_path.unlink()
+
+        self._files = {}
+        for col, (file_name, dtype, width) in COLUMNS.items():
+            f = open(self.store_dir / file_name, mode)
+            if mode == 'ab':
+                # 前回の書き込みが中断していた場合に備えて、meta.json の件数に切り詰める
+                f.truncate(self.count * width * np.dtype(dtype).itemsize)
+            self._files[col] = f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add(self, image_name: str, boxes, conf=None, cls=None, names: dict = None) -> None:
+        """
+        1枚の画像（またはその一部）の検出結果をまとめて追記する
+
+        :param image_name: 画像名（拡張子なしのファイル名など）
+        :param boxes: (K, 4) の xyxy ボックス
+        :param conf: (K,) の信頼度（省略時は 1.0）
+        :param cls: (K,) のクラスインデックス（省略時は 0）
+        :param names: {クラスインデックス: クラス名}
+        """
+        boxes = np.ascontiguousarray(boxes, dtype=np.float32).reshape(-1, 4)
+        k = len(boxes)
+        conf = np.ones(k, np.float32) if conf is None else np.ascontiguousarray(conf, dtype=np.float32).reshape(-1)
+        cls = np.zeros(k, np.int32) if cls is None else np.ascontiguousarray(cls, dtype=np.int32).reshape(-1)
+        if len(conf) != k or len(cls) != k:
+            raise ValueError(f"boxes/conf/cls の件数が一致しません: {k}, {len(conf)}, {len(cls)}")
+
+        if image_name not in self.image_ids:
+            self.image_ids[image_name] = len(self.images)
+            self.images.append(image_name)
+        image_id = self.image_ids[image_name]
+        if names:
+            self.names.update({int(i): n for i, n in names.items()})
+
+        self._files['boxes'].write(boxes.tobytes())
+        self._files['conf'].write(conf.tobytes())
+        self._files['cls'].write(cls.tobytes())
+        self._files['image_id'].write(np.full(k, image_id, np.int32).tobytes())
+
+        # 画像ごとの行範囲を記録（直前の範囲と連続していれば結合する）
+        ranges = self.ranges.setdefault(image_id, [])
+        if ranges and ranges[-1][1] == self.count:
+            ranges[-1][1] += k
+        else:
+            ranges.append([self.count, self.count + k])
+        self.count += k
+
+    def close(self) -> None:
+        """
+        ファイルを閉じ、meta.json を書き出す
+        """
+        if self._files is None:
+            return
+        for f in self._files.values():
+            f.close()
+        self._files = None
+
+        meta = {
+            'version': FORMAT_VERSION,
+            'count': self.count,
+            'images': self.images,
+            'ranges': {str(k): v for k, v in self.ranges.items()},
+            'names': {str(k): v for k, v in self.names.items()},
+            'columns': {
+                col: {'file': file_name, 'dtype': np.dtype(dtype).name, 'width': width}
+                for col, (file_name, dtype, width) in COLUMNS.items()
+            },
+        }
+        # 追記などで行が変わると、write_columns で追加した列は対応しなくなるため meta.json から外す
+        _write_meta(self.store_dir, meta)
+
+
+class PredictionStore:
+    """
+    PredictionWriter で書き出したストアをメモリマップで読み込むリーダー
+    各列は読み取り専用の np.memmap として保持し、必要な部分だけがディスクから読まれる
+    """
+
+    def __init__(self, store_dir: Path):
+        """
+        :param store_dir: ストアのディレクトリ
+        """
+        self.store_dir = Path(store_dir)
+        meta = _read_meta(self.store_dir)
+        self.count = meta['count']
+        self.images = list(meta['images'])
+        self.image_ids = {name: i for i, name in enumerate(self.images)}
+        self.ranges = {int(k): v for k, v in meta['ranges'].items()}
+        self.names = {int(k): v for k, v in meta['names'].items()}
+
+        for col, (file_name, dtype, width) in COLUMNS.items():
+            shape = (self.count, width) if width > 1 else (self.count,)
+            if self.count == 0:
+                array = np.empty(shape, dtype=dtype)
+            else:
+                array = np.memmap(self.store_dir / file_name, dtype=dtype, mode='r', shape=shape)
+            setattr(self, col, array)
+        # write_columns で追加した列（粒子の統計量など）
+        self.extra = meta.get('extra', {})
+        self.attrs = meta.get('attrs', {})
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        write_columns で追加した列をメモリマップで読み込む
+
+        :param name: 列名
+        :return: 行ごとの列は (count, ...)、画像ごとの列は (画像数, ...) の配列
+        """
+        if name not in self.extra:
+            raise KeyError(f"ストアに列 '{name}' が存在しません。")
+        info = self.extra[name]
+        shape = tuple(info['shape'])
+        if shape[0] == 0:
+            return np.empty(shape, dtype=info['dtype'])
+        return np.memmap(self.store_dir / info['file'], dtype=info['dtype'], mode='r', shape=shape)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def get(self, image_name: str) -> dict[str, np.ndarray]:
+        """
+        1枚の画像の検出結果を取得する
+
+        :param image_name: 画像名
+        :return: {'boxes': (K, 4), 'conf': (K,), 'cls': (K,)}
+        """
+        if image_name not in self.image_ids:
+            raise KeyError(f"ストアに画像 '{image_name}' が存在しません。")
+        ranges = self.ranges.get(self.image_ids[image_name], [])
+        result = {}
+        for col in ('boxes', 'conf', 'cls'):
+            array = getattr(self, col)
+            if len(ranges) == 1:
+                # 連続していればコピーせずにビューを返す
+                start, stop = ranges[0]
+                result[col] = array[start:stop]
+            else:
+                result[col] = np.concatenate([array[start:stop] for start, stop in ranges]) if ranges else array[:0]
+        return result
+
+    def iter_images(self):
+        """
+        画像ごとに (画像名, 検出結果) を順に返す
+        """
+        for name in self.images:
+            yield name, self.get(name)
+
+    def iter_batches(self, batch_size: int = 65536):
+        """
+        全行を batch_size 行ずつ区切って返す
+
+        :param batch_size: 1バッチあたりの行数
+        """
+        for start in range(0, self.count, batch_size):
+            stop = min(start + batch_size, self.count)
+            yield {col: getattr(self, col)[start:stop] for col in COLUMNS}
+
+
+def write_columns(store_dir: Path, columns: dict, per_image: bool = False, attrs: dict = None) -> None:
+    """
+    既存のストアに列を追加する（同じ名前の列は置き換える）
+    行ごとの列は PredictionStore の行（boxes など）と同じ順、画像ごとの列は store.images と同じ順に並べる
+
+    :param store_dir: ストアのディレクトリ
+    :param columns: {列名: 配列}
+    :param per_image: True の場合は画像ごとの列
+    :param attrs: 列の解釈に必要な値（ヒストグラムのビンの境界など、JSON にできるもの）
+    """
+    store_dir = Path(store_dir)
+    meta = _read_meta(store_dir)
+    n = len(meta['images']) if per_image else meta['count']
+    extra = meta.setdefault('extra', {})
+    for name, array in columns.items():
+        if name in COLUMNS:
+            raise ValueError(f"列 '{name}' は既存の列と同じ名前です。")
+        array = np.ascontiguousarray(array)
+        if len(array) != n:
+            raise ValueError(f"列 '{name}' の長さが一致しません: {len(array)} (期待値 {n})")
+        file_name = f"{name}.{array.dtype.kind}{array.dtype.itemsize * 8}"
+        tmp_path = store_dir / (file_name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(array.tobytes())
+        os.replace(tmp_path, store_dir / file_name)
+        extra[name] = {'file': file_name, 'dtype': array.dtype.name, 'shape': list(array.shape),
+                       'per_image': per_image}
+    if attrs:
+        meta.setdefault('attrs', {}).update(attrs)
+    _write_meta(store_dir, meta)
+
+
+def _write_meta(store_dir: Path, meta: dict) -> None:
+    # 書き込み途中で落ちても壊れたメタデータが残らないように置き換える
+    tmp_path = Path(store_dir) / (META_NAME + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(tmp_path, Path(store_dir) / META_NAME)
+
+
+def _read_meta(store_dir: Path) -> dict:
+    meta_path = Path(store_dir) / META_NAME
+    if not meta_path.exists():
+        raise FileNotFoundError(f"ストアのメタデータが存在しません: {meta_path}")
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        raise ValueError(f"未対応のストア形式です: version={meta.get('version')}")
+    return meta
+
+
+def image_name_from_json(json_path: Path) -> str:
+    """
+    predict/result_no_<画像名>.json のファイル名から画像名を取り出す
+    """
+    stem = Path(json_path).stem
+    return stem[len('result_no_'):] if stem.startswith('result_no_') else stem
+
+
+def convert_json_files(json_paths, store_dir: Path, append: bool = False) -> int:
+    """
+    save_to_json.py が出力した JSON ファイル群を列形式のストアに変換する
+
+    :param json_paths: 変換する JSON ファイルのパスのリスト
+    :param store_dir: 出力先ディレクトリ
+    :param append: True の場合は既存のストアに追記する
+    :return: 変換したボックスの数
+    """
+    with PredictionWriter(store_dir, append=append) as writer:
+        for json_path in json_paths:
+            with open(json_path, 'r') as f:
+                data = json.load(f)
+            objs = [obj for group in data for obj in group]
+            boxes = [(o['box']['x1'], o['box']['y1'], o['box']['x2'], o['box']['y2']) for o in objs]
+            writer.add(
+                image_name_from_json(json_path),
+                boxes,
+                conf=[o.get('confidence', 1.0) for o in objs],
+                cls=[o.get('class', 0) for o in objs],
+                names={o['class']: o['name'] for o in objs if 'class' in o and 'name' in o},
+            )
+        return writer.count
+
+
+if __name__ == "__main__":
+    json_paths = sorted(Path("predict").glob("result_no_*.json"))
+    n = convert_json_files(json_paths, Path("predict/store"))
+    print(f"変換完了: {len(json_paths)} 個のファイル、{n} 個のボックスを predict/store に保存しました。")
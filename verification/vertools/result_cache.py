@@ -0,0 +1,185 @@
+from pathlib import Path
+import hashlib
+import io
+import json
+import sqlite3
+import time
+
+import numpy as np
+
+# 推論結果・評価指標をその入力の内容で引くキャッシュ
+#
+# キーは (チェックポイントの内容のハッシュ, 画像の内容のハッシュ, 推論の引数) のように、
+# 結果を決める入力だけから作る。ファイル名や実行順には依存しないため、
+# 画像を1枚追加して再実行した場合は、その画像の推論と評価だけが行われる
+#
+# 結果は SQLite（既定は predict/cache/results.db）に npz のバイト列として保存し、
+# 合計サイズが max_bytes を超えたら最後に使った時刻が古いものから削除する
+
+CACHE_DIR = Path("predict/cache")
+DB_NAME = "results.db"
+# キャッシュの形式を変えた場合はこの番号を上げる（古いエントリは使われなくなる）
+CACHE_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,           -- predict / metrics など
+    data BLOB NOT NULL,           -- np.savez のバイト列
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS digests (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+"""
+
+
+def array_digest(array) -> str:
+    """
+    配列の内容（dtype・形状を含む）のハッシュ
+    """
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    h.update(array.tobytes())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    内容のハッシュをキーにした、サイズ上限付きの結果キャッシュ
+    複数のプロセスから同じファイルを開いてもよい（書き込みは SQLite のロックで直列化される）
+
+    使い方:
+        cache = ResultCache()
+        key = cache.key("predict", cache.file_digest(checkpoint), cache.file_digest(image), {"conf": 0.7})
+        arrays = cache.get(key)
+        if arrays is None:
+            arrays = {...}
+            cache.put(key, arrays, kind="predict")
+    """
+
+    def __init__(self, cache_dir: Path = CACHE_DIR, max_bytes: int = 1 << 30):
+        """
+        :param cache_dir: キャッシュの保存先
+        :param max_bytes: 保存する結果の合計バイト数の上限
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(self.cache_dir / DB_NAME, timeout=60)
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def file_digest(self, path) -> str:
+        """
+        ファイルの内容の SHA-256
+        更新時刻とサイズが前回と同じであれば、読み直さずに記録済みの値を返す
+        """
+        path = Path(path).resolve()
+        stat = path.stat()
+        row = self.conn.execute("SELECT mtime_ns, size, digest FROM digests WHERE path = ?", (str(path),)).fetchone()
+        if row is not None and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+            return row[2]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        digest = h.hexdigest()
+        self.conn.execute("INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                          (str(path), stat.st_mtime_ns, stat.st_size, digest))
+        self.conn.commit()
+        return digest
+
+    @staticmethod
+    def key(*parts) -> str:
+        """
+        入力からキーを作る（辞書はキーの順序に依存しない）
+
+        :param parts: 文字列・数値・リスト・辞書など JSON にできる値
+        """
+        text = json.dumps([CACHE_VERSION, *parts], sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> dict[str, np.ndarray]:
+        """
+        保存済みの結果を返す（無ければ None）
+        """
+        row = self.conn.execute("SELECT data FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        with np.load(io.BytesIO(row[0])) as data:
+            return {name: data[name] for name in data.files}
+
+    def put(self, key: str, arrays: dict, kind: str = "") -> None:
+        """
+        結果を保存し、合計サイズが上限を超えた分を古いものから削除する
+
+        :param arrays: {名前: 配列}
+        :param kind: エントリの種類（表示用）
+        """
+        buffer = io.BytesIO()
+        np.savez(buffer, **{name: np.asarray(value) for name, value in arrays.items()})
+        data = buffer.getvalue()
+        self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                          (key, kind, data, len(data), time.time()))
+        self._evict()
+        self.conn.commit()
+
+    def _evict(self) -> None:
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        removed = []
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            removed.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", removed)
+
+    def get_json(self, key: str):
+        """
+        put_json で保存した値を返す（無ければ None）
+        """
+        arrays = self.get(key)
+        return None if arrays is None else json.loads(str(arrays["json"]))
+
+    def put_json(self, key: str, value, kind: str = "") -> None:
+        """
+        評価指標の辞書など、JSON にできる値を保存する
+        """
+        self.put(key, {"json": np.array(json.dumps(value, ensure_ascii=False))}, kind)
+
+    def stats(self) -> dict:
+        """
+        保存しているエントリの種類ごとの件数とバイト数、このインスタンスでのヒット数
+        """
+        rows = self.conn.execute("SELECT kind, COUNT(*), SUM(size) FROM entries GROUP BY kind").fetchall()
+        return {'entries': {kind: {'count': n, 'bytes': size} for kind, n, size in rows},
+                'hits': self.hits, 'misses': self.misses}
+
+
+if __name__ == "__main__":
+    with ResultCache() as cache:
+        print(cache.stats())
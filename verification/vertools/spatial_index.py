@@ -0,0 +1,189 @@
+import numpy as np
+
+# グリッドの一辺のセル数の上限（セルの配列が大きくなりすぎないようにする）
+MAX_CELLS_PER_SIDE = 1024
+
+
+def _expand_cells(x0, y0, x1, y1, n_cols):
+    """
+    各ボックスが覆うセル範囲 [x0, x1] × [y0, y1] を (ボックス番号, セル番号) の組に展開する
+    """
+    widths = x1 - x0 + 1
+    counts = widths * (y1 - y0 + 1)
+    owner = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    dx = local % widths[owner]
+    dy = local // widths[owner]
+    cells = (y0[owner] + dy) * n_cols + (x0[owner] + dx)
+    return owner, cells
+
+
+class GridIndex:
+    """
+    GT ボックスを一様グリッドに登録し、予測ボックスの近くにある GT だけを候補として返す空間インデックス
+    粒子が小さく画像全体にまばらに分布している場合、マッチングの計算量をほぼ線形にできる
+    1枚の画像の GT（polygon_to_xyxy の出力）に対して一度作れば、IoU 閾値を変えても使い回せる
+    """
+
+    def __init__(self, gt_boxes, cell_size: float = None):
+        """
+        :param gt_boxes: GT ボックス (G, 4)
+        :param cell_size: セルの一辺（省略時は GT ボックスの大きさの中央値の 2 倍。
+            全体の範囲を MAX_CELLS_PER_SIDE 個より細かくは分けない）
+        """
+        self.boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+        if len(self.boxes) == 0:
+            self.cell_size = 1.0
+            self.origin = np.zeros(2)
+            self.n_cols = self.n_rows = 1
+            self.cell_starts = np.zeros(2, dtype=np.int64)
+            self.members = np.zeros(0, dtype=np.int64)
+            return
+
+        self.origin = self.boxes[:, :2].min(axis=0)
+        extent = self.boxes[:, 2:].max(axis=0) - self.origin
+        if cell_size is None:
+            sizes = np.maximum(self.boxes[:, 2] - self.boxes[:, 0], self.boxes[:, 3] - self.boxes[:, 1])
+            cell_size = 2 * float(np.median(sizes))
+        # 小さいボックスが多いとセルが細かくなりすぎるため、一辺のセル数を MAX_CELLS_PER_SIDE までに抑える
+        cell_size = max(cell_size, float(extent.max()) / MAX_CELLS_PER_SIDE)
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+        self.n_cols, self.n_rows = (np.floor(extent / self.cell_size).astype(np.int64) + 1).tolist()
+
+        # 各 GT が覆うセルに登録し、セル番号順に並べて CSR 形式で保持する（同じセル内は GT 番号順）
+        owner, cells = _expand_cells(*self._cell_range(self.boxes), self.n_cols)
+        order = np.lexsort((owner, cells))
+        self.members = owner[order]
+        self.cell_starts = np.searchsorted(cells[order], np.arange(self.n_cols * self.n_rows + 1))
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def _cell_range(self, boxes: np.ndarray):
+        lo = np.floor((boxes[:, :2] - self.origin) / self.cell_size).astype(np.int64)
+        hi = np.floor((boxes[:, 2:] - self.origin) / self.cell_size).astype(np.int64)
+        lo[:, 0] = np.clip(lo[:, 0], 0, self.n_cols - 1)
+        hi[:, 0] = np.clip(hi[:, 0], 0, self.n_cols - 1)
+        lo[:, 1] = np.clip(lo[:, 1], 0, self.n_rows - 1)
+        hi[:, 1] = np.clip(hi[:, 1], 0, self.n_rows - 1)
+        hi = np.maximum(hi, lo)
+        return lo[:, 0], lo[:, 1], hi[:, 0], hi[:, 1]
+
+    def candidate_pairs(self, pred_boxes) -> tuple[np.ndarray, np.ndarray]:
+        """
+        予測ボックスと重なる GT の組を、同じセルにかかる GT の中から列挙する
+
+        :param pred_boxes: 予測ボックス (P, 4)
+        :return: (予測の番号, GT の番号)（予測番号順、同じ予測の中では GT 番号順、重複なし）
+        """
+        pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+        if len(pred_boxes) == 0 or len(self.boxes) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        pred_owner, cells = _expand_cells(*self._cell_range(pred_boxes), self.n_cols)
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells + 1] - starts
+        pi = np.repeat(pred_owner, counts)
+        pair_cells = np.repeat(cells, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        gj = self.members[np.repeat(starts, counts) + offsets]
+
+        # 実際に重なる組だけを残す。同じ組が複数のセルで見つかるため、交差部分の左上の点を含むセルでのみ残す
+        corner = np.maximum(pred_boxes[pi, :2], self.boxes[gj, :2])
+        far = np.minimum(pred_boxes[pi, 2:], self.boxes[gj, 2:])
+        cx, cy, _, _ = self._cell_range(np.concatenate([corner, corner], axis=1))
+        keep = (far > corner).all(axis=1) & ((cy * self.n_cols + cx) == pair_cells)
+        pi, gj = pi[keep], gj[keep]
+
+        order = np.lexsort((gj, pi))
+        return pi[order], gj[order]
+
+
+def pair_iou(boxes1: np.ndarray, boxes2: np.ndarray) -> np.ndarray:
+    """
+    対応するボックス同士の IoU を計算する（compute_iou と同じ式）
+
+    :param boxes1: (K, 4)
+    :param boxes2: (K, 4)
+    :return: (K,)
+    """
+    w = np.clip(np.minimum(boxes1[:, 2], boxes2[:, 2]) - np.maximum(boxes1[:, 0], boxes2[:, 0]), 0, None)
+    h = np.clip(np.minimum(boxes1[:, 3], boxes2[:, 3]) - np.maximum(boxes1[:, 1], boxes2[:, 1]), 0, None)
+    intersection = w * h
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1 + area2 - intersection
+    iou = np.zeros_like(union)
+    np.divide(intersection, union, out=iou, where=union != 0)
+    return iou
+
+
+def greedy_match_pairs(pi: np.ndarray, gj: np.ndarray, ious: np.ndarray, n_pred: int, n_gt: int,
+                       iou_thresholds=(0.5,)) -> dict:
+    """
+    疎な IoU（重なる組だけ）から、match_detections と同じ貪欲マッチングを行う
+    予測を先頭から順に、未マッチの GT のうち IoU 最大のもの（同値なら番号の小さい方）と組ませる
+
+    :param pi: 予測の番号（昇順、同じ予測の中では GT 番号の昇順）
+    :param gj: GT の番号
+    :param ious: 各組の IoU
+    :param n_pred: 予測の数
+    :param n_gt: GT の数
+    :param iou_thresholds: IoU の閾値のリスト (T,)
+    :return: match_detections と同じ形式の辞書
+    """
+    thresholds = np.atleast_1d(np.asarray(iou_thresholds, dtype=np.float64))
+    n_thr = len(thresholds)
+    # IoU が 0 の組はマッチに影響しないので落とす
+    overlap = ious > 0
+    pi, gj, ious = pi[overlap], gj[overlap], ious[overlap]
+    bounds = np.searchsorted(pi, np.arange(n_pred + 1))
+
+    matched_gt = np.zeros((n_thr, n_gt), dtype=bool)
+    pred_match = np.full((n_thr, n_pred), -1, dtype=np.int64)
+    tp = np.zeros(n_thr, dtype=np.int64)
+    rows = np.arange(n_thr)
+    zero_hit = thresholds <= 0
+
+    for i in range(n_pred):
+        start, stop = bounds[i], bounds[i + 1]
+        if start == stop:
+            # どの GT とも重ならない予測（閾値 0 のときのみ TP になり得る）
+            tp += zero_hit
+            continue
+        cand = gj[start:stop]
+        masked = np.where(matched_gt[:, cand], -1.0, ious[start:stop][None, :])
+        best_k = masked.argmax(axis=1)
+        best_iou = np.maximum(masked[rows, best_k], 0.0)
+
+        hit = best_iou >= thresholds
+        tp += hit
+        claim = hit & (best_iou > 0)
+        matched_gt[rows[claim], cand[best_k[claim]]] = True
+        pred_match[rows[claim], i] = cand[best_k[claim]]
+
+    return {
+        'thresholds': thresholds,
+        'tp': tp,
+        'fp': n_pred - tp,
+        'fn': n_gt - tp,
+        'pred_match': pred_match
+    }
+
+
+def match_detections_indexed(pred_boxes, gt_boxes=None, iou_thresholds=(0.5,), index: GridIndex = None) -> dict:
+    """
+    confusion_matrix_detect.match_detections と同じ貪欲マッチングを、空間インデックスの候補だけで行う
+    戻り値の形式も match_detections と同じ
+
+    :param pred_boxes: 予測ボックス (P, 4)
+    :param gt_boxes: GT ボックス (G, 4)（index を渡す場合は省略可）
+    :param iou_thresholds: IoU の閾値のリスト (T,)
+    :param index: 作成済みの GridIndex（省略時は gt_boxes から作る）
+    """
+    if index is None:
+        index = GridIndex(gt_boxes)
+    pred_boxes = np.asarray(pred_boxes, dtype=np.float64).reshape(-1, 4)
+    pi, gj = index.candidate_pairs(pred_boxes)
+    ious = pair_iou(pred_boxes[pi], index.boxes[gj])
+    return greedy_match_pairs(pi, gj, ious, len(pred_boxes), len(index), iou_thresholds)